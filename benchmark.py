@@ -0,0 +1,444 @@
+#!/usr/bin/env python3
+
+# Micro-benchmarks of the parser internals on synthetic sources that mimic WiredTiger's
+# heaviest macros. Run: python benchmark.py [benchmark ...]
+
+import sys, os, gc, time, argparse, tempfile, pickle, tracemalloc
+sys.path.insert(0, os.path.dirname(__file__))
+
+from layercparse import *
+
+# Simplified copies of WiredTiger's statistics macros
+WT_STAT_MACROS = r"""
+/* #private(conn) */
+#define S2C(session) ((WT_CONNECTION_IMPL *)((WT_SESSION_IMPL *)(session))->iface.connection)
+#define WT_STAT_ENABLED(session) (S2C(session)->stat_flags != 0)
+#define WT_STATS_SLOT_ID(session) (((session)->id) % WT_STAT_CONN_COUNTER_SLOTS)
+#define WT_STAT_INCRV_BASE(session, stat, fld, value) \
+    do { \
+        if (WT_STAT_ENABLED(session)) \
+            (stat)->fld += (int64_t)(value); \
+    } while (0)
+#define WT_STAT_INCRV_ATOMIC_BASE(session, stat, fld, value) \
+    do { \
+        if (WT_STAT_ENABLED(session)) \
+            __wt_atomic_addi64(&(stat)->fld, (int64_t)(value)); \
+    } while (0)
+#define WT_STAT_CONN_INCRV(session, fld, value) \
+    WT_STAT_INCRV_BASE(session, S2C(session)->stats[WT_STATS_SLOT_ID(session)], conn_##fld, value)
+#define WT_STAT_CONN_INCR(session, fld) WT_STAT_CONN_INCRV(session, fld, 1)
+#define WT_STAT_CONN_DECR(session, fld) WT_STAT_CONN_INCRV(session, fld, -1)
+#define WT_STAT_CONN_INCR_ATOMIC(session, fld) \
+    WT_STAT_INCRV_ATOMIC_BASE(session, S2C(session)->stats[WT_STATS_SLOT_ID(session)], conn_##fld, 1)
+#define WT_STAT_DSRC_INCRV(session, fld, value) \
+    WT_STAT_INCRV_BASE(session, (session)->dhandle->stats[WT_STATS_SLOT_ID(session)], fld, value)
+#define WT_STAT_CONN_DSRC_INCR(session, fld) \
+    do { \
+        WT_STAT_CONN_INCR(session, fld); \
+        WT_STAT_DSRC_INCRV(session, fld, 1); \
+    } while (0)
+#define WT_RET(a) do { int __ret; if ((__ret = (a)) != 0) return (__ret); } while (0)
+#define WT_ERR(a) do { if ((ret = (a)) != 0) goto err; } while (0)
+#define F_ISSET(p, mask) ((p)->flags & (mask))
+#define WT_ASSERT(session, exp) do { if (!(exp)) __wt_abort(session, #exp); } while (0)
+#define __wt_verbose(session, category, fmt, ...) \
+    do { \
+        if (WT_VERBOSE_ISSET(session, category)) \
+            __wt_verbose_worker(session, category, "[" #category "] " fmt, ## __VA_ARGS__); \
+    } while (0)
+#define WT_VERBOSE_ISSET(session, category) (S2C(session)->verbose[category] != 0)
+"""
+
+WT_STAT_USES = [
+    "WT_STAT_CONN_INCR(session, cursor_insert);",
+    "WT_STAT_CONN_DECR(session{i}, cursor_open_count);",
+    "WT_STAT_CONN_INCR_ATOMIC(session, txn_begin);",
+    "WT_STAT_CONN_DSRC_INCR(session, cache_read_{i});",
+    "WT_STAT_CONN_INCRV(session, block_write_bytes, size + {i});",
+    "WT_RET(__wt_cursor_init(cursor, NULL, owner{i}, cfg, cursorp));",
+    "WT_ERR(__wt_buf_init(session, tmp, {i}));",
+    "if (F_ISSET(conn, WT_CONN_CLOSING)) return (0);",
+    "WT_ASSERT(session, cbt->ref != NULL && cbt->slot < {i});",
+    '__wt_verbose(session, WT_VERB_RECOVERY, "%s: %d", name, {i});',
+]
+
+def gen_source(functions: int) -> str:
+    """A source file with many functions using the macros."""
+    lines = []
+    for f in range(functions):
+        lines.append(f"int\nfunc{f}(WT_SESSION_IMPL *session)\n{{")
+        lines.extend("    " + use.format(i=(f * 7 + n) % 13) for n, use in enumerate(WT_STAT_USES))
+        lines.append("    return (0);\n}\n")
+    return "\n".join(lines)
+
+def gen_header(structs: int) -> str:
+    """A header with struct definitions and prototypes that use types but no macros."""
+    lines = []
+    for s in range(structs):
+        lines.append(f"/*\n * __wt_struct{s} --\n *     A structure with WT_* typed fields.\n */")
+        lines.append(f"struct __wt_struct{s} {{")
+        lines.extend(f"    WT_SESSION_IMPL *session{f};\n    WT_DATA_HANDLE *dhandle{f};\n"
+                     f"    uint64_t counter{f};" for f in range(5))
+        lines.append("};")
+        lines.append(f"extern int __wt_struct{s}_init(WT_SESSION_IMPL *session, WT_ITEM *buf);")
+    return "\n".join(lines) + "\n"
+
+def _timeit(fn, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def _codebase() -> Codebase:
+    _globals = Codebase()
+    with ScopePush(file=File("wt_stat.h")):
+        _globals.updateMacroFromText(WT_STAT_MACROS)
+    return _globals
+
+def bench_expand(args) -> None:
+    """Function-like macro substitution: expansion with the expansion cache disabled."""
+    txt = gen_source(args.functions)
+    table = _codebase().macro_table()
+    table.cache.maxsize = 0
+    t = _timeit(lambda: MacroExpander().expand(txt, table), args.repeat)
+    print(f"expand: {len(txt)} bytes, {args.functions * len(WT_STAT_USES)} macro uses: "
+          f"{t * 1000:.1f} ms")
+
+def bench_policies(args) -> None:
+    """Expansion and parsing of a file with each macro expansion policy."""
+    txt = gen_source(args.functions)
+    policies: dict[str, ExpandPolicy] = {
+        "all": "all",
+        "private": "private",
+        "has_rettype": "has_rettype",
+        "no WT_STAT_*": lambda defn: not defn.name.startswith("WT_STAT_"),
+    }
+    for name, policy in policies.items():
+        def _run() -> None:
+            _globals = _codebase()
+            _globals.expand_policy = policy
+            with ScopePush(file=File("wt_stat.c")):
+                _globals.updateFromText(MacroExpander().expand(txt, _globals.macro_table()),
+                                        do_preproc=False)
+        t = _timeit(_run, args.repeat)
+        table = MacroTable(_codebase().macros, policy=policy)
+        print(f"policy {name}: {len(table.obj_like | table.fn_like) - len(table.opaque)} of "
+              f"{len(table.obj_like | table.fn_like)} macros expanded: {t * 1000:.1f} ms")
+
+def bench_local_macros(args) -> None:
+    """Scan of a header and .c files with own macros: global macros vs. per-file .c macros."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        files = [os.path.join(tmpdir, "wt_stat.h")]
+        with open(files[0], "w") as f:
+            f.write(WT_STAT_MACROS)
+        for n in range(args.files):
+            files.append(os.path.join(tmpdir, f"file{n}.c"))
+            with open(files[-1], "w") as f:
+                f.write(f"#define LOCAL{n}_RET(a) WT_RET(a)\n#define LOCAL{n}_FLAG 0x{n}u\n")
+                f.write(gen_source(args.functions // args.files))
+        for multithread in [False, True]:
+            for local_macros in [False, True]:
+                t = _timeit(lambda: Codebase().scanFiles(files, multithread=multithread,
+                                                         local_macros=local_macros), args.repeat)
+                print(f"scan {args.files} files, {'multi' if multithread else 'single'}-threaded, "
+                      f"{'local' if local_macros else 'global'} .c macros: {t * 1000:.1f} ms")
+
+def bench_scan(args) -> None:
+    """Scan of many headers and sources: single-threaded vs. worker processes."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        files = [os.path.join(tmpdir, "wt_stat.h")]
+        with open(files[0], "w") as f:
+            f.write(WT_STAT_MACROS)
+        for n in range(args.files):
+            for ext, txt in (("h", gen_header(args.functions // args.files)),
+                             ("c", gen_source(args.functions // args.files))):
+                files.append(os.path.join(tmpdir, f"file{n}.{ext}"))
+                with open(files[-1], "w") as f:
+                    f.write(txt.replace("func", f"func{n}_").replace("__wt_struct", f"__wt_struct{n}_"))
+        for multithread in [False, True]:
+            scanned: list[Codebase] = []
+            def scan() -> None:
+                scanned.append(Codebase())
+                scanned[-1].scanFiles(files, multithread=multithread, jobs=args.jobs)
+            t = _timeit(scan, args.repeat)
+            print(f"scan {len(files)} files, {'multi' if multithread else 'single'}-threaded: "
+                  f"{t * 1000:.1f} ms")
+            for stats in scanned[-1].worker_stats:
+                print(stats.report())
+
+def bench_scan_cache(args) -> None:
+    """Rescan with per-file results in the parse cache: cold, warm, after editing one file."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        workspace.rootPath, cache.use_cache = tmpdir, True
+        files = [os.path.join(tmpdir, "wt_stat.h")]
+        with open(files[0], "w") as f:
+            f.write(WT_STAT_MACROS)
+        for n in range(args.files):
+            files.append(os.path.join(tmpdir, f"file{n}.c"))
+            with open(files[-1], "w") as f:
+                f.write(gen_source(args.functions // args.files).replace("func", f"func{n}_"))
+        def scan() -> None:
+            Codebase().scanFiles(files, multithread=False, cache_files=True)
+        t_cold = _timeit(scan, 1)
+        t_warm = _timeit(scan, args.repeat)
+        with open(files[-1], "a") as f:
+            f.write("int\nedited(WT_SESSION_IMPL *session)\n{\n    WT_RET(edited_call(session));\n}\n")
+        t_edit = _timeit(scan, 1)
+        workspace.rootPath = ""
+    print(f"scan cache: {len(files)} files, cold: {t_cold * 1000:.1f} ms, "
+          f"warm: {t_warm * 1000:.1f} ms, one file edited: {t_edit * 1000:.1f} ms")
+
+def bench_update_files(args) -> None:
+    """Update after editing one source file and one macro header vs scanning all files again."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        files = [os.path.join(tmpdir, "wt_stat.h")]
+        with open(files[0], "w") as f:
+            f.write(WT_STAT_MACROS)
+        for n in range(args.files):
+            files.append(os.path.join(tmpdir, f"file{n}.c"))
+            with open(files[-1], "w") as f:
+                f.write(gen_source(args.functions // args.files).replace("func", f"func{n}_"))
+        _globals = Codebase()
+        t_full = _timeit(lambda: _globals.scanFiles(files, multithread=False), 1)
+        with open(files[-1], "a") as f:
+            f.write("int\nedited(WT_SESSION_IMPL *session)\n{\n    WT_RET(edited_call(session));\n}\n")
+        t_file = _timeit(lambda: _globals.updateFiles(changed=[files[-1]]), 1)
+        with open(files[0], "a") as f:
+            f.write("#define WT_EDITED(x) (x)\n")
+        rescanned: list[str] = []
+        t_macro = _timeit(lambda: rescanned.extend(_globals.updateFiles(changed=[files[0]])), 1)
+    print(f"update files: {len(files)} files, full scan: {t_full * 1000:.1f} ms, "
+          f"one file edited: {t_file * 1000:.1f} ms, new macro: {t_macro * 1000:.1f} ms "
+          f"({len(rescanned)} files rescanned)")
+
+def bench_source_map(args) -> None:
+    """Offset lookups in the source map of an expanded file: one by one and in bulk."""
+    txt = gen_source(args.functions)
+    expander = MacroExpander()
+    expanded = expander.expand(txt, _codebase().macro_table())
+    smap = SourceMap(expander.insert_list)
+    offsets = list(range(0, len(expanded), 7))
+    t_one = _timeit(lambda: [smap.to_orig(offset) for offset in offsets], args.repeat)
+    t_many = _timeit(lambda: smap.to_orig_many(offsets), args.repeat)
+    lists_size = sum(sys.getsizeof(lst) + sum(sys.getsizeof(x) for x in lst)
+                     for lst in ([ins.range_new[0] for ins in expander.insert_list],
+                                 [ins.delta for ins in expander.insert_list]))
+    print(f"source map: {len(smap)} expansions, {len(smap.tobytes())} bytes "
+          f"(offset/delta lists: {lists_size} bytes), {len(offsets)} lookups: "
+          f"{t_one * 1000:.1f} ms one by one, {t_many * 1000:.1f} ms in bulk")
+
+def _deep_size(obj, seen: set[int] | None = None) -> int:
+    """Approximate memory size of an object and everything it refers to"""
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_deep_size(k, seen) + _deep_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(_deep_size(x, seen) for x in obj)
+    elif hasattr(obj, "__dict__"):
+        size += _deep_size(obj.__dict__, seen)
+    else:
+        size += sum(_deep_size(getattr(obj, name), seen)
+                    for cls in type(obj).__mro__ for name in getattr(cls, "__slots__", ())
+                    if hasattr(obj, name))
+    return size
+
+def bench_memory(args) -> None:
+    """Memory held by a scanned codebase and the events of an access check run."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        files = [os.path.join(tmpdir, "wt_stat.h")]
+        with open(files[0], "w") as f:
+            f.write(WT_STAT_MACROS)
+        for n in range(args.files):
+            for ext, txt in (("h", gen_header(args.functions // args.files)),
+                             ("c", gen_source(args.functions // args.files))):
+                files.append(os.path.join(tmpdir, f"file{n}.{ext}"))
+                with open(files[-1], "w") as f:
+                    f.write(txt.replace("func", f"func{n}_").replace("__wt_struct", f"__wt_struct{n}_"))
+        tracemalloc.start()
+        _globals = Codebase()
+        _globals.scanFiles(files, multithread=False)
+        filetext.clear()
+        scanned = tracemalloc.get_traced_memory()[0]
+        events: list = []
+        AccessCheck(_globals).scan(False, on_macro_expand=events.append,
+                                   on_global_name=events.append, on_field_access=events.append)
+        filetext.clear()
+        checked = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+    classes = (Token, Definition, Variable, FunctionParts, RecordParts, MacroParts, Scope,
+               InsertPoint, Expansions)
+    counts = {cls.__name__: 0 for cls in classes}
+    for obj in gc.get_objects():
+        if isinstance(obj, classes):
+            counts[next(cls for cls in classes if isinstance(obj, cls)).__name__] += 1
+    print(f"memory: {len(files)} files, codebase: {scanned / 1024 / 1024:.1f} MiB, "
+          f"with {len(events)} access events: {checked / 1024 / 1024:.1f} MiB")
+    print("  " + ", ".join(f"{name}: {count}" for name, count in counts.items() if count))
+
+def _write_tree(tmpdir: str, args) -> list[str]:
+    """The statistics macros and args.files pairs of headers and sources"""
+    files = [os.path.join(tmpdir, "wt_stat.h")]
+    with open(files[0], "w") as f:
+        f.write(WT_STAT_MACROS)
+    for n in range(args.files):
+        for ext, txt in (("h", gen_header(args.functions // args.files)),
+                         ("c", gen_source(args.functions // args.files))):
+            files.append(os.path.join(tmpdir, f"file{n}.{ext}"))
+            with open(files[-1], "w") as f:
+                f.write(txt.replace("func", f"func{n}_").replace("__wt_struct", f"__wt_struct{n}_"))
+    return files
+
+def bench_store(args) -> None:
+    """SQLite store vs a pickle of the codebase: writing, reading all, one lookup in a view."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        files = _write_tree(tmpdir, args)
+        _globals = Codebase()
+        _globals.scanFiles(files, multithread=False)
+        data: list[bytes] = []
+        t_dump = _timeit(lambda: data.append(pickle.dumps(_globals)), 1)
+        t_loads = _timeit(lambda: pickle.loads(data[-1]), args.repeat)
+        db = os.path.join(tmpdir, "codebase.db")
+        with CodebaseStore(db) as store:
+            t_save = _timeit(lambda: store.save_codebase(_globals), 1)
+            t_load = _timeit(store.load, args.repeat)
+        name = next(reversed(_globals.names))
+        def lookup() -> None:
+            with CodebaseStore(db) as store:
+                store.codebase().names[name]
+        t_lookup = _timeit(lookup, args.repeat)
+        with CodebaseStore(db) as store:
+            t_query = _timeit(lambda: list(store.find(defn_kind="function", is_private=False)),
+                              args.repeat)
+        db_size = os.path.getsize(db)
+    print(f"store: {len(files)} files, pickle: {len(data[-1])} bytes, dump {t_dump * 1000:.1f} ms, "
+          f"load {t_loads * 1000:.1f} ms; sqlite: {db_size} bytes, save {t_save * 1000:.1f} ms, "
+          f"load {t_load * 1000:.1f} ms, open and look up one name {t_lookup * 1000:.1f} ms, "
+          f"public functions {t_query * 1000:.1f} ms")
+
+def bench_snapshot(args) -> None:
+    """Snapshot vs a pickle of the codebase: loading, listing the names, reading all details."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        files = _write_tree(tmpdir, args)
+        _globals = Codebase()
+        _globals.scanFiles(files, multithread=False)
+        data = pickle.dumps(_globals)
+        path = os.path.join(tmpdir, "codebase.snap")
+        t_save = _timeit(lambda: Snapshot.save(_globals, path), 1)
+        t_loads = _timeit(lambda: pickle.loads(data), args.repeat)
+        t_load = _timeit(lambda: Snapshot.load(path), args.repeat)
+        def list_names() -> None:
+            for defn in Snapshot.load(path).names.values():  # type: ignore[union-attr]
+                defn.locationStr()
+        t_list = _timeit(list_names, args.repeat)
+        def read_all() -> None:
+            for defn in Snapshot.load(path).names.values():  # type: ignore[union-attr]
+                defn.details
+        t_all = _timeit(read_all, args.repeat)
+        size = os.path.getsize(path)
+    print(f"snapshot: {len(files)} files, pickle: {len(data)} bytes, load {t_loads * 1000:.1f} ms; "
+          f"snapshot: {size} bytes, save {t_save * 1000:.1f} ms, load {t_load * 1000:.1f} ms, "
+          f"list names {t_list * 1000:.1f} ms, load and read all details {t_all * 1000:.1f} ms")
+
+def bench_field_types(args) -> None:
+    """Field type lookups: computed on each call vs. the tables built by finalize()."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        files = _write_tree(tmpdir, args)
+        _globals = Codebase()
+        _globals.scanFiles(files, multithread=False)
+        t_finalize = _timeit(lambda: (setattr(_globals, "field_types", None), _globals.finalize()),
+                             args.repeat)
+        pairs = [(rec_name, field_name) for rec_name, fields in _globals.fields.items()
+                 for field_name in fields] * 10
+        def lookup() -> None:
+            for rec_name, field_name in pairs:
+                _globals.get_field_type(rec_name, field_name)
+        t_table = _timeit(lookup, args.repeat)
+        field_types, _globals.field_types = _globals.field_types, None
+        t_live = _timeit(lookup, args.repeat)
+        _globals.field_types = field_types
+    print(f"field types: {len(pairs)} lookups, computed {t_live * 1000:.1f} ms, "
+          f"table {t_table * 1000:.1f} ms, building the table {t_finalize * 1000:.1f} ms")
+
+def bench_expansion_log(args) -> None:
+    """Memory of the per-file expansion records: Expansions objects vs. the packed log."""
+    txt = gen_source(args.functions)
+    expander = MacroExpander()
+    expander.expand(txt, _codebase().macro_table())
+    log, objs = expander.expansion_log, expander.expand_list
+    t = _timeit(lambda: list(log), args.repeat)
+    print(f"expansion log: {len(log)} expansions, "
+          f"{_deep_size(objs)} bytes in memory, {len(pickle.dumps(objs))} pickled as objects; "
+          f"{_deep_size(log)} bytes in memory, {len(pickle.dumps(log))} pickled as a log; "
+          f"all views: {t * 1000:.1f} ms")
+
+def bench_macro_stats(args) -> None:
+    """Expansion with and without per-macro profiling."""
+    txt = gen_source(args.functions)
+    table = _codebase().macro_table()
+    table.cache.maxsize = 0
+    for stats in [None, MacroStats()]:
+        table.stats = stats
+        t = _timeit(lambda: MacroExpander().expand(txt, table), args.repeat)
+        print(f"expand {'with' if stats is not None else 'without'} profiling: {t * 1000:.1f} ms")
+    print(cast(MacroStats, table.stats).report(5))
+
+def bench_statements(args) -> None:
+    """Expansion of a header and a source: top-level statements with no macro names are skipped."""
+    txt = gen_header(args.functions) + gen_source(args.functions)
+    table = _codebase().macro_table()
+    statements = list(top_statements(txt))
+    skipped = sum(table.names.isdisjoint(regex.findall(r"\w+", txt[start:end]))
+                  for start, end in statements)
+    t = _timeit(lambda: MacroExpander().expand(txt, table), args.repeat)
+    print(f"statements: {len(txt)} bytes, {skipped} of {len(statements)} "
+          f"top-level statements without macros: {t * 1000:.1f} ms")
+
+def bench_tokens(args) -> None:
+    """Expanded tokens: tokenizing the expanded text vs. expanding token by token."""
+    txt = gen_header(args.functions) + gen_source(args.functions)
+    table = _codebase().macro_table()
+    t_text = _timeit(lambda: TokenList.fromText(MacroExpander().expand(txt, table), 0), args.repeat)
+    t_tokens = _timeit(lambda: MacroExpander().expand_tokens(txt, table), args.repeat)
+    print(f"tokens: {len(txt)} bytes, expand + tokenize: {t_text * 1000:.1f} ms, "
+          f"expand_tokens: {t_tokens * 1000:.1f} ms")
+
+BENCHMARKS = {
+    "expand": bench_expand,
+    "policies": bench_policies,
+    "local_macros": bench_local_macros,
+    "scan": bench_scan,
+    "scan_cache": bench_scan_cache,
+    "update_files": bench_update_files,
+    "source_map": bench_source_map,
+    "memory": bench_memory,
+    "store": bench_store,
+    "snapshot": bench_snapshot,
+    "field_types": bench_field_types,
+    "expansion_log": bench_expansion_log,
+    "macro_stats": bench_macro_stats,
+    "statements": bench_statements,
+    "tokens": bench_tokens,
+}
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description="Benchmarks of layercparse internals")
+    argparser.add_argument("benchmarks", nargs="*", choices=[[]] + list(BENCHMARKS.keys()),
+                           help="Benchmarks to run. Default: all")
+    argparser.add_argument("-n", "--functions", type=int, default=300,
+                           help="Number of functions in the generated source")
+    argparser.add_argument("-f", "--files", type=int, default=20,
+                           help="Number of generated files for the scan benchmarks")
+    argparser.add_argument("-j", "--jobs", type=int,
+                           help="Number of worker processes. Default: all available CPUs")
+    argparser.add_argument("-r", "--repeat", type=int, default=3,
+                           help="Number of runs, the best time is reported")
+    args = argparser.parse_args()
+    setLogLevel(LogLevel.QUIET)
+    for name in args.benchmarks or BENCHMARKS.keys():
+        BENCHMARKS[name](args)
@@ -1,3 +1,5 @@
+# Defined first: modules use it to version what they write
+LAYERCPARSE_VERSION = "0.4.3"
 
 from .common import *
 from .workspace import *
@@ -14,5 +16,9 @@ from .codebase import *
 from .access import *
 from .macro import *
 from .macroexpand import *
-
-LAYERCPARSE_VERSION = "0.4.3"
+from .filetext import BodyRef
+from .memo import FunctionMemo
+from .parallel import WorkerStats, available_cpus, resolve_jobs
+from .scancache import ScanCache
+from .store import CodebaseStore, StoredDefinitions, AccessRow, access_rows
+from .snapshot import Snapshot, LazyDefinition
@@ -1,5 +1,4 @@
 import regex
-import multiprocessing, signal
 import itertools
 from dataclasses import dataclass, field
 from typing import Iterable, Any
@@ -10,6 +9,8 @@ from .record import *
 from .function import *
 from .codebase import *
 from .workspace import *
+from .memo import FunctionMemo, MemoKey, tables_version
+from .parallel import WorkerStats, run_tasks
 
 _reg_member_access_chain = regex.compile(r"""
     (?>
@@ -166,9 +167,39 @@ def _yield_if_not_none(val: Any) -> Iterable[Any]:
 class AccessCheck:
     _globals: Codebase
     _perModuleInvisibleNamesRe: dict[str, regex.Pattern | None] = field(default_factory=dict)
+    memo: FunctionMemo = field(default_factory=FunctionMemo)
+    # Utilisation of the worker processes of the last scan
+    worker_stats: WorkerStats | None = field(default=None, repr=False, compare=False)
+    _names_version: str = ""
 
     def __post_init__(self) -> None:
         self._globals.finalize()
+        self._names_version = tables_version(
+            ((name, defn.module) for name, defn in self._globals.names.items()),
+            ((name, defn.module) for name, defn in self._globals.names_restricted.items()))
+
+    def _get_symbols(self, func: FunctionParts) -> SymbolTable:
+        body = cast(Token, func.body)
+        # The offsets of the arguments are relative to the body, so the text between them counts
+        return self.memo.get(
+            "symbols", f"{body.range[0] - func.args.range[0]}\0{func.args.value}\0{body.value}",
+            lambda: func.getSymbolTable(self._globals.alltypes, self._get_clean_body(body.value)),
+            version=self._globals.types_version)
+
+    def _get_clean_body(self, body: str) -> str:
+        return self.memo.get("clean", body, lambda: clean_text_more_sz(body))
+
+    def _get_global_names(self, module: str, body: str, body_clean: str,
+                          optimize_for_errors: bool) -> list[tuple[Range, str]]:
+        names_re = (self._get_invisible_global_names_for_module(module) if optimize_for_errors else
+                    self._get_all_global_names_for_module())
+        if not names_re:
+            return []
+        return self.memo.get(
+            "invisible_names" if optimize_for_errors else "global_names", body,
+            lambda: [((match.start(), match.end()), match[0])
+                     for match in names_re.finditer(body_clean)],  # type: ignore[union-attr] # names_re is not None
+            version=self._names_version + (module if optimize_for_errors else ""))
 
     def _get_invisible_global_names_for_module(self, module: str) -> regex.Pattern | None:
         if module not in self._perModuleInvisibleNamesRe:
@@ -195,20 +226,21 @@ class AccessCheck:
     def __check_macro_expansions_access(self, defn: Definition,
                                         on_macro_expand: Callable[[AccessMacroExpand], Any] | None = None) -> Iterable[Any]:
         module = defn.module
+        macros = self._globals.macros_for_file(defn.scope.file.name)
         for exps in defn.scope.file.expansions(
                 cast(Token, cast(FunctionParts, defn.details).body).range):
             if on_macro_expand:
                 yield from _yield_if_not_none(on_macro_expand(AccessMacroExpand(defn, exps)))
             r, explist = exps.at.range_new, exps.expansions
             for callerMacro in sorted(explist.keys()):
-                if callerMacro and callerMacro in self._globals.macros:
-                    callerDef = self._globals.macros[callerMacro]
+                if callerMacro and callerMacro in macros:
+                    callerDef = macros[callerMacro]
                     callerMod = callerDef.module
                 else:
                     callerMod = module
                 for calleeMacro in explist[callerMacro]:
-                    if (calleeMacro in self._globals.macros and
-                            (calleeDef := self._globals.macros[calleeMacro]) and
+                    if (calleeMacro in macros and
+                            (calleeDef := macros[calleeMacro]) and
                             calleeDef.is_private and
                             (calleeMod := calleeDef.module) and
                             calleeMod != callerMod):
@@ -221,8 +253,8 @@ class AccessCheck:
                             else:
                                 rootName = list(explist[''])[0]
                                 rootName = f"macro " + _funcId(
-                                    (self._globals.macros[rootName].module
-                                        if rootName in self._globals.macros
+                                    (macros[rootName].module
+                                        if rootName in macros
                                         else ""),
                                     rootName, colon="")
                             Log.access_macro(defn.scope.file.locationStr(r[0]), _funcId(module, defn.name),
@@ -252,7 +284,8 @@ class AccessCheck:
                 not isinstance(defn.details, FunctionParts) or \
                 not defn.details.body:
             return
-        body_clean = clean_text_more_sz(defn.details.body.value)
+        body = defn.details.body.value
+        body_clean = self._get_clean_body(body)
 
         def _locationStr(offset: int) -> str:
             return (defn.scope.locationStr(defn.details.body.range[0] + offset) + # type: ignore[union-attr]
@@ -269,35 +302,23 @@ class AccessCheck:
         yield from self.__check_macro_expansions_access(defn, on_macro_expand=on_macro_expand)
 
         # Check local names
-        localvars: dict[str, Definition] = {} # name -> type
-        with ScopePush(file=defn.scope.file, offset=0):
-            for var in itertools.chain(defn.details.xGetArgs(),
-                                       #defn.details.getLocalVars(self._globals),
-                                       defn.details.xGetFunctionLocalVarsOfTypes(self._globals.alltypes, body_clean),
-                                       ):
-                if var.typename:
-                    localvars[var.name.value] = Definition(
-                        name=var.name.value,
-                        kind="variable",
-                        scope=defn.scope,
-                        offset=var.name.range[0],
-                        module="",
-                        is_private=False,
-                        details=var)
-                else:
-                    Log.parse_localvar(_LOC(var.name.range[0]),
-                            f"Missing type for local variable '{var.name.value}'")
-
-        if localvars:
-            DEBUG4(_LOC(0), f"locals vars:\n{pformat(localvars, width=120, compact=False)}") or \
+        func = defn.details
+        symbols = self._get_symbols(func)
+        for var in symbols:
+            if not var.typename:
+                Log.parse_localvar(_LOC(var.offset),
+                        f"Missing type for local variable '{var.name}'")
+
+        if symbols:
+            DEBUG4(_LOC(0), f"locals vars:\n{pformat(symbols.symbols, width=120, compact=False)}") or \
             DEBUG2(_LOC(0), f"locals vars:\n" + "\n".join(
-                       f"    {name}: {cast(Details, d.details).typename.short_repr()}"
-                       for name, d in localvars.items()))
+                       f"    {var.name}: {var.typename}"
+                       for var in symbols if var.typename))
 
-        def _get_type_of_name(name: str) -> str:
-            # Consider scopes in order: local, static, global
-            if name in localvars:
-                details = localvars[name].details
+        def _get_type_of_name(name: str, offset: int) -> str:
+            # Consider scopes in order: innermost local block, static, global
+            if (var := symbols.lookup(name, offset)) and var.typename:
+                return self._globals.untypedef(var.basetype) if var.basetype else ""
             elif filename in self._globals.static_names and \
                      name in self._globals.static_names[filename]:
                 details = self._globals.static_names[filename][name].details
@@ -338,7 +359,7 @@ class AccessCheck:
                     token_type = _get_type_of_expr_str(
                             token.value[1:-1], root_offset + token.range[0] + 1)  # expression
             elif reg_word_char.match(token.value):
-                token_type = _get_type_of_name(token.value)
+                token_type = _get_type_of_name(token.value, root_offset + token.range[0])
             else: # Something weird
                 Log.parse_expression(_LOC(root_offset + token.range[0]),
                         f"Unexpected token in expression: {token.value}")
@@ -388,26 +409,22 @@ class AccessCheck:
                     self._globals.fields[rec_type][field], offset, prefix=f"{rec_type}.")
 
         if optimize_for_errors:
-            if invisible_names := self._get_invisible_global_names_for_module(module):
-                for match in invisible_names.finditer(body_clean):
-                    name = match[0]
-                    Log.access_global(_locationStr(match.start()),
-                        f"Invalid access to private name [{self._globals.names_restricted[name].module}] '{name}' ")
-                    if on_global_name:
-                        yield from _yield_if_not_none(on_global_name(AccessGlobalName(defn, (match.start(), match.end()), name)))
+            for name_range, name in self._get_global_names(module, body, body_clean, True):
+                Log.access_global(_locationStr(name_range[0]),
+                    f"Invalid access to private name [{self._globals.names_restricted[name].module}] '{name}' ")
+                if on_global_name:
+                    yield from _yield_if_not_none(on_global_name(AccessGlobalName(defn, name_range, name)))
         else:
-            if global_names := self._get_all_global_names_for_module():
-                for match in global_names.finditer(body_clean):
-                    name = match[0]
-                    dst_module = self._globals.names[name].module
-                    DEBUG3(_LOC(match.start()), f"Function call: [{dst_module}] '{name}'")
-                    if dst_module and dst_module != module:
-                        Log.access_global(_locationStr(match.start()),
-                            f"Invalid access to private name [{dst_module}] '{name}'")
-                    if on_global_name:
-                        yield from _yield_if_not_none(on_global_name(AccessGlobalName(defn, (match.start(), match.end()), name)))
-
-        for chain in member_access_chains_fast(body_clean):
+            for name_range, name in self._get_global_names(module, body, body_clean, False):
+                dst_module = self._globals.names[name].module
+                DEBUG3(_LOC(name_range[0]), f"Function call: [{dst_module}] '{name}'")
+                if dst_module and dst_module != module:
+                    Log.access_global(_locationStr(name_range[0]),
+                        f"Invalid access to private name [{dst_module}] '{name}'")
+                if on_global_name:
+                    yield from _yield_if_not_none(on_global_name(AccessGlobalName(defn, name_range, name)))
+
+        for chain in self.memo.get("chains", body, lambda: list(member_access_chains_fast(body_clean))):
             DEBUG2(_LOC(chain.range[0]), f"Access chain: {chain}")
             if on_field_chain:
                 yield from _yield_if_not_none(on_field_chain(AccessFieldChain(defn, chain)))
@@ -429,19 +446,24 @@ class AccessCheck:
                 Log.type_deduce_expr(_locationStr(chain.range[0]), f"Can't deduce type of expression {chain}")
 
     # Go through function bodies. Check calls and struct member accesses.
-    def checkAccess(self, multithread = True) -> None:
-        self.scan(multithread, optimize_for_errors=True)
+    def checkAccess(self, multithread = True, jobs: int | None = None) -> None:
+        self.scan(multithread, optimize_for_errors=True, jobs=jobs)
 
     # Go through function bodies. Check calls and struct member accesses.
-    def scan(self, multithread = True, *args, **kwargs) -> None:
-        for _ in self.xscan(multithread, *args, **kwargs):
+    def scan(self, multithread = True, *args, jobs: int | None = None, **kwargs) -> None:
+        for _ in self.xscan(multithread, *args, jobs=jobs, **kwargs):
             pass
 
     # Go through function bodies. Check calls and struct member accesses.
     def xscan(self,
               multithread = True,
               want_scan: Callable[[Definition], bool] | None = None,
-              *args, **kwargs) -> Iterable[Any]:
+              *args, jobs: int | None = None, ordered = True, **kwargs) -> Iterable[Any]:
+        """jobs is the number of worker processes, see resolve_jobs(). The functions with the
+           largest bodies are checked first. The utilisation of the workers is collected in
+           worker_stats.
+           With ordered=False, the results and the log of the workers come as the functions are
+           checked and not in the order of the functions, which holds fewer of them in memory."""
         if not multithread:
             for defn in itertools.chain(
                         self._globals.names.values(),
@@ -449,25 +471,28 @@ class AccessCheck:
                 if not want_scan or want_scan(defn):
                     yield from self.scan_function(defn, *args, **kwargs)
         else:
-            init_multithreading()
-            with multiprocessing.Pool(processes=multiprocessing.cpu_count(),
-                                      initializer=signal.signal,
-                                      initargs=(signal.SIGINT, signal.SIG_IGN)) as pool:
-                for res in pool.starmap(
-                        AccessCheck._check_function_name_for_multiproc,
-                        itertools.chain(
-                            ((self, n, True,  want_scan, args, kwargs) for n in self._globals.static_names.keys()),
-                            ((self, n, False, want_scan, args, kwargs) for n in self._globals.names.keys()))):
-                    print(res[0], end='')
-                    yield from res[1]
+            # Worker processes are forked and inherit this object, so it's not pickled per task
+            global _multiproc_check
+            _multiproc_check = self
+            tasks = [*((n, True,  want_scan, args, kwargs) for n in self._globals.static_names.keys()),
+                     *((n, False, want_scan, args, kwargs) for n in self._globals.names.keys())]
+            costs = [*(sum(map(_body_len, defns.values())) for defns in self._globals.static_names.values()),
+                     *map(_body_len, self._globals.names.values())]
+            self.worker_stats = WorkerStats("access")
+            for res in run_tasks(AccessCheck._check_function_name_for_multiproc, tasks, costs,
+                                 jobs=jobs, stats=self.worker_stats, ordered=ordered):
+                print(res[0], end='')
+                self.memo.update(res[2])
+                yield from res[1]
+            _multiproc_check = None
 
     @staticmethod
-    def _check_function_name_for_multiproc(self: 'AccessCheck',
-                                           name: str,
+    def _check_function_name_for_multiproc(name: str,
                                            file: bool,
                                            want_scan: Callable[[Definition], bool] | None = None,
                                            args: list[Any] = [],
-                                           kwargs = dict[Any, Any]) -> tuple[str, list[Any]]:
+                                           kwargs = dict[Any, Any]) -> tuple[str, list[Any], dict[MemoKey, Any]]:
+        self = cast(AccessCheck, _multiproc_check)
         ret: list[Any] = []
         with LogToStringScope():
             if not file:
@@ -480,4 +505,12 @@ class AccessCheck:
                         for res in self.scan_function(defn, *args, **kwargs):
                             ret.append(res)
             return (workspace.logStream.getvalue(), # type: ignore # logStream is a StringIO
-                    ret)
+                    ret,
+                    self.memo.take_new())
+
+def _body_len(defn: Definition) -> int:
+    """Length of the function body as the estimated cost of checking it"""
+    body = getattr(defn.details, "body", None)
+    return body.range[1] - body.range[0] if body is not None else 0
+
+_multiproc_check: AccessCheck | None = None
@@ -58,27 +58,35 @@ def is_cached(srcpath: str,
         return False
 
 # Returns the object from the cache if it exists and is up to date
+# load reads the cache file instead of pickle and returns None if it's invalid
 def get(srcpath: str,
         dependencies: list[str] | None = None,
         suffix: str = "",
-        cachepath: str = "") -> object | None:
+        cachepath: str = "",
+        load: Callable[[str], object | None] | None = None) -> object | None:
     if not cachepath:
         cachepath = getcachepath(srcpath, suffix)
     if not is_cached(srcpath, dependencies, suffix=suffix, cachepath=cachepath):
         return None
+    if load is not None:
+        return load(cachepath)
     try:
         with open(cachepath, "rb") as f:
             return pickle.load(f)
     except (FileNotFoundError, pickle.UnpicklingError):
         return None
 
-# Pickles the object to the cache
-def put(obj: object, srcpath: str, suffix: str = "", cachepath: str = "") -> object:
+# Pickles the object to the cache, or writes it with dump
+def put(obj: object, srcpath: str, suffix: str = "", cachepath: str = "",
+        dump: Callable[[object, str], None] | None = None) -> object:
     if not cachepath:
         cachepath = getcachepath(srcpath, suffix)
     if not cachepath:
         return obj
     os.makedirs(os.path.dirname(cachepath), exist_ok=True)
+    if dump is not None:
+        dump(obj, cachepath)
+        return obj
     with open(cachepath, "wb") as f:
         pickle.dump(obj, f)
     return obj
@@ -86,7 +94,9 @@ def put(obj: object, srcpath: str, suffix: str = "", cachepath: str = "") -> obj
 # Decorator that wraps a function or instance method with caching
 def cached(file: Callable[..., str] | str = "",
            deps: Callable[..., list[str] | None] | list[str] | None = None,
-           suffix: Callable[..., str] | str = ""):
+           suffix: Callable[..., str] | str = "",
+           load: Callable[[str], object | None] | None = None,
+           dump: Callable[[object, str], None] | None = None):
     if not file:
         raise ValueError("file is required")
     fileFn   = file   if callable(file  ) else lambda *args, **kwargs: file
@@ -99,9 +109,9 @@ def cached(file: Callable[..., str] | str = "",
             key_    = fileFn  (*args, **kwargs)
             deps_   = depsFn  (*args, **kwargs)
             suffix_ = suffixFn(*args, **kwargs)
-            if (obj := get(key_, dependencies=deps_, suffix=suffix_)) is not None:
+            if (obj := get(key_, dependencies=deps_, suffix=suffix_, load=load)) is not None:
                 return obj
-            return put(func(*args, **kwargs), key_, suffix=suffix_)
+            return put(func(*args, **kwargs), key_, suffix=suffix_, dump=dump)
         return wrapper
     return decorator
 
@@ -1,7 +1,8 @@
 import regex
-import multiprocessing, signal
+import os, copy
 from dataclasses import dataclass, field
-from typing import Iterable, Any
+from typing import Iterable, Any, Mapping
+from collections import ChainMap
 
 from .internal import *
 from .common import *
@@ -9,11 +10,15 @@ from .record import *
 from .function import *
 from .macro import *
 from .macroexpand import *
-from . import workspace
+from .filetext import BodyRef
+from .memo import tables_version
+from .parallel import WorkerStats, run_tasks
+from .scancache import ScanCache, MacroFingerprints
+from . import workspace, filetext
 
 Details: TypeAlias = FunctionParts | RecordParts | Variable | MacroParts
 
-@dataclass
+@dataclass(slots=True)
 class Definition:
     name: str
     kind: str
@@ -24,6 +29,8 @@ class Definition:
     details: Details | None = None
     preComments: list[Token] = field(default_factory=list)
     postComments: list[Token] = field(default_factory=list)
+    # Made by merging definitions, see _dict_upsert_def()
+    merged: bool = field(default=False, repr=False, compare=False)
 
     def short_repr(self) -> str:
         return (
@@ -82,9 +89,20 @@ class Definition:
         self.postComments += other.postComments
 
 
+def _merged_copy(defn: Definition) -> Definition:
+    """Copy of the definition that can be updated without changing the original"""
+    ret = copy.copy(defn)
+    ret.details = copy.copy(defn.details)
+    ret.preComments, ret.postComments = list(defn.preComments), list(defn.postComments)
+    ret.merged = True
+    return ret
+
 def _dict_upsert_def(d: dict[str, Definition], other: Definition) -> None:
     if other.name in d:
-        d[other.name].update(other)
+        # Merge into a copy, the definitions as they came from the files are kept in provenance
+        if not d[other.name].merged:
+            d[other.name] = _merged_copy(d[other.name])
+        d[other.name].update(_merged_copy(other))
     else:
         d[other.name] = other
 
@@ -147,6 +165,8 @@ class Codebase:
     types_restricted: dict[str, Definition] = field(default_factory=dict)
     # record_name -> {field_name -> GlobalDefn}
     fields: dict[str, dict[str, Definition]] = field(default_factory=dict)
+    # field_name -> {record_name}, reverse index of fields
+    field_records: dict[str, set[str]] = field(default_factory=dict, repr=False)
     # Functions, variables, other identifiers
     names: dict[str, Definition] = field(default_factory=dict)
     names_restricted: dict[str, Definition] = field(default_factory=dict)
@@ -156,9 +176,34 @@ class Codebase:
     typedefs: dict[str, str] = field(default_factory=dict)
     typedefs_merged: bool = field(default=False, repr=False)
     alltypes: frozenset[str] = field(default_factory=frozenset, repr=False)
+    types_version: str = field(default="", repr=False)
+    # Built by finalize() and dropped when types, typedefs or fields change:
+    # typedef -> the end of its chain, a type or a name that is not a typedef
+    resolved_typedefs: dict[str, str] | None = field(default=None, repr=False, compare=False)
+    # (record name, field name) -> the un-typedefed base type of the field or ""
+    field_types: dict[tuple[str, str], str] | None = field(default=None, repr=False, compare=False)
     # Macros
     macros: dict[str, Definition] = field(default_factory=dict)
+    # file -> {name -> GlobalDefn} for macros of .c files when they are not global, see scanFiles()
+    file_macros: dict[str, dict[str, Definition]] = field(default_factory=dict, repr=False)
     # macros_restricted: dict[str, Definition] = field(default_factory=dict)
+    # Prepared for expansion, built on demand. Not pickled.
+    _macro_table: MacroTable | None = field(default=None, repr=False, compare=False)
+    expand_policy: ExpandPolicy = field(default=None, repr=False, compare=False)
+    _macros_changed: set[str] = field(default_factory=set, repr=False, compare=False)
+    # Per-macro expansion profile, collected if set, see scanFiles()
+    macro_stats: MacroStats | None = field(default=None, repr=False, compare=False)
+    # file name -> the File that the definitions of the file refer to, one per scanned file
+    files: dict[str, File] = field(default_factory=dict, repr=False, compare=False)
+    # file -> what the file contributed, in the order of scanning; "" for addMacro(). Allows to
+    # retract the contributions of a file, see updateFiles().
+    provenance: dict[str, 'Definitions'] = field(default_factory=dict, repr=False, compare=False)
+    # (kind, key, name) of the contributions to merge later, see updateFiles()
+    _merge_later: set[tuple[str, str, str]] | None = field(default=None, repr=False, compare=False)
+    # Utilisation of the worker processes of the last scanFiles()
+    worker_stats: list[WorkerStats] = field(default_factory=list, repr=False, compare=False)
+    # Per-file results cache of the last scanFiles(), see its hits and misses
+    scan_cache: ScanCache | None = field(default=None, repr=False, compare=False)
 
     def __post_init__(self):
         if "__attribute__" not in self.macros:
@@ -172,19 +217,63 @@ class Codebase:
                 details=MacroParts(name=Token(0, (0, 0), "__attribute__"),
                                    args=[Token(0, (0, 0), "@")])
             )
+            self.provenance.setdefault("", []).append(("macro", "", self.macros["__attribute__"]))
+
+    def __getstate__(self) -> dict[str, Any]:
+        state = self.__dict__.copy()
+        state["_macro_table"], state["_macros_changed"], state["scan_cache"] = None, set(), None
+        if callable(self.expand_policy):
+            state["expand_policy"] = None  # a predicate may not be picklable
+        return state
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        for file in self.files.values():
+            file.expander = self._expand_file_text
+
+    def macro_table(self) -> MacroTable:
+        """The macros prepared for expansion. Rebuilt incrementally when macros are added."""
+        if (self._macro_table is None or self._macro_table.macros is not self.macros or
+                self._macro_table.policy != self.expand_policy):
+            self._macro_table = MacroTable(self.macros, policy=self.expand_policy,
+                                           stats=self.macro_stats)
+        elif self._macros_changed:
+            self._macro_table.update(self._macros_changed)
+        self._macros_changed = set()
+        self._macro_table.stats = self.macro_stats
+        return self._macro_table
+
+    def get_macro_users(self, name: str) -> set[str]:
+        """Macros which expansion uses the macro, directly or through other macros"""
+        return self.macro_table().graph.transitive_users(name)
+
+    def macros_for_file(self, fname: str) -> Mapping[str, Definition]:
+        """Macros visible in the file: the global ones and the file's own ones"""
+        return (ChainMap(self.file_macros[fname], self.macros) if fname in self.file_macros else
+                self.macros)
+
+    def _expand_file_text(self, file: File) -> str:
+        with LogToStringScope(), ScopePush(file=File(file.name)):
+            table = self.macro_table().overlay(self.file_macros.get(file.name, {}))
+            return MacroExpander().expand_tokens(scope_file().read(), table)[0]
 
     def finalize(self) -> None:
-        if self.typedefs_merged:
-            return
-        self.fill_typedefs()
-        self.alltypes = frozenset(name for name in self.types.keys()
-                                  if not name.startswith("("))
+        if not self.typedefs_merged:
+            self.fill_typedefs()
+            self.alltypes = frozenset(name for name in self.types.keys()
+                                      if not name.startswith("("))
+            self.types_version = tables_version(self.alltypes)
+        if self.field_types is None:
+            self.field_types = {(rec_name, field_name): self._field_type(defn)
+                                for rec_name, fields in self.fields.items()
+                                for field_name, defn in fields.items()}
 
     def addMacro(self, name: str,
                        args: int | tuple[str, ...] | None = None,
                        body: str | None = None,
                        **kwargs) -> None:
-        self.macros[name] = Definition(
+        self._macros_changed.add(name)
+        self.macros[name] = defn = Definition(
             name=name,
             kind="macro",
             scope=Scope.empty(),
@@ -197,10 +286,11 @@ class Codebase:
                                     None,
                                body=Token(0, (0, 0), body) if body is not None else None,
                                **kwargs))
+        self.provenance.setdefault("", []).append(("macro", "", defn))
 
     def untypedef(self, name: str) -> str:
         if self.typedefs_merged:
-            return self.types[name].name if name in self.types else name
+            return defn.name if (defn := self.types.get(name)) is not None else name
 
         seen: set[str] = set()
         while name not in self.types and name in self.typedefs and name not in seen:
@@ -208,16 +298,34 @@ class Codebase:
             name = self.typedefs[name]
         return name
 
+    def resolve_typedefs(self) -> dict[str, str]:
+        """Each typedef resolved to the end of its chain as untypedef() does, every chain is walked
+           once. Cycles are reported, names in a cycle resolve to themselves."""
+        ret: dict[str, str] = {}
+        for alias in self.typedefs:
+            path: dict[str, None] = {}
+            name = alias
+            while (name not in ret and name not in self.types and name in self.typedefs and
+                   name not in path):
+                path[name] = None
+                name = self.typedefs[name]
+            if name in path:
+                cycle = list(path)[list(path).index(name):]
+                Log.parse_typedef(None, f"typedef cycle: {' -> '.join([*cycle, name])}")
+                ret.update((n, n) for n in cycle)
+            end = ret.get(name, name)
+            for n in path:
+                ret.setdefault(n, end)
+        return ret
+
     def fill_typedefs(self) -> None:
         """Add typedef'd types to the types list."""
         if self.typedefs_merged:
             return
 
-        for typealias in self.typedefs.keys():
-            if typealias in self.types:
-                continue
-            typename = self.untypedef(typealias)
-            if typename not in self.types:
+        self.resolved_typedefs = self.resolve_typedefs()
+        for typealias, typename in self.resolved_typedefs.items():
+            if typealias in self.types or typename not in self.types:
                 continue
             typedef = self.types[typename]
             self.types[typealias] = typedef
@@ -228,14 +336,128 @@ class Codebase:
 
     # Get the un-typedefed type of a field or ""
     def get_field_type(self, rec_type: str, field_name: str) -> str:
-        if not rec_type in self.fields or \
-                field_name not in self.fields[rec_type] or \
-                not self.fields[rec_type][field_name] or \
-                not self.fields[rec_type][field_name].details or \
-                not cast(Details, self.fields[rec_type][field_name].details).typename:
+        if self.field_types is not None:
+            return self.field_types.get((rec_type, field_name), "")
+        if (fields := self.fields.get(rec_type)) is None or field_name not in fields:
+            return ""  # unknown type
+        return self._field_type(fields[field_name])
+
+    def _field_type(self, defn: Definition | None) -> str:
+        if not defn or not defn.details or not cast(Details, defn.details).typename:
             return ""  # unknown type
-        return self.untypedef(get_base_type(
-            cast(Details, self.fields[rec_type][field_name].details).typename))
+        return self.untypedef(get_base_type(cast(Details, defn.details).typename))
+
+    def _upsert_field(self, rec_name: str, defn: Definition) -> None:
+        if rec_name not in self.fields:
+            self.fields[rec_name] = {}
+        if defn.name not in self.fields[rec_name]:
+            if defn.name not in self.field_records:
+                self.field_records[defn.name] = set()
+            self.field_records[defn.name].add(rec_name)
+        _dict_upsert_def(self.fields[rec_name], defn)
+
+    def _contribute(self, kind: str, key: str, value: Definition | str) -> None:
+        """Merge a definition of the current file and record where it came from.
+           See Definitions for the kinds and keys."""
+        self.provenance.setdefault(scope_file().name, []).append((kind, key, value))
+        if self._merge_later is not None:
+            self._merge_later.add(_item_id((kind, key, value)))
+        else:
+            self._merge(kind, key, value)
+
+    def _merge(self, kind: str, key: str, value: Definition | str) -> None:
+        if kind in ("typedef", "type", "field"):
+            self.resolved_typedefs = self.field_types = None
+        if kind == "typedef":
+            self.typedefs[key] = cast(str, value)
+            return
+        defn = cast(Definition, value)
+        if kind == "field":
+            self._upsert_field(key, defn)
+        elif kind == "static":
+            _dict_upsert_def(self.static_names.setdefault(key, {}), defn)
+        elif kind == "macro":
+            _dict_upsert_def(self.macros, defn)
+            self._macros_changed.add(defn.name)
+        else:
+            dst, restricted = ((self.types, self.types_restricted) if kind == "type" else
+                               (self.names, self.names_restricted))
+            _dict_upsert_def(dst, defn)
+            if defn.is_private or defn.name in restricted:
+                restricted[defn.name] = dst[defn.name]
+
+    def _drop(self, kind: str, key: str, name: str) -> None:
+        """Remove a merged definition"""
+        if kind in ("typedef", "type", "field"):
+            self.resolved_typedefs = self.field_types = None
+        if kind == "typedef":
+            self.typedefs.pop(key, None)
+        elif kind == "field":
+            if self.fields.get(key, {}).pop(name, None) is not None:
+                self.field_records[name].discard(key)
+                if not self.field_records[name]:
+                    del self.field_records[name]
+                if not self.fields[key]:
+                    del self.fields[key]
+        elif kind == "static":
+            if self.static_names.get(key, {}).pop(name, None) is not None and not self.static_names[key]:
+                del self.static_names[key]
+        elif kind == "macro":
+            self.macros.pop(name, None)
+            self._macros_changed.add(name)
+        else:
+            dst, restricted = ((self.types, self.types_restricted) if kind == "type" else
+                               (self.names, self.names_restricted))
+            dst.pop(name, None)
+            restricted.pop(name, None)
+
+    def _retract(self, files: Iterable[str], macros: bool) -> set[tuple[str, str, str]]:
+        """Remove the macros or the other definitions of the files from provenance. Returns the
+           affected (kind, key, name) to merge again, see _remerge()."""
+        affected: set[tuple[str, str, str]] = set()
+        for fname in files:
+            keep: Definitions = []
+            for item in self.provenance.get(fname, []):
+                if (item[0] == "macro") == macros:
+                    affected.add(_item_id(item))
+                else:
+                    keep.append(item)
+            if fname in self.provenance:
+                self.provenance[fname] = keep
+        return affected
+
+    def _remerge(self, ids: set[tuple[str, str, str]]) -> None:
+        """Merge the definitions with the (kind, key, name) again from all files in the order of
+           files, as a full scan does. All fields of a record are merged again, so that they keep
+           their order."""
+        records = {key for kind, key, _ in ids if kind == "field"}
+        for item_id in ids:
+            if item_id[0] != "field":
+                self._drop(*item_id)
+        for rec_name in records:
+            for name in self.fields.get(rec_name, {}):
+                self.field_records[name].discard(rec_name)
+                if not self.field_records[name]:
+                    del self.field_records[name]
+            self.fields.setdefault(rec_name, {}).clear()  # keeps the place of the record
+        if records:
+            self.resolved_typedefs = self.field_types = None
+        for items in self.provenance.values():
+            for item in items:
+                if (item[0] == "field" and item[1] in records) or _item_id(item) in ids:
+                    self._merge(*item)
+        for rec_name in records:
+            if not self.fields[rec_name]:
+                del self.fields[rec_name]
+
+    # Get the names of all records that have a field with the given name
+    def get_field_records(self, field_name: str) -> set[str]:
+        return self.field_records.get(field_name, set())
+
+    # Get the only record that has a field with the given name or ""
+    def get_field_record(self, field_name: str) -> str:
+        recs = self.field_records.get(field_name)
+        return next(iter(recs)) if recs and len(recs) == 1 else ""
 
     def addRecordDesc(self, record: RecordParts | None, is_global_scope: bool = True) -> None:
         if record is None:
@@ -249,7 +471,7 @@ class Codebase:
         is_private_record, local_module = _get_visibility_and_module_check(
             record, default_private=default_private,
             default_module=default_module, is_nested=is_nested)
-        _dict_upsert_def(self.types, Definition(
+        self._contribute("type", "", Definition(
             name=record.name.value,
             kind="record",
             scope=record.scope,
@@ -259,16 +481,12 @@ class Codebase:
             details=record))
         DEBUG3(lambda: scope().locationStr(
             record.name.range[0]), "Record:", self.types[record.name.value].short_repr)
-        if is_private_record:
-            self.types_restricted[record.name.value] = self.types[record.name.value]
         if record.members:
             for member in record.members:
                 is_private_field, local_module = _get_visibility_and_module_check(
                     record, default_private=scope_file().is_private, default_module=scope_module(),
                     is_nested=True)
-                if record.name.value not in self.fields:
-                    self.fields[record.name.value] = {}
-                _dict_upsert_def(self.fields[record.name.value], Definition(
+                self._contribute("field", record.name.value, Definition(
                     name=member.name.value,
                     kind="field",
                     scope=member.scope,
@@ -278,7 +496,7 @@ class Codebase:
                     details=member))
         if record.typedefs:
             for typedef in record.typedefs:
-                self.typedefs[typedef.name.value] = record.name.value
+                self._contribute("typedef", typedef.name.value, record.name.value)
         if record.vardefs:
             if is_global_scope:
                 Log.ignored_global(scope().locationStr(record.name.range[0]),
@@ -286,10 +504,9 @@ class Codebase:
         if record.nested:
             for rec in record.nested:
                 self.addRecordDesc(rec)
+        record.body = BodyRef.fromToken(record.body, record.scope)
 
-    def addMacroDesc(self, macro: MacroParts | None) -> None:
-        if macro is None:
-            return
+    def _macro_defn(self, macro: MacroParts) -> Definition:
         is_private, local_module = _get_visibility_and_module_check(
             macro, default_private=scope_file().is_private, default_module=scope_module())
         defn = Definition(
@@ -301,15 +518,23 @@ class Codebase:
             is_private=is_private,
             details=macro)
         DEBUG3(lambda: scope().locationStr(macro.name.range[0]), "Macro:", defn.short_repr)
-        _dict_upsert_def(self.macros, defn)
+        return defn
+
+    def addMacroDesc(self, macro: MacroParts | None) -> None:
+        if macro is None:
+            return
+        self._contribute("macro", "", self._macro_defn(macro))
         # if is_private:
         #     self.macros_restricted[macro.name.value] = self.macros[macro.name.value]
 
-    def updateFromText(self, txt: str, offset: int = 0, do_preproc: bool = True) -> None:
+    def updateFromText(self, txt: str, offset: int = 0, do_preproc: bool = True,
+                       tokens: TokenList | None = None) -> None:
+        """tokens, if given, are the tokens of txt, e.g. from MacroExpander.expand_tokens()"""
         DEBUG3(" ---", f"Scope: {offset}")
         with ScopePush(offset=offset):
             saved_type: Any = None
-            for st in StatementList.fromText(txt, base_offset=0):
+            for st in (StatementList.fromTokens(tokens) if tokens is not None else
+                       StatementList.fromText(txt, base_offset=0)):
                 st.getKind()
                 if (saved_type or (st.getKind().is_typedef and
                                    not st.getKind().is_record and
@@ -319,7 +544,7 @@ class Codebase:
                         if not var.typename:
                             var.typename = saved_type
                         if var.typename:
-                            self.typedefs[var.name.value] = get_base_type(var.typename)
+                            self._contribute("typedef", var.name.value, get_base_type(var.typename))
                             DEBUG3(lambda: scope().locationStr(st.range()[0]),
                                    lambda: f"Typedef: {var.name.value} = {var.typename} = "
                                            f"{self.typedefs[var.name.value]}")
@@ -332,6 +557,7 @@ class Codebase:
                     if st.getKind().is_function_def:
                         func = FunctionParts.fromStatement(st)
                         if func and func.body:
+                            func.body = BodyRef.fromToken(func.body, func.scope)
                             is_static_func_in_c = func.is_type_static and scope_file().fileKind == "c"
                             is_private, local_module = _get_visibility_and_module_check(
                                 func,
@@ -351,14 +577,9 @@ class Codebase:
                                     Log.module_foreign_def(defn.locationStr(),
                                           f"Private static function of a foreign module defined in "
                                           f"[{scope_module()}]")
-                                if scope_file().name not in self.static_names:
-                                    self.static_names[scope_file().name] = {}
-                                _dict_upsert_def(self.static_names[scope_file().name], defn)
+                                self._contribute("static", scope_file().name, defn)
                             else:
-                                _dict_upsert_def(self.names, defn)
-                                if is_private:
-                                    self.names_restricted[func.name.value] = \
-                                        self.names[func.name.value]
+                                self._contribute("name", "", defn)
                     elif st.getKind().is_record:
                         self.addRecordDesc(RecordParts.fromStatement(st))
                     elif st.getKind().is_function_decl:
@@ -376,85 +597,350 @@ class Codebase:
                             DEBUG3(lambda: scope().locationStr(st.range()[0]), "extern C")
                             self.updateFromText(body.value[1:-1], offset=body.range[0]+1)
 
-    def updateFromFile(self, fname: str, expand_preproc = True) -> None:
+    def _get_file_macros(self, txt: str) -> dict[str, Definition]:
+        """Macros defined in the text of the current file. They are not added to the globals."""
+        ret: dict[str, Definition] = {}
+        for st in StatementList.preprocFromText(txt):
+            if not (macro := MacroParts.fromStatement(st)):
+                continue
+            defn = self._macro_defn(macro)
+            if (defn.name in self.macros and
+                    (errors := copy.copy(cast(MacroParts, self.macros[defn.name].details)).update(macro))):
+                Log.defn_conflict_macro(defn.locationStr, f"redefinition of a global macro:")
+                Log.defn_conflict_macro(self.macros[defn.name].locationStr, f"global definition here:")
+                for error in errors:
+                    Log.defn_conflict_macro(None, error)
+            _dict_upsert_def(ret, defn)
+        return ret
+
+    def _expand_current_file(self, txt: str, table: MacroTable, file_macros: dict[str, Definition],
+                             persist: bool) -> tuple[str, TokenList]:
+        expander = MacroExpander()
+        txt, tokens = expander.expand_tokens(txt, table.overlay(file_macros))
+        scope_file().setExpansions(expander.expansion_log)
+        filetext.put_text(scope_file(), txt, is_expanded=True, persist=persist)
+        return txt, tokens
+
+    def updateFromFile(self, fname: str, expand_preproc = True, local_macros = False) -> File:
         DEBUG2(" ---", f"File: {fname}")
-        with ScopePush(file=File(fname)):
+        self.provenance.setdefault(fname, [])
+        with ScopePush(file=self._new_file(fname)):
+            txt = scope_file().read()
             if expand_preproc:
-                expander = MacroExpander()
-                txt = expander.expand(scope_file().read(), self.macros)
-                scope_file().updateLineInfoWithInsertList(expander.insert_list)
-                scope_file().expandList = expander.expand_list
-                self.updateFromText(txt, do_preproc=False)
+                file_macros = (self._get_file_macros(txt)
+                               if local_macros and scope_file().fileKind == "c" else {})
+                if file_macros:
+                    self.file_macros[fname] = file_macros
+                txt, tokens = self._expand_current_file(txt, self.macro_table(), file_macros,
+                                                        persist=True)
+                self.updateFromText(txt, do_preproc=False, tokens=tokens)
             else:
-                self.updateFromText(scope_file().read(), do_preproc=True)
+                filetext.put_text(scope_file(), txt)
+                self.updateFromText(txt, do_preproc=True)
+            return scope_file()
+
+    def _new_file(self, fname: str) -> File:
+        """Register a new File for the file being scanned"""
+        ret = self.files[fname] = File(fname, expander=self._expand_file_text)
+        return ret
 
     def updateMacroFromText(self, txt: str, offset: int = 0) -> None:
         with ScopePush(offset=offset):
             for st in StatementList.preprocFromText(txt):
                 self.addMacroDesc(MacroParts.fromStatement(st))
 
+    @staticmethod
+    def _collect_macros_for_multi(fname: str) -> tuple[str, File, list[MacroParts]]:
+        with LogToStringScope():
+            with ScopePush(file=File(fname)):
+                macros = [macro for st in StatementList.preprocFromText(scope_file().read())
+                          if (macro := MacroParts.fromStatement(st))]
+                file = scope_file()  # has the line info
+            errors = workspace.logStream.getvalue() # type: ignore # logStream is a StringIO
+        return (errors, file, macros)
+
+    def _update_macros_from_multi(self, errors: str, file: File, macros: list[MacroParts]) -> None:
+        print(errors, end="", file=workspace.logStream)
+        with ScopePush(file=file):
+            for macro in macros:
+                self.addMacroDesc(macro)
+
     def updateMacroFromFile(self, fname: str) -> None:
         with ScopePush(file=File(fname)):
             self.updateMacroFromText(scope_file().read())
 
-    def scanFiles(self, files: Iterable[str], twopass = True, multithread = True) -> None:
+    def scanFiles(self, files: Iterable[str], twopass = True, multithread = True,
+                  expand_policy: ExpandPolicy = None, local_macros = False,
+                  profile_macros = False, jobs: int | None = None, cache_files = False) -> None:
+        """With local_macros, only the headers and other non-.c files contribute to the global
+           macros. Macros of a .c file are collected and applied while the file is scanned,
+           which saves reading and scanning all .c files upfront. Uses of them in other files
+           are reported.
+           With profile_macros, the cost of each macro's expansions is collected in macro_stats.
+           jobs is the number of worker processes, see resolve_jobs(). The utilisation of the
+           workers is collected in worker_stats.
+           With cache_files, the results of each file are kept in the parse cache, see ScanCache.
+           Only the files that changed or can expand changed macros are scanned again. With
+           profile_macros, the definitions pass doesn't read the cache.
+           expand_policy, if given, replaces the Codebase's expand_policy."""
+        if expand_policy is not None:
+            self.expand_policy = expand_policy
+        if profile_macros and self.macro_stats is None:
+            self.macro_stats = MacroStats()
+        files = list(files)
+        self.worker_stats = []
+        file_cache = ScanCache() if cache_files and ScanCache.available() else None
+        self.scan_cache = file_cache
         if twopass:
-            for fname in files:
-                # if get_file_priority(fname) <= 1:
-                self.updateMacroFromFile(fname)
-            if not multithread:
+            macro_files = ([fname for fname in files if get_file_kind(fname) != "c"]
+                           if local_macros else files)
+            scanned: list[File] = []
+            if not multithread and file_cache is None:
+                for fname in macro_files:
+                    # if get_file_priority(fname) <= 1:
+                    self.updateMacroFromFile(fname)
+            else:
+                # Merged in the order of files, so that conflicts resolve as in a serial scan
+                self.worker_stats.append(WorkerStats("macros"))
+                for errors, file, macros in self._file_results(
+                        Codebase._collect_macros_for_multi, macro_files, (),
+                        multithread, jobs, file_cache, ".macros"):
+                    self._update_macros_from_multi(errors, file, macros)
+            DEBUG(None, lambda: "Recursive macros: " + "; ".join(
+                        ", ".join(cycle) for cycle in self.macro_table().graph.cycles()))
+            if not multithread and file_cache is None:
                 for fname in files:
                     # if fname == "/Users/y.ershov/src/wt-mod/src/conn/conn_handle.c":
-                    self.updateFromFile(fname, expand_preproc=True)
+                    scanned.append(self.updateFromFile(fname, expand_preproc=True,
+                                                       local_macros=local_macros))
             else:
-                init_multithreading()
-                with multiprocessing.Pool(processes=multiprocessing.cpu_count(),
-                                          initializer=signal.signal,
-                                          initargs=(signal.SIGINT, signal.SIG_IGN)) as pool:
-                    for res in pool.starmap(
-                                Codebase._preprocess_file_for_multi,
-                                ((self, fname) for fname in files)):
-                        self._update_from_multi(*res)
+                scanned = self._scan_definitions(files, local_macros, multithread, jobs, file_cache)
+            if local_macros:
+                self._report_macro_leaks(scanned)
         else:
             for fname in files:
                 self.updateFromFile(fname, expand_preproc=False)
 
-    def _update_from_multi(self, fname: str, errors: str,
-                           types: dict[str, Definition],
-                           fields: dict[str, dict[str, Definition]],
-                           names: dict[str, Definition],
-                           static_names: dict[str, dict[str, Definition]],
-                           typedefs: dict[str, str]) -> None:
+    def _scan_definitions(self, files: list[str], local_macros: bool, multithread: bool,
+                          jobs: int | None, file_cache: ScanCache | None = None) -> list[File]:
+        """The second pass of scanFiles() through per-file results"""
+        # Worker processes are forked and inherit the codebase and the table, so they are
+        # built once and not pickled per file
+        global _multiproc_codebase, _multiproc_macro_table
+        _multiproc_codebase, _multiproc_macro_table = self, self.macro_table()
+        if self.macro_stats is not None:
+            # Workers count from zero and send back what they counted
+            _multiproc_macro_table.stats = MacroStats()
+            # The cached results have no stats, so the files are expanded again
+            file_cache = None
+        if file_cache is not None:
+            file_cache.fingerprints = MacroFingerprints(_multiproc_macro_table)
+        self.worker_stats.append(WorkerStats("definitions"))
+        scanned = [self._update_from_multi(*res)
+                   for res in self._file_results(Codebase._preprocess_file_for_multi, files,
+                                                 (local_macros,), multithread, jobs, file_cache, ".scan")]
+        _multiproc_macro_table.stats = self.macro_stats
+        _multiproc_codebase, _multiproc_macro_table = None, None
+        return scanned
+
+    def updateFiles(self, changed: Iterable[str] = (), removed: Iterable[str] = (),
+                    local_macros = False, multithread = False, jobs: int | None = None) -> list[str]:
+        """Update the codebase after files were changed, added or removed, as if it was scanned
+           again. The contributions of the changed and removed files are retracted and the
+           definitions of the same names from the other files are merged again. The changed files
+           are scanned again, and so are the files that can expand the macros that changed.
+           local_macros must be as in scanFiles(). Returns the names of the scanned files."""
+        changed = list(dict.fromkeys(changed))
+        removed = set(removed).difference(changed)
+        typedefs_merged = self.typedefs_merged
+        self._unmerge_typedefs()
+        self.worker_stats = []
+
+        # First pass: macros. The contributions of the scanned files are merged with the ones
+        # of the other files in the order of files.
+        macros_before = {name: _macro_key(defn) for name, defn in self.macros.items()}
+        affected = self._retract([*changed, *removed], macros=True)
+        self.worker_stats.append(WorkerStats("macros"))
+        self._merge_later = set()
+        try:
+            for errors, file, macros in self._file_results(
+                    Codebase._collect_macros_for_multi,
+                    [fname for fname in changed if not local_macros or get_file_kind(fname) != "c"],
+                    (), multithread, jobs, None, ""):
+                self._update_macros_from_multi(errors, file, macros)
+            affected |= self._merge_later
+        finally:
+            self._merge_later = None
+        self._remerge(affected)
+        changed_macros = {name for *_, name in affected
+                          if _macro_key(self.macros.get(name)) != macros_before.get(name)}
+
+        # Files that can expand the changed macros
+        rescan = list(changed)
+        if changed_macros:
+            graph = self.macro_table().graph
+            reach = changed_macros.union(*(graph.mentions.get(name, ()) for name in changed_macros))
+            reach |= graph.transitive_users(reach | {MacroGraph.PASTE})
+            for fname in self.provenance:
+                if (fname and fname not in removed and fname not in changed and
+                        not reach.isdisjoint(reg_word.findall(file_content(fname)))):
+                    rescan.append(fname)
+
+        # Second pass: everything else
+        affected = self._retract([*rescan, *removed], macros=False)
+        for fname in removed:
+            self.provenance.pop(fname, None)
+            self.files.pop(fname, None)
+        for fname in [*rescan, *removed]:
+            self.file_macros.pop(fname, None)
+        self._merge_later = set()
+        try:
+            self._scan_definitions(rescan, local_macros, multithread, jobs)
+            affected |= self._merge_later
+        finally:
+            self._merge_later = None
+        self._remerge(affected)
+        if typedefs_merged:
+            self.finalize()
+        return rescan
+
+    def _unmerge_typedefs(self) -> None:
+        """Undo fill_typedefs()"""
+        if not self.typedefs_merged:
+            return
+        for alias in self.typedefs:
+            if alias in self.types and self.types[alias].name != alias:
+                if self.types_restricted.get(alias) is self.types[alias]:
+                    del self.types_restricted[alias]
+                del self.types[alias]
+        self.typedefs_merged = False
+        self.resolved_typedefs = self.field_types = None
+
+    def _file_results(self, func: Callable[..., tuple], files: list[str], args: tuple,
+                      multithread: bool, jobs: int | None,
+                      file_cache: ScanCache | None, suffix: str) -> Iterator[tuple]:
+        """Results of func(fname, *args) in the order of the files: from the cache, from worker
+           processes or computed here. The order is kept at the cost of holding the results
+           finished early, so that conflicts resolve as in a serial scan."""
+        cached: dict[str, tuple] = {}
+        if file_cache is not None:
+            cached = {fname: res for fname in files
+                      if (res := file_cache.get(fname, suffix)) is not None}
+        missing = [fname for fname in files if fname not in cached]
+        computed = (run_tasks(func, [(fname, *args) for fname in missing], _file_sizes(missing),
+                              jobs=jobs, stats=self.worker_stats[-1]) if multithread else
+                    (func(fname, *args) for fname in missing))
+        for fname in files:
+            if fname in cached:
+                yield cached[fname]
+                continue
+            res = next(computed)
+            if file_cache is not None:
+                # Macro stats are per run, the last item of the definitions pass results
+                file_cache.put(fname, suffix, res if suffix != ".scan" else (*res[:-1], None))
+            yield res
+        next(computed, None)  # let the pool finish
+
+    def _definitions(self) -> 'Definitions':
+        """The definitions as a flat list, see _update_from_multi()"""
+        ret: Definitions = [("type", "", defn) for defn in self.types.values()]
+        ret.extend(("field", rec_name, defn)
+                   for rec_name, fields in self.fields.items() for defn in fields.values())
+        ret.extend(("name", "", defn) for defn in self.names.values())
+        ret.extend(("static", fname, defn)
+                   for fname, names in self.static_names.items() for defn in names.values())
+        ret.extend(("typedef", name, typename) for name, typename in self.typedefs.items())
+        return ret
+
+    def _update_from_multi(self, fname: str, errors: str, txt: str, definitions: 'Definitions',
+                           file: File, file_macros: dict[str, Definition],
+                           macro_stats: MacroStats | None) -> File:
         DEBUG2(" ---", f"File: {fname}")
         print(errors, end="", file=workspace.logStream)
-        with ScopePush(file=File(fname)):
-            for k, v in typedefs.items():
-                self.typedefs[k] = v
-            for dst, src in ((self.types, types),
-                                (self.names, names)):
-                for name in src:
-                    _dict_upsert_def(dst, src[name])
-            for dst2, src2 in ((self.fields, fields),
-                                (self.static_names, static_names)):
-                for name2 in src2:
-                    if name2 not in dst2:
-                        dst2[name2] = {}
-                    for name in src2[name2]:
-                        _dict_upsert_def(dst2[name2], src2[name2][name])
+        if macro_stats and self.macro_stats is not None:
+            self.macro_stats.merge(macro_stats)
+        file.expander = self._expand_file_text
+        filetext.put_text(file, txt, is_expanded=True)
+        if file_macros:
+            self.file_macros[fname] = file_macros
+        self.provenance.setdefault(fname, [])
+        # The definitions came in one pickle with the file, so they already share it
+        self.files[fname] = file
+        with ScopePush(file=file):
+            for kind, key, value in definitions:
+                self._contribute(kind, key, value)
+        return file
+
+    def _report_macro_leaks(self, files: list[File]) -> None:
+        """Report uses of macros of .c files in the files that don't define them. A function-like
+           macro is used only where its name is followed by an argument list."""
+        defined_in: dict[str, set[str]] = {}
+        obj_like: set[str] = set()
+        for fname, macros in self.file_macros.items():
+            for name, defn in macros.items():
+                if name not in self.macros:
+                    defined_in.setdefault(name, set()).add(fname)
+                    if cast(MacroParts, defn.details).args is None:
+                        obj_like.add(name)
+        if not defined_in:
+            return
+        names_re = regex.compile(r"\b(?:\L<names>)\b(?=(\s*+\()?)", re_flags, names=list(defined_in))
+        for file in files:
+            reported: set[str] = set()
+            for match in names_re.finditer(clean_text_more_sz(filetext.get_text(file))):
+                if ((name := match[0]) in reported or file.name in defined_in[name] or
+                        (name not in obj_like and not match[1])):
+                    continue
+                reported.add(name)
+                Log.macro_leak(file.locationStr(match.start()),
+                    f"Macro '{name}' is defined only in {', '.join(sorted(defined_in[name]))}")
 
     @staticmethod
-    def _preprocess_file_for_multi(self: 'Codebase', fname: str) -> tuple[str, str,
-                    dict[str, Definition],
-                    dict[str, dict[str, Definition]],
-                    dict[str, Definition],
-                    dict[str, dict[str, Definition]],
-                    dict[str, str]]:
+    def _preprocess_file_for_multi(fname: str, local_macros: bool) -> tuple[str, str, str,
+                    'Definitions', File, dict[str, Definition], MacroStats | None]:
+        base, table = cast(Codebase, _multiproc_codebase), cast(MacroTable, _multiproc_macro_table)
+        # Start from nothing, so that only the definitions of this file are sent back
+        self = Codebase(macros=base.macros)
         with LogToStringScope():
             with ScopePush(file=File(fname)):
-                expander = MacroExpander()
-                txt = expander.expand(scope_file().read(), self.macros)
-                scope_file().updateLineInfoWithInsertList(expander.insert_list)
-                scope_file().expandList = expander.expand_list
-                self.updateFromText(txt, do_preproc=False)
+                txt = scope_file().read()
+                file_macros = (self._get_file_macros(txt)
+                               if local_macros and scope_file().fileKind == "c" else {})
+                # The text is sent back and persisted by _update_from_multi()
+                txt, tokens = self._expand_current_file(txt, table, file_macros, persist=False)
+                self.updateFromText(txt, do_preproc=False, tokens=tokens)
+                file = scope_file()
             errors = workspace.logStream.getvalue() # type: ignore # logStream is a StringIO
-        return (fname, errors, self.types, self.fields, self.names, self.static_names, self.typedefs)
+        return (fname, errors, txt, self._definitions(),
+                file, file_macros, table.stats.take() if table.stats is not None else None)
+
+def _file_sizes(files: list[str]) -> list[int]:
+    """Sizes of the files as the estimated costs of scanning them"""
+    ret = []
+    for fname in files:
+        try:
+            ret.append(os.path.getsize(fname))
+        except OSError:
+            ret.append(0)
+    return ret
+
+def _macro_key(defn: Definition | None) -> tuple | None:
+    """What expansion of the macro depends on"""
+    if defn is None:
+        return None
+    macro = cast(MacroParts, defn.details)
+    return ([arg.value for arg in macro.args] if macro.args is not None else None,
+            macro.body.value if macro.body is not None else None, macro.is_va_args,
+            defn.is_private, defn.module)
+
+def _item_id(item: tuple[str, str, Definition | str]) -> tuple[str, str, str]:
+    """(kind, key, name) of an item of Definitions"""
+    return (item[0], item[1], item[2].name if isinstance(item[2], Definition) else item[1])
+
+# Definitions of one file: (kind, key, value), kind is one of "type", "field", "name", "static",
+# "typedef" and "macro". The key is the record name for fields, the file name for static names and the
+# alias for typedefs, which value is the type name.
+Definitions: TypeAlias = list[tuple[str, str, Definition | str]]
+
+_multiproc_codebase: 'Codebase | None' = None
+_multiproc_macro_table: MacroTable | None = None
@@ -36,13 +36,15 @@ def getTokenKind(txt: str) -> TokenKind:
         "@" if txt.startswith("@") else \
         ""
 
-@dataclass
+@dataclass(slots=True)
 class Token:
     """One token in the source code"""
     idx: int = field(compare=False)     # Index in the original stream of tokens
     range: Range = field(compare=False) # Character range in the original text
     value: str                          # Text value
     kind: TokenKind | None = field(default=None, repr=False)
+    # Range in the source text before macro expansion, set by MacroExpander.expand_tokens()
+    orig_range: Range | None = field(default=None, compare=False, repr=False)
 
     def getKind(self) -> TokenKind:
         if self.kind is not None:
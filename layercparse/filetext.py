@@ -0,0 +1,121 @@
+# Function and record bodies are stored as references to ranges of the file text rather
+# than as strings. The text is read on demand and kept in a per-process size-capped cache.
+
+import zlib
+from dataclasses import fields
+from collections import OrderedDict
+
+from .internal import *
+from .ctoken import *
+from .workspace import *
+from . import cache
+
+# Maximum total size of the texts kept in memory
+cache_limit = 256 * 1024 * 1024
+
+_texts: OrderedDict[tuple[str, int], str] = OrderedDict()  # (file name, crc) -> text
+_texts_size = 0
+_persisted: set[tuple[str, int]] = set()  # keys of the texts in the disk cache
+
+def text_crc(txt: str) -> int:
+    return zlib.crc32(txt.encode())
+
+def _cache_key(file: File) -> tuple[str, int]:
+    return (file.name, file.textCrc)  # type: ignore[return-value] # textCrc is not None
+
+def _cache_suffix(file: File) -> str:
+    return f".expanded.{file.textCrc:08x}"
+
+def _cache_add(key: tuple[str, int], txt: str) -> None:
+    global _texts_size
+    if key in _texts:
+        _texts.move_to_end(key)
+        return
+    _texts[key] = txt
+    _texts_size += len(txt)
+    while _texts_size > cache_limit and len(_texts) > 1:
+        _, old = _texts.popitem(last=False)
+        _texts_size -= len(old)
+
+def clear() -> None:
+    global _texts_size
+    _texts.clear()
+    _texts_size = 0
+    _persisted.clear()
+
+def put_text(file: File, txt: str, is_expanded: bool = False, persist: bool = True) -> None:
+    """Register the text that the file's tokens refer to and keep it in memory. With persist,
+       an expanded text is also written to the disk cache, once. Worker processes don't
+       persist the text that they send back."""
+    file.textCrc = text_crc(txt)
+    file.is_expanded = is_expanded
+    key = _cache_key(file)
+    _cache_add(key, txt)
+    if persist and is_expanded and cache.use_cache and key not in _persisted:
+        cache.put(txt, file.name, suffix=_cache_suffix(file))
+        _persisted.add(key)
+
+def has_text(file: File) -> bool:
+    return file.textCrc is not None
+
+def _load_text(file: File) -> str:
+    txt: str | None = None
+    if not file.is_expanded:
+        txt = file_content(file.name)
+    elif cache.use_cache:
+        txt = cast(str | None, cache.get(file.name, suffix=_cache_suffix(file)))
+        if txt is not None:
+            _persisted.add(_cache_key(file))
+    if txt is None:
+        if file.expander is None:
+            raise ValueError(f"No macro expander to read the text of {file.name}")
+        txt = file.expander(file)
+    if text_crc(txt) != file.textCrc:
+        WARNING(None, f"{file.name}: the file has changed since it was scanned")
+    return txt
+
+def get_text(file: File) -> str:
+    key = _cache_key(file)
+    if key in _texts:
+        _texts.move_to_end(key)
+        return _texts[key]
+    txt = _load_text(file)
+    _cache_add(key, txt)
+    return txt
+
+
+class BodyRef(Token):
+    """Token which value is a range of the file text. The text is read on demand."""
+    __slots__ = ("file", "base")
+    file: File
+    base: int  # offset of the scope that the range is relative to
+
+    def __init__(self, token: Token, scope: Scope):
+        self.file, self.base = scope.file, scope.offset
+        self.idx, self.range, self.kind, self.orig_range = token.idx, token.range, token.kind, None
+
+    @property  # type: ignore[override] # value is a field in Token
+    def value(self) -> str:
+        return get_text(self.file)[self.base + self.range[0]:self.base + self.range[1]]
+
+    @value.setter
+    def value(self, val: str) -> None:
+        raise AttributeError("The value of a BodyRef is read from the file and can't be set")
+
+    def __getstate__(self) -> tuple[None, dict[str, Any]]:
+        # The default state of a slotted object would read the value from the file
+        return (None, {name: getattr(self, name) for name in _bodyref_slots})
+
+    def __eq__(self, other: Any) -> bool:
+        if not isinstance(other, Token):
+            return NotImplemented
+        return self.value == other.value
+
+    @staticmethod
+    def fromToken(token: Token | None, scope: Scope) -> Token | None:
+        """Make a reference if the scope's file text is registered, otherwise keep the token."""
+        if token is None or isinstance(token, BodyRef) or not has_text(scope.file):
+            return token
+        return BodyRef(token, scope)
+
+_bodyref_slots = [f.name for f in fields(Token) if f.name != "value"] + list(BodyRef.__slots__)
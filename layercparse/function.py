@@ -1,4 +1,4 @@
-from typing import Iterable, Any
+from typing import Iterable, Any, Container
 from dataclasses import dataclass
 
 from .internal import *
@@ -6,9 +6,44 @@ from .ctoken import *
 from .statement import *
 from .variable import *
 from .record import *
-from .workspace import scope, Scope
+from .workspace import scope, Scope, ScopePush
 
-@dataclass
+class LocalName(NamedTuple):
+    """Local name of a function: an argument or a local variable"""
+    name: str
+    typename: str  # declared type
+    basetype: str  # base type before untypedef, "" if it's not a known type
+    offset: int    # relative to the function body
+    scope: Range   # part of the function body where the name is visible
+
+class SymbolTable:
+    """Arguments and local variables of a function with the scopes they are visible in"""
+    symbols: list[LocalName]
+    _byName: dict[str, list[LocalName]]
+
+    def __init__(self):
+        self.symbols = []
+        self._byName = {}
+
+    def __iter__(self) -> Iterator[LocalName]:
+        return iter(self.symbols)
+
+    def __len__(self) -> int:
+        return len(self.symbols)
+
+    def add(self, sym: LocalName) -> None:
+        self.symbols.append(sym)
+        self._byName.setdefault(sym.name, []).append(sym)
+
+    def lookup(self, name: str, offset: int) -> LocalName | None:
+        """Find the declaration of the name in the innermost scope at the offset in the body."""
+        ret = None
+        for sym in self._byName.get(name, ()):
+            if sym.scope[0] <= offset < sym.scope[1] and (ret is None or sym.scope[0] >= ret.scope[0]):
+                ret = sym
+        return ret
+
+@dataclass(slots=True)
 class FunctionParts:
     typename: TokenList
     name: Token
@@ -222,3 +257,67 @@ class FunctionParts:
     def getFunctionLocalVarsOfTypes(self, alltypes: Iterable[str], body: str | None = None) -> list[Variable]:
         return list(self.xGetFunctionLocalVarsOfTypes(alltypes))
 
+    def getSymbolTable(self, alltypes: Container[str] = (), body: str | None = None) -> SymbolTable:
+        """Get the arguments and local variables in all nested blocks in one pass over the body.
+           alltypes is used to tell if a local record type is known.
+           body can be a cleaned-up copy of the body text of the same size."""
+        ret = SymbolTable()
+        if body is None and self.body:
+            body = self.body.value
+        if body is None or not self.body:
+            return ret
+        base = self.body.range[0]
+        for var in self.xGetArgs():
+            offset = var.name.range[0] - base
+            ret.add(LocalName(var.name.value,
+                              var.typename.short_repr() if var.typename else "",
+                              get_base_type(var.typename) if var.typename else "",
+                              offset, (offset, len(body))))
+        with ScopePush(file=self.scope.file, offset=self.scope.offset + base):
+            self._scanBlock(TokenList.fromText(body, base_offset=0), len(body), alltypes, ret)
+        return ret
+
+    @staticmethod
+    def _scanBlock(tokens: TokenList, end: int, alltypes: Container[str], ret: SymbolTable) -> None:
+        def _add(var: Variable, basetype: str) -> None:
+            ret.add(LocalName(var.name.value,
+                              var.typename.short_repr() if var.typename else "",
+                              basetype, var.name.range[0], (var.name.range[0], end)))
+
+        saved_type: Any = None
+        for st in StatementList.xFromTokens(tokens):
+            t = st.getKind()
+            if saved_type or (t.is_decl and not t.is_function and not t.is_record and
+                              (not t.is_expression or t.is_initialization)):
+                var = Variable.fromVarDef(st.tokens)
+                if var:
+                    if not var.typename:
+                        var.typename = saved_type
+                    _add(var, get_base_type(var.typename) if var.typename else "")
+                    saved_type = var.typename if var.end == "," else None
+                else:
+                    saved_type = None
+                continue
+            saved_type = None
+            if t.is_record:
+                record = RecordParts.fromStatement(st)
+                if record and record.vardefs:
+                    for var in record.vardefs:
+                        # A local record type can't be resolved through the global types
+                        basetype = get_base_type(var.typename)
+                        _add(var, basetype if basetype in alltypes else "")
+                continue
+            # Nested blocks and for-loop headers
+            prev = ""
+            for token in st.tokens:
+                if token.getKind() == "{":
+                    FunctionParts._scanBlock(
+                        TokenList.fromText(token.value[1:-1], base_offset=token.range[0]+1),
+                        token.range[1]-1, alltypes, ret)
+                elif token.getKind() == "(" and prev == "for":
+                    FunctionParts._scanBlock(
+                        TokenList.fromText(token.value[1:-1], base_offset=token.range[0]+1),
+                        st.range()[1], alltypes, ret)
+                if token.getKind() not in [" ", "/"]:
+                    prev = token.value
+
@@ -69,7 +69,26 @@ _reg_clean_preproc = regex.compile(_re_clean_preproc, re_flags)
 def _clean_text_preproc(txt: str):
     return _reg_clean_preproc.sub(lambda match: reg_cr.sub(" ", match[0]) if match["s"] else match[0], txt)
 
-@dataclass
+# Segments of the body of a function-like macro
+#   ("t", text)                  - literal text
+#   ("a", arg_idx)               - the macro-expanded argument
+#   ("s", arg_idx)               - the stringified argument: #arg
+#   ("p", (arg_idx | text, ...)) - the pasted non-expanded arguments and words: a ## b
+#   ("c", (text, arg_idx))       - GNU comma paste: ", ## __VA_ARGS__" drops the comma if empty
+TemplateSegment: TypeAlias = tuple[str, Any]
+
+_reg_macro_template = regex.compile(r"""
+    (?P<lit> (?> " (?> [^\\"] | \\. )* " ) |
+             (?> ' (?> [^\\'] | \\. )* ' ) |
+             (?> \/\/ [^\n]*+ ) |
+             (?> \/\* (?: [^*] | \*[^\/] )*+ \*\/ ) ) |
+    (?P<c> (?P<sep>,\s*+) \#\#\s*+ (?P<n>__VA_ARGS__)\b ) |
+    (?P<h> \#\s*+ (?P<n>\w++) ) |
+    (?P<hh> (?P<n>\w++)(?>\s*+\#\#\s*+(?P<n>\w++))++) |
+    (?P<n>\w++)
+""", re_flags)
+
+@dataclass(slots=True)
 class MacroParts:
     name: Token
     args: list[Token] | None = None
@@ -84,9 +103,7 @@ class MacroParts:
     unbalanced: str | None = None
     has_rettype: bool | None = None
     typename: TokenList = field(default_factory=TokenList)
-
-    # TODO(later): Parse body into a list of tokens.
-    #              Use special token types for # and ## operators and replacements
+    template: list[TemplateSegment] | None = field(default=None, repr=False, compare=False)
 
     # def __post_init__(self):
     #     self.parseExtra()
@@ -107,6 +124,47 @@ class MacroParts:
         self.parseExtra()
         return self.typename
 
+    def get_template(self) -> list[TemplateSegment]:
+        """The body of a function-like macro split into segments for argument substitution.
+           Comments and string literals are never substituted."""
+        if self.template is not None:
+            return self.template
+        template: list[TemplateSegment] = []
+        if not self.body:
+            self.template = template
+            return template
+        args = {arg.value: i for i, arg in enumerate(self.args or [])}
+        body, pos = self.body.value, 0
+
+        def _literal(txt: str) -> None:
+            if template and template[-1][0] == "t":
+                template[-1] = ("t", template[-1][1] + txt)
+            elif txt:
+                template.append(("t", txt))
+
+        for match in _reg_macro_template.finditer(body):
+            _literal(body[pos:match.start()])
+            pos = match.end()
+            if match["lit"]:
+                _literal(match[0])
+            elif match["c"] and self.is_va_args:
+                template.append(("c", (match["sep"], args["__VA_ARGS__"])))
+            elif match["h"]:
+                if match["n"] in args:
+                    template.append(("s", args[match["n"]]))
+                else:
+                    _literal('""')
+            elif match["hh"]:
+                template.append(("p", tuple(args.get(name, name)
+                                            for name in match.captures("n"))))
+            elif match["n"] in args:
+                template.append(("a", args[match["n"]]))
+            else:
+                _literal(match[0])
+        _literal(body[pos:])
+        self.template = template
+        return template
+
     def args_short_repr(self) -> str:
         return "(" + ", ".join([arg.value for arg in self.args]) + ")" if self.args is not None else ""
     def short_repr(self) -> str:
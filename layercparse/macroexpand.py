@@ -1,4 +1,7 @@
+import itertools, time, copy
 from dataclasses import dataclass
+from typing import Mapping, MutableMapping
+from collections import OrderedDict, ChainMap
 
 from .workspace import *
 from .macro import *
@@ -14,26 +17,491 @@ def _D2M(val: 'Definition') -> MacroParts: # type: ignore[name-defined] # circul
 #     expansionTree: 'map[str, ExpandTree]'
 #     # name: str
 
-class MacroExpander:
-    insert_list: InsertList  # sorted list by range[0] of (offset, delta)
-    expand_list: list[Expansions]  # sorted list by range[0] of ExpandList
-    _macros: dict[str, MacroParts]
-    _cur_expand_entry: dict[str, set[str]]
+# (macro name, argument list text or None, names blocked from recursive expansion)
+ExpansionKey: TypeAlias = tuple[str, str | None, frozenset[str]]
+# (replacement, (caller, callee) expansion edges). Caller None stands for the expansion context.
+ExpansionResult: TypeAlias = tuple[str, tuple[tuple[str | None, str], ...]]
 
-    # Macro expansion.
-    #  - https://en.wikipedia.org/wiki/C_preprocessor#Order_of_expansion
-    #  - https://stackoverflow.com/questions/45375238/c-preprocessor-macro-expansion
-    #  - https://gcc.gnu.org/onlinedocs/cpp/Argument-Prescan.html
-    def expand(self, txt: str, macros: 'dict[str, Definition]', expand_const: bool = False) -> str: # type: ignore[name-defined] # circular dependency for Definition
-        # TODO(later): Optimise: compose the result as a list of strings, then join at the end
+def _result_uses(key: ExpansionKey, value: ExpansionResult, names: set[str]) -> bool:
+    """Whether a change of any of the macros can affect the expansion result: it expanded them
+       or has them as unexpanded words"""
+    if key[0] in names or any(callee in names for _, callee in value[1]):
+        return True
+    return any(any(name in txt for name in names) and not names.isdisjoint(reg_word.findall(txt))
+               for txt in (value[0], key[1] or ""))
+
+class ExpansionCache:
+    """LRU cache of macro expansion results with per-macro hit counters"""
+    maxsize: int
+    stats: dict[str, list[int]]  # macro name -> [hits, misses]
+    _entries: OrderedDict[ExpansionKey, ExpansionResult]
+
+    def __init__(self, maxsize: int = 65536):
+        self.maxsize = maxsize
+        self.stats = {}
+        self._entries = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: ExpansionKey) -> ExpansionResult | None:
+        stat = self.stats.setdefault(key[0], [0, 0])
+        if (ret := self._entries.get(key)) is None:
+            stat[1] += 1
+            return None
+        stat[0] += 1
+        self._entries.move_to_end(key)
+        return ret
+
+    def put(self, key: ExpansionKey, value: ExpansionResult) -> None:
+        self._entries[key] = value
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def invalidate(self, names: set[str]) -> None:
+        """Drop the results that a change of any of the macros can affect"""
+        for key in [key for key, value in self._entries.items() if _result_uses(key, value, names)]:
+            del self._entries[key]
+
+    def report(self, top: int = 20) -> str:
+        """Macros with the most cache lookups and their hit rates"""
+        lines = []
+        for name, (hits, misses) in sorted(self.stats.items(), key=lambda kv: -sum(kv[1]))[:top]:
+            lines.append(f"{name}: {hits}/{hits + misses} hits ({100 * hits // (hits + misses)}%)")
+        return "\n".join(lines)
+
+
+# Lines that end top-level statements in formatted C code: a closing brace or a declaration
+# at column 0
+_reg_top_end = regex.compile(r"""^ (?: \} [^\n]*+ (?<!\\) | [^\s\#] [^\n]* ; ) \n""",
+                             re_flags | regex.MULTILINE)
+
+# Parentheses and the comments and literals that they don't count in
+_reg_parens = regex.compile(r"""
+    \/\* (?: [^*] | \*(?!\/) )*+ (?: \*\/ | \Z ) | \/\/ (?: [^\\\n] | \\. )*+ |
+    " (?: [^"\\\n] | \\. )*+ " | ' (?: [^'\\\n] | \\. )*+ ' | [()]""", re_flags)
+
+def top_statements(txt: str) -> Iterator[Range]:
+    """Split the text into ranges of top-level statements that no macro use or comment spans.
+       Cut at the ends of lines that end statements where parentheses are balanced and no
+       comment or literal continues."""
+    start = parens = 0
+    scan = _reg_parens.finditer(txt)
+    paren = next(scan, None)
+    for match in _reg_top_end.finditer(txt):
+        end = match.end()
+        while paren is not None and paren.end() <= end:
+            if paren[0] == "(":
+                parens += 1
+            elif paren[0] == ")":
+                parens -= 1
+            paren = next(scan, None)
+        if not parens and (paren is None or paren.start() >= end):
+            yield start, end
+            start = end
+    if start < len(txt):
+        yield start, len(txt)
+
+_reg_tokens = regex.compile(r"(?&TOKEN)*+" + re_token, re_flags)
+# Characters that can't start a comment, string, preprocessor directive or escape
+_plain_chars = frozenset("_abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
+                         "\r\t\n ,;?:!~.+-*&%<>^|=@(){}[]/")
+_reg_brackets = regex.compile(r"[(){}\[\]]", re_flags)
+_opening = {")": "(", "}": "{", "]": "["}
+
+def _whole_tokens(txt: str) -> bool:
+    """Whether the text is a sequence of tokens with nothing left over"""
+    if not _plain_chars.issuperset(txt) or "//" in txt or "/*" in txt:
+        return bool(_reg_tokens.fullmatch(txt))
+    # Only brackets can be left over. Matching them here is faster than the recursive regex.
+    stack: list[str] = []
+    for char in _reg_brackets.findall(txt):
+        if char in "({[":
+            stack.append(char)
+        elif not stack or stack.pop() != _opening[char]:
+            return False
+    return not stack
+
+_ident_start = frozenset("_abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ")
+
+def _char_class(char: str) -> str:
+    return ("w" if char.isalnum() or char == "_" else
+            " " if char in " \t\r" else
+            "+" if char in "+-*/%<>=!&|^.:?~#\\" else "")
+
+def _glues(left: str, right: str) -> bool:
+    """Whether the characters can become one token when a replacement puts them side by side"""
+    return bool(left and right) and (left == "\\" or _char_class(left) == _char_class(right) != "")
+
+class _TokenMatch:
+    """A macro use found in tokens. Quacks like a match of MacroTable.names_reg."""
+    def __init__(self, txt: str, spans: dict[int | str, Range]):
+        self._txt, self._spans = txt, spans
+
+    def __getitem__(self, group: int | str) -> str | None:
+        span = self._spans.get(group)
+        return None if span is None else self._txt[span[0]:span[1]]
+
+    def start(self, group: int | str = 0) -> int:
+        return self._spans[group][0]
+
+    def end(self, group: int | str = 0) -> int:
+        return self._spans[group][1]
+
+class _OverlayCache(ExpansionCache):
+    """Cache of a MacroTable overlay. The results that don't depend on the macros of the overlay
+       are shared with the cache of the base table."""
+    base: ExpansionCache
+    names: set[str]  # macros of the overlay and the macros that can reach them
+
+    def __init__(self, base: ExpansionCache, names: set[str]):
+        super().__init__(base.maxsize)
+        self.stats, self.base, self.names = base.stats, base, names
+
+    def _shared(self, key: ExpansionKey, value: ExpansionResult) -> bool:
+        return not _result_uses(key, value, self.names)
+
+    def get(self, key: ExpansionKey) -> ExpansionResult | None:
+        if (value := self.base._entries.get(key)) is not None and self._shared(key, value):
+            return self.base.get(key)
+        return super().get(key)
+
+    def put(self, key: ExpansionKey, value: ExpansionResult) -> None:
+        if self._shared(key, value):
+            self.base.put(key, value)
+        else:
+            super().put(key, value)
+
+class MacroGraph:
+    """Dependency graph of macros: the macros that each macro's body refers to"""
+    deps: MutableMapping[str, set[str]]  # macro -> macros used in its body
+    users: dict[str, set[str]]  # macro -> macros which bodies use it
+    words: dict[str, set[str]]     # macro -> words of its body
+    mentions: dict[str, set[str]]  # word -> macros which bodies have it, macro or not
+    _closure: dict[str, frozenset[str]]
+
+    # Pseudo-dependency of macros that paste tokens with ##. Pasting can produce any name.
+    PASTE = "##"
+
+    def __init__(self):
+        self.deps, self.users, self.words, self.mentions, self._closure = {}, {}, {}, {}, {}
+
+    def update(self, macros: 'dict[str, Definition]', names: Iterable[str]) -> None: # type: ignore[name-defined] # circular dependency for Definition
+        """Re-read the bodies of the given macros. The macros which bodies mention the names
+           get their dependencies updated as well because the names may be new or removed."""
+        names = set(names)
+        for name in names:
+            for word in self.words.pop(name, ()):
+                self.mentions[word].discard(name)
+            if name not in macros or (words := self._body_words(macros[name])) is None:
+                continue
+            self.words[name] = words
+            for word in words:
+                self.mentions.setdefault(word, set()).add(name)
+        for name in names.union(*(self.mentions.get(name, ()) for name in names)):
+            for dep in self.deps.pop(name, ()):
+                self.users[dep].discard(name)
+            if name not in self.words:
+                continue
+            deps = {word for word in self.words[name] if word in macros or word == self.PASTE}
+            self.deps[name] = deps
+            for dep in deps:
+                self.users.setdefault(dep, set()).add(name)
+        self._closure = {}
+
+    @staticmethod
+    def _body_words(defn: 'Definition') -> set[str] | None: # type: ignore[name-defined] # circular dependency for Definition
+        if not (body := _D2M(defn).body):
+            return None
+        words = set(reg_word.findall(body.value))
+        if "##" in body.value:
+            words.add(MacroGraph.PASTE)
+        return words
+
+    def closure(self, name: str) -> frozenset[str]:
+        """All macros that expansion of the macro can reach"""
+        if name in self._closure:
+            return self._closure[name]
+        ret: set[str] = set()
+        stack = [name]
+        while stack:
+            for dep in self.deps.get(stack.pop(), ()):
+                if dep not in ret:
+                    ret.add(dep)
+                    stack.append(dep)
+        self._closure[name] = frozenset(ret)
+        return self._closure[name]
+
+    def transitive_users(self, names: str | Iterable[str]) -> set[str]:
+        """All macros which expansion can reach any of the names"""
+        ret: set[str] = set()
+        stack = [names] if isinstance(names, str) else list(names)
+        while stack:
+            for user in self.users.get(stack.pop(), ()):
+                if user not in ret:
+                    ret.add(user)
+                    stack.append(user)
+        return ret
+
+    def cycles(self) -> list[list[str]]:
+        """Groups of mutually recursive macros (Tarjan's strongly connected components)"""
+        index: dict[str, int] = {}
+        lowlink: dict[str, int] = {}
+        on_stack: set[str] = set()
+        stack: list[str] = []
+        ret: list[list[str]] = []
+        for root in sorted(self.deps):
+            if root in index:
+                continue
+            work = [(root, iter(sorted(self.deps.get(root, ()))))]
+            index[root] = lowlink[root] = len(index)
+            stack.append(root)
+            on_stack.add(root)
+            while work:
+                node, children = work[-1]
+                for child in children:
+                    if child not in index:
+                        index[child] = lowlink[child] = len(index)
+                        stack.append(child)
+                        on_stack.add(child)
+                        work.append((child, iter(sorted(self.deps.get(child, ())))))
+                        break
+                    if child in on_stack:
+                        lowlink[node] = min(lowlink[node], index[child])
+                else:  # all children are done
+                    work.pop()
+                    if work:
+                        lowlink[work[-1][0]] = min(lowlink[work[-1][0]], lowlink[node])
+                    if lowlink[node] == index[node]:
+                        component = []
+                        while True:
+                            member = stack.pop()
+                            on_stack.discard(member)
+                            component.append(member)
+                            if member == node:
+                                break
+                        if len(component) > 1 or node in self.deps.get(node, ()):
+                            ret.append(sorted(component))
+        return ret
+
+@dataclass
+class MacroStat:
+    count: int = 0          # expansions, including cached ones
+    time: float = 0.0       # seconds, including the nested expansions
+    out_bytes: int = 0      # size of the replacements
+    max_depth: int = 0      # deepest nesting level of the macro's expansion
+    args_time: float = 0.0  # seconds spent splitting the arguments
+
+    def merge(self, other: 'MacroStat') -> None:
+        self.count += other.count
+        self.time += other.time
+        self.out_bytes += other.out_bytes
+        self.max_depth = max(self.max_depth, other.max_depth)
+        self.args_time += other.args_time
+
+class MacroStats(dict[str, MacroStat]):
+    """Per-macro expansion profile: macro name -> MacroStat"""
+
+    def get_stat(self, name: str) -> MacroStat:
+        if (ret := self.get(name)) is None:
+            ret = self[name] = MacroStat()
+        return ret
+
+    def merge(self, other: 'dict[str, MacroStat]') -> None:
+        for name, stat in other.items():
+            self.get_stat(name).merge(stat)
+
+    def take(self) -> 'MacroStats':
+        """Return the counters collected so far and start over, e.g. in a worker process"""
+        ret = MacroStats(self)
+        self.clear()
+        return ret
+
+    def report(self, top: int = 20) -> str:
+        """Macros that took the most time"""
+        lines = [f"{'macro':<40} {'count':>9} {'time, ms':>10} {'args, ms':>10} "
+                 f"{'out, KB':>10} {'depth':>5}"]
+        for name, stat in sorted(self.items(), key=lambda kv: -kv[1].time)[:top]:
+            lines.append(f"{name:<40} {stat.count:>9} {stat.time * 1000:>10.1f} "
+                         f"{stat.args_time * 1000:>10.1f} {stat.out_bytes / 1024:>10.1f} "
+                         f"{stat.max_depth:>5}")
+        return "\n".join(lines)
+
+# Which macros to expand. The rest are left in the text and recorded as opaque uses.
+#   "all"         - all macros
+#   "private"     - private or module-owned macros and the macros that use them
+#   "has_rettype" - macros that evaluate to a typed expression, e.g. a cast
+#   a predicate on the macro definition
+ExpandPolicy: TypeAlias = 'str | Callable[[Definition], bool] | None' # type: ignore[name-defined] # circular dependency for Definition
+
+class _OverlayGraph(MacroGraph):
+    """Dependency graph of a MacroTable overlay. deps and closure() see the macros of the
+       overlay, users, words and mentions are the ones of the base graph."""
+    def __init__(self, base: MacroGraph, macros: 'Mapping[str, Definition]', # type: ignore[name-defined] # circular dependency for Definition
+                 names: set[str]):
+        """names are the macros of the overlay and the macros which bodies mention them"""
+        super().__init__()
+        self.users, self.words, self.mentions = base.users, base.words, base.mentions
+        deps: dict[str, set[str]] = {}
+        for name in names:
+            words = self._body_words(macros[name]) or set()
+            deps[name] = {word for word in words if word in macros or word == self.PASTE}
+        self.deps = ChainMap(deps, base.deps)
 
-        self.insert_list = []  # (offset, delta)
-        self.expand_list = []
+class MacroTable:
+    """Macros prepared for expansion: their kinds and the compiled name matcher.
+       Built once after the macro pass and reused for every file. Forked workers inherit it."""
+    macros: 'dict[str, Definition]'  # type: ignore[name-defined] # circular dependency for Definition
+    expand_const: bool
+    obj_like: set[str]
+    fn_like: set[str]
+    _names_reg: regex.Pattern | None
+    _names_reg_stale: bool  # compile on the next use
+    cache: ExpansionCache  # valid for the current set of expandable names
+    graph: MacroGraph
+    # Object-like macros expanded with no names blocked from recursion. Valid where none of the
+    # macros reachable from it is blocked.
+    preexpanded: dict[str, ExpansionResult]
+    policy: ExpandPolicy
+    opaque: set[str]  # matched and recorded but not expanded because of the policy
+    names: frozenset[str]  # names the matcher looks for: obj_like | fn_like
+    stats: MacroStats | None  # expansion profile, collected if set
+
+    def __init__(self, macros: 'dict[str, Definition]', expand_const: bool = False, # type: ignore[name-defined] # circular dependency for Definition
+                 policy: ExpandPolicy = None, stats: MacroStats | None = None):
+        if policy not in (None, "all", "private", "has_rettype") and not callable(policy):
+            raise ValueError(f"Unknown macro expansion policy: {policy}")
+        self.macros, self.expand_const, self.policy = macros, expand_const, policy
+        self.stats = stats
+        self.obj_like, self.fn_like, self.opaque = set(), set(), set()
+        self._names_reg, self._names_reg_stale = None, False
+        self.names = frozenset()
+        self.cache = ExpansionCache()
+        self.graph = MacroGraph()
+        self.preexpanded = {}
+        self.update(macros.keys(), force=True)
+
+    def update(self, names: Iterable[str], force: bool = False) -> bool:
+        """Pick up added, changed or removed macros. Recompile the matcher only if the set of
+           expandable names changed. Return True if the matcher was recompiled."""
+        names = set(names)
+        changed = force
+        for name in names:
+            is_obj_like, is_fn_like = self._kind(name)
+            for names_set, is_in in ((self.obj_like, is_obj_like), (self.fn_like, is_fn_like)):
+                if (name in names_set) != is_in:
+                    changed = True
+                    if is_in:
+                        names_set.add(name)
+                    else:
+                        names_set.discard(name)
+        if changed:
+            self._compile()
+        if names:
+            # Users before and after the update: a name can be added or removed
+            affected = names | self.graph.transitive_users(names)
+            self.graph.update(self.macros, names)
+            affected |= self.graph.transitive_users(names)
+            self.cache.invalidate(affected)
+            for name in affected:
+                if (name in self.obj_like or name in self.fn_like) and not self._want_expand(name):
+                    self.opaque.add(name)
+                else:
+                    self.opaque.discard(name)
+            self._preexpand(affected)
+        return changed
+
+    def overlay(self, macros: 'dict[str, Definition]') -> 'MacroTable': # type: ignore[name-defined] # circular dependency for Definition
+        """A table with the macros added, e.g. the ones defined in the file being expanded. They
+           shadow the macros with the same names. This table is not changed: the overlay shares
+           its matcher sets, graph and cached expansions that don't depend on the added macros.
+           The overlay is not to be updated."""
         if not macros:
-            return txt
-        self._macros = macros
-        self._cur_expand_entry = {}
+            return self
+        names = set(macros)
+        mentioning = set().union(*(self.graph.mentions.get(name, ()) for name in names))
+        # The expansions of these can change
+        affected = names | mentioning | self.graph.transitive_users(names | mentioning)
+        ret = copy.copy(self)
+        ret.macros = ChainMap(macros, self.macros)  # type: ignore[assignment] # only read
+        ret.obj_like, ret.fn_like = set(self.obj_like), set(self.fn_like)
+        for name in names:
+            is_obj_like, is_fn_like = ret._kind(name)
+            for names_set, is_in in ((ret.obj_like, is_obj_like), (ret.fn_like, is_fn_like)):
+                if is_in:
+                    names_set.add(name)
+                else:
+                    names_set.discard(name)
+        ret._compile()
+        ret.graph = _OverlayGraph(self.graph, ret.macros, names | mentioning)
+        ret.opaque = self.opaque - affected
+        ret.opaque.update(name for name in affected
+                          if name in ret.names and not ret._want_expand(name))
+        ret.cache = _OverlayCache(self.cache, affected)
+        ret.preexpanded = {name: entry for name, entry in self.preexpanded.items()
+                           if name not in affected}
+        return ret
+
+    def _kind(self, name: str) -> tuple[bool, bool]:
+        """Whether the macro is expanded as object-like and as function-like"""
+        if name not in self.macros:
+            return False, False
+        macro = _D2M(self.macros[name])
+        if not self.expand_const and macro.get_is_const():
+            return False, False
+        if macro.args is not None:
+            macro.get_template()  # so that forked workers inherit it
+        return macro.args is None, macro.args is not None
+
+    def _want_expand(self, name: str) -> bool:
+        match self.policy:
+            case None | "all":
+                return True
+            case "private":
+                # Private as in the access check: private and owned by a module
+                return any(dep == MacroGraph.PASTE or
+                           (dep in self.macros and
+                            bool(self.macros[dep].is_private and self.macros[dep].module))
+                           for dep in itertools.chain((name,), self.graph.closure(name)))
+            case "has_rettype":
+                return bool(_D2M(self.macros[name]).get_has_rettype())
+            case _:
+                return self.policy(self.macros[name])  # type: ignore[operator] # policy is callable
 
+    def _preexpand(self, names: set[str]) -> None:
+        for name in names:
+            self.preexpanded.pop(name, None)
+        if not self.names:
+            return
+        for name in sorted((names & self.obj_like) - self.opaque):
+            if MacroGraph.PASTE in self.graph.closure(name):
+                continue
+            expander = MacroExpander()
+            with LogToStringScope():
+                txt, _ = expander.expand_tokens(name, self)
+            if expander._warnings:
+                continue
+            log = expander.expansion_log
+            self.preexpanded[name] = (txt, tuple(
+                (caller, callee)
+                for k in range(len(log))
+                for caller, callee in log.edges(k) if caller))  # skip the use itself
+
+    @property
+    def names_reg(self) -> regex.Pattern | None:
+        """The matcher of the text expander, compiled on first use"""
+        if self._names_reg_stale:
+            self._names_reg, self._names_reg_stale = self._compile_names_reg(), False
+        return self._names_reg
+
+    def _compile(self) -> None:
+        self.names = frozenset(self.obj_like | self.fn_like)
+        self._names_reg, self._names_reg_stale = None, True
+
+    def _compile_names_reg(self) -> regex.Pattern | None:
         names_re_a = [
             r"""(?> (?: \# | \/\/ ) (?: [^\\\n] | \\. )*+ \n)""",
             r"""(?> \/\* (?: [^*] | \*[^\/] )*+ \*\/ )""",
@@ -41,32 +509,89 @@ class MacroExpander:
             r"""(?> ' (?> [^\\'] | \\. )* ' )""",
         ]
         kwargs = {}
-        self._has_obj_like_names, self._has_fn_like_names = False, False
-        obj_like_names, fn_like_names = [], []
-        for k, v in self._macros.items():
-            macro = _D2M(v)
-            if not expand_const and macro.get_is_const():
-                continue
-            if macro.args is None:
-                obj_like_names.append(k)
-            else:
-                fn_like_names.append(k)
-        if obj_like_names:
-            kwargs["names_obj"] = obj_like_names
+        if self.obj_like:
+            kwargs["names_obj"] = sorted(self.obj_like)
             names_re_a.append(r"""(?P<name> \b(?:\L<names_obj>)\b )""")
-            self._has_obj_like_names = True
-        if fn_like_names:
-            kwargs["names_func"] = fn_like_names
+        if self.fn_like:
+            kwargs["names_func"] = sorted(self.fn_like)
             names_re_a.append(r"""
                 (?P<name> \b(?:\L<names_func>)\b )
                 (?P<args>(?P<spc>\s*+)\((?P<list>(?&TOKEN)*+)\))""" + re_token)
-            self._has_fn_like_names = True
-        del obj_like_names, fn_like_names # There can be many, so free up memory
+        return (regex.compile(" | ".join(names_re_a), re_flags, **kwargs)  # type: ignore # **kwargs
+                if kwargs else None)
 
-        if not self._has_obj_like_names and not self._has_fn_like_names:
+class MacroExpander:
+    expansion_log: ExpansionLog  # top-level expansions in the order of offsets
+    _macros: dict[str, MacroParts]
+    _cur_expand_entry: dict[str, set[str]]
+
+    # Macro expansion.
+    #  - https://en.wikipedia.org/wiki/C_preprocessor#Order_of_expansion
+    #  - https://stackoverflow.com/questions/45375238/c-preprocessor-macro-expansion
+    #  - https://gcc.gnu.org/onlinedocs/cpp/Argument-Prescan.html
+    def expand(self, txt: str, macros: 'dict[str, Definition] | MacroTable', expand_const: bool = False, # type: ignore[name-defined] # circular dependency for Definition
+               policy: ExpandPolicy = None) -> str:
+        """Expand macros in txt. Pass a MacroTable to reuse it across files,
+           expand_const and policy are ignored in that case."""
+        self.expansion_log = ExpansionLog()
+        if not macros:
             return txt
+        table = macros if isinstance(macros, MacroTable) else MacroTable(macros, expand_const, policy)
+        if table.names_reg is None:
+            return txt
+        self._names_reg = table.names_reg
+        self._has_obj_like_names, self._has_fn_like_names = bool(table.obj_like), bool(table.fn_like)
+        self._start(table)
+        ret = self._expand_statements(txt)
+        del self._names_reg
+        self._finish()
+        return ret
+
+    def expand_tokens(self, txt: str, macros: 'dict[str, Definition] | MacroTable', expand_const: bool = False, # type: ignore[name-defined] # circular dependency for Definition
+                      policy: ExpandPolicy = None) -> tuple[str, TokenList]:
+        """Expand macros in txt working on fat tokens. Return the expanded text and its
+           top-level tokens, as TokenList.fromText() would make them, with orig_range set.
+           Blocks are only looked into if they have a macro name in them."""
+        self.expansion_log = ExpansionLog()
+        table = macros if isinstance(macros, MacroTable) else MacroTable(macros, expand_const, policy)
+        tokens = TokenList([])
+        if not table.names:
+            for token in TokenList.xFromText(txt, base_offset=0):
+                token.orig_range = token.range
+                tokens.append(token)
+            return txt, tokens
+        self._start(table)
+        self._spliced = True  # the tokens are the same as of the expanded text
+        # Nested expansions go through the tokens as well
+        self._expand_fragment = self._expand_fragment_tokens  # type: ignore[method-assign]
+        ret = self._expand_range(txt, 0, len(txt), tokens)
+        del self._expand_fragment
+        if not self._spliced:
+            tokens = TokenList.fromText(ret, base_offset=0)
+            for token in tokens:
+                token.orig_range = self.expansion_log.ranges.to_orig_span(token.range)
+        self._finish()
+        return ret, tokens
+
+    def _start(self, table: MacroTable) -> None:
+        self._macros = table.macros
+        self._table = table
+        self._cache = table.cache
+        self._cur_expand_entry = {}
+        self._edges: list[tuple[str, str]] = []  # (caller, callee) entered since the last top-level expansion
+        self._warnings = 0  # expansions that logged a warning are not cached
+        self._stats = table.stats
+        # Expansion of a macro use, profiled or not. Picked once, so there's no cost when not
+        # profiling.
+        self._expand_obj_like_use: Callable[[regex.Match, int], str]
+        self._expand_fn_like_use: Callable[[regex.Match, int], str]
+        if self._stats is not None:
+            self._expand_obj_like_use = self.__profiled(MacroExpander._expand_obj_like)
+            self._expand_fn_like_use = self.__profiled(MacroExpander._expand_fn_like)
+        else:
+            self._expand_obj_like_use = self._expand_obj_like
+            self._expand_fn_like_use = self._expand_fn_like
 
-        self._names_reg = regex.compile(" | ".join(names_re_a), re_flags, **kwargs)  # type: ignore # **kwargs
         self._recurse_in_use: set[str] = set()  # recursion control
         self._owner_stack: list[str] = []       # stack of current expansion "owning" scopes
         self._expanding_stack: list[str] = []   # stack of current expansion levels
@@ -83,16 +608,49 @@ class MacroExpander:
         # Then, when the contents of "CAT" are expanded with arguments substituted, the _owner_stack
         # is set to "CAT" as well.
 
-        ret = self._expand_fragment(txt)
-        del self._macros, self._cur_expand_entry # delete temporaries
-        return ret
+    def _finish(self) -> None:
+        del self._macros, self._table, self._cache, self._cur_expand_entry, self._edges # delete temporaries
+        del self._expand_obj_like_use, self._expand_fn_like_use
 
-    def __expand_enter(self, name: str) -> None:
-        self._expanding_stack.append(name)
-        parent = self._owner_stack[-1] if self._owner_stack else ""
+    def __count_replayed(self, entry: ExpansionResult) -> None:
+        # Nested expansions taken from a stored result count as done
+        for _, callee in entry[1]:
+            cast(MacroStats, self._stats).get_stat(callee).count += 1
+
+    def __profiled(self, expand: Callable[['MacroExpander', regex.Match, int], str]
+                   ) -> Callable[[regex.Match, int], str]:
+        stats = cast(MacroStats, self._stats)
+        def _expand(match: regex.Match, base_offset: int = 0) -> str:
+            depth = len(self._expanding_stack) + 1
+            start = time.perf_counter()
+            ret = expand(self, match, base_offset)
+            stat = stats.get_stat(match["name"])
+            stat.time += time.perf_counter() - start
+            stat.count += 1
+            stat.out_bytes += len(ret)
+            stat.max_depth = max(stat.max_depth, depth)
+            return ret
+        return _expand
+
+    @property
+    def insert_list(self) -> InsertList:
+        """The ranges of the expansions, made on access"""
+        return [self.expansion_log.ranges.insert_point(k) for k in range(len(self.expansion_log))]
+
+    @property
+    def expand_list(self) -> list[Expansions]:
+        """The expansions, made on access"""
+        return list(self.expansion_log)
+
+    def __add_edge(self, parent: str, name: str) -> None:
         if parent not in self._cur_expand_entry:
             self._cur_expand_entry[parent] = set()
         self._cur_expand_entry[parent].add(name)
+        self._edges.append((parent, name))
+
+    def __expand_enter(self, name: str) -> None:
+        self._expanding_stack.append(name)
+        self.__add_edge(self._owner_stack[-1] if self._owner_stack else "", name)
         DEBUG4(None, lambda: f"Expanding macro {' => '.join(self._owner_stack)} => {name}")
 
     def __expand_leave(self, replacement: str, match: regex.Match, base_offset) -> str:
@@ -102,29 +660,137 @@ class MacroExpander:
             delta = len(replacement) - len(match[0])
             range_orig = (match.start() + base_offset, match.end() + base_offset)
             range_new = (self._expand_offset + range_orig[0], self._expand_offset + range_orig[1] + delta)
-            ins = InsertPoint(range_orig, range_new, delta)
-            self.insert_list.append(ins)
-            self.expand_list.append(Expansions(ins, self._cur_expand_entry))
+            self.expansion_log.append(range_orig, range_new, self._cur_expand_entry)
             self._expand_offset += delta
             self._cur_expand_entry = {}
+            self._edges = []
         return replacement
 
+    def __expand_cached(self, name: str, args: str | None, compute: Callable[[], str]) -> str:
+        # The result only depends on the macro, the argument text and the names blocked from
+        # expansion. Expansion edges from the current owner are stored relative to it.
+        parent = self._owner_stack[-1] if self._owner_stack else ""
+        key = (name, args, frozenset(self._recurse_in_use))
+        if (entry := self._cache.get(key)) is not None:
+            for caller, callee in entry[1]:
+                self.__add_edge(parent if caller is None else caller, callee)
+            if self._stats is not None:
+                self.__count_replayed(entry)
+            return entry[0]
+        edges_start, warnings = len(self._edges), self._warnings
+        replacement = compute()
+        if self._warnings == warnings:
+            self._cache.put(key, (replacement, tuple(
+                (None if caller == parent else caller, callee)
+                for caller, callee in self._edges[edges_start:])))
+        return replacement
+
+    def _expand_statements(self, txt: str) -> str:
+        # Run the matcher only over the top-level statements that have a macro name in them
+        parts: list[str] = []
+        for start, end in top_statements(txt):
+            if self._table.names.isdisjoint(reg_word.findall(txt, start, end)):
+                parts.append(txt[start:end])
+            else:
+                parts.append(self._expand_fragment(txt[start:end], start))
+        return "".join(parts)
+
     def _expand_fragment(self, txt: str, base_offset: int = 0) -> str:
         return self._names_reg.sub(
-            lambda match: self._expand_fn_like(match, base_offset + base_offset) \
+            lambda match: self._expand_fn_like_use(match, base_offset) \
                                 if self._has_fn_like_names and match["args"] else \
-                          self._expand_obj_like(match, base_offset + base_offset) \
+                          self._expand_obj_like_use(match, base_offset) \
                                 if self._has_obj_like_names and match["name"] else \
                           match[0],
             txt)
 
+    def _expand_fragment_tokens(self, txt: str, base_offset: int = 0) -> str:
+        return self._expand_range(txt, 0, len(txt), base_offset=base_offset)
+
+    def _expand_range(self, txt: str, start: int, end: int, tokens: TokenList | None = None,
+                      base_offset: int = 0, in_file: bool = True) -> str:
+        """Expand macros in txt[start:end] token by token and blocks with macro names in them
+           recursively. If tokens is given, collect the top-level tokens of the result."""
+        names, fn_like = self._table.names, self._table.fn_like
+        in_file = in_file and not self._expanding_stack  # the text of the file, not of a macro
+        matches = list(reg_token.finditer(txt, start, end))
+        parts: list[str] = []
+        pos, out_pos, i = start, 0, 0
+        while i < len(matches):
+            match = matches[i]
+            i += 1
+            value = match[0]
+            if match.start() != pos:
+                parts.append(txt[pos:match.start()])  # not a token
+                out_pos += match.start() - pos
+            pos = match.end()
+            use: _TokenMatch | None = None
+            if value[0] in _ident_start and value in names:
+                if value not in fn_like:
+                    use = _TokenMatch(txt, {0: match.span(), "name": match.span()})
+                else:
+                    j = i
+                    while j < len(matches) and matches[j][0][0] in " \t\r\n":
+                        j += 1
+                    if j < len(matches) and matches[j][0][0] == "(":
+                        args = matches[j]
+                        use = _TokenMatch(txt, {0: (match.start(), args.end()), "name": match.span(),
+                                                "args": (match.end(), args.end()),
+                                                "spc": (match.end(), args.start()),
+                                                "list": (args.start() + 1, args.end() - 1)})
+                        i, pos = j + 1, args.end()
+            if use is not None:
+                value = (self._expand_fn_like_use(cast(regex.Match, use), base_offset) if "args" in use._spans
+                         else self._expand_obj_like_use(cast(regex.Match, use), base_offset))
+                if in_file and self._spliced:
+                    self._check_splice(value, parts[-1][-1:] if parts else txt[start - 1:start],
+                                       txt[pos:pos + 1])
+                if tokens is not None:
+                    for token in reg_token.finditer(value):
+                        tokens.append(Token(len(tokens), rangeShift(token.span(), out_pos), token[0],
+                                            orig_range=(use.start(), use.end())))
+            else:
+                if value[0] in "{([" and len(value) > 2 and not names.isdisjoint(
+                        reg_word.findall(txt, match.start() + 1, match.end() - 1)):
+                    value = value[0] + self._expand_range(txt, match.start() + 1, match.end() - 1,
+                                                          base_offset=base_offset,
+                                                          in_file=in_file) + value[-1]
+                if tokens is not None:
+                    tokens.append(Token(len(tokens), (out_pos, out_pos + len(value)), value,
+                                        orig_range=match.span()))
+            parts.append(value)
+            out_pos += len(value)
+        if pos < end:
+            parts.append(txt[pos:end])
+        return "".join(parts)
+
+    def _check_splice(self, replacement: str, before: str, after: str) -> None:
+        # The tokens of the text with a replacement are the tokens of the text around it and of
+        # the replacement if the replacement is whole tokens and doesn't join with the neighbours
+        if (not _whole_tokens(replacement) or
+                (_glues(before, replacement[:1]) or _glues(replacement[-1:], after) if replacement
+                 else _glues(before, after))):
+            self._spliced = False
+
     def _expand_obj_like(self, match: regex.Match, base_offset: int = 0) -> str:
         name = match["name"]
         self.__expand_enter(name)
-        if name in self._recurse_in_use:
+        if name in self._recurse_in_use or name in self._table.opaque:
             return self.__expand_leave(match[0], match, base_offset)
+        if ((entry := self._table.preexpanded.get(name)) is not None and
+                self._recurse_in_use.isdisjoint(self._table.graph.closure(name))):
+            for caller, callee in entry[1]:
+                self.__add_edge(cast(str, caller), callee)
+            if self._stats is not None:
+                self.__count_replayed(entry)
+            return self.__expand_leave(entry[0], match, base_offset)
+        return self.__expand_leave(
+            self.__expand_cached(name, None, lambda: self._replace_obj_like(name, base_offset)),
+            match, base_offset)
+
+    def _replace_obj_like(self, name: str, base_offset: int) -> str:
         if not _D2M(self._macros[name]).body:
-            return self.__expand_leave("", match, base_offset)
+            return ""
 
         self._recurse_in_use.add(name)
         self._owner_stack.append(name)
@@ -133,18 +799,34 @@ class MacroExpander:
         self._owner_stack.pop()
         self._recurse_in_use.remove(name)
 
-        return self.__expand_leave(replacement, match, base_offset)
+        return replacement
 
     def _expand_fn_like(self, match: regex.Match, base_offset: int = 0) -> str:
         name = match["name"]
         self.__expand_enter(name)
         if name in self._recurse_in_use:
             return self.__expand_leave(match[0], match, base_offset)
+        return self.__expand_leave(
+            self.__expand_cached(name, match["list"],
+                                 lambda: self._replace_fn_like(match, base_offset)),
+            match, base_offset)
+
+    def _replace_opaque(self, match: regex.Match, base_offset: int) -> str:
+        # Keep the macro call but expand its arguments as they still can use other macros
+        return (match["name"] + match["spc"] + "(" +
+                self._expand_fragment(match["list"], base_offset + match.start("list")) + ")")
+
+    def _replace_fn_like(self, match: regex.Match, base_offset: int) -> str:
+        name = match["name"]
+        if name in self._table.opaque:
+            return self._replace_opaque(match, base_offset)
         macro = _D2M(self._macros[name])
         if not macro.body:
-            return self.__expand_leave("", match, base_offset)
+            return ""
 
         # Parse args
+        if self._stats is not None:
+            args_start = time.perf_counter()
         args_val: list[TokenList] = [TokenList([])]
         for token_arg in TokenList.xFromText(match["list"],
                                              base_offset=base_offset + match.start("list")):
@@ -159,41 +841,39 @@ class MacroExpander:
                     break
                 # if va_args, continue appending to the last list
             args_val[-1].append(token_arg)
+        if macro.is_va_args and len(args_val) == len(macro.args) - 1:  # type: ignore # macro has args
+            args_val.append(TokenList([]))  # empty variadic arguments
+        if self._stats is not None:
+            self._stats.get_stat(name).args_time += time.perf_counter() - args_start
         if len(args_val) < len(macro.args):  # type: ignore # macro has args
             Log.macro_expand(scope_file().locationStr(base_offset + match.start()),
                   f"macro {name}: got only {len(args_val)} arguments, expected {len(macro.args)}")   # type: ignore # macro has args
-            return self.__expand_leave(match[0], match, base_offset)
+            self._warnings += 1
+            return match[0]
 
         replacement = macro.body.value  # type: ignore # match is not None
 
         if macro.args:  # Can be an empty list
-            args_dict = {k.value: Token(0, v.range(), "".join(v.strings()).strip())
-                         for k, v in zip(macro.args, args_val)}
+            args_raw = ["".join(v.strings()).strip() for v in args_val]
 
             # Calculate expanded arguments
-            args_dict_expanded = {k:
-                Token(0, v.range, self._expand_fragment(v.value, base_offset+v.range[0])) \
-                    for k, v in args_dict.items()}
-
-            # Replace operators # and ## and arguments
-            # TODO: protect from expanding in comments and strings
-            reg_macro_subst = regex.compile(r"""
-                (?P<h> \#\s*+ (?P<n>\w++) ) |
-                (?P<hh> (?P<n>\w++)(?>\s*+(\#\#)\s*+(?P<n>\w++))++) |
-                (?P<n>\b(?:\L<names>)\b)
-            """, re_flags, names=args_dict.keys())
-
-            def _concat_hh(match: regex.Match) -> str:
-                return "".join(((args_dict[name].value if name in args_dict else name) \
-                        for name in match.capturesdict()["n"]))
-            def _arg_c_escape(name: str) -> str:
-                return '"'+c_string_escape(args_dict[name].value)+'"' if name in args_dict else '""'
-
-            replacement = reg_macro_subst.sub(
-                lambda match: _arg_c_escape(match["n"]) if match["h"] else \
-                              _concat_hh(match) if match["hh"] else \
-                              args_dict_expanded[match["n"]].value,
-                replacement)
+            args_expanded = [self._expand_fragment(raw, base_offset+v.range()[0] if v else base_offset)
+                             for raw, v in zip(args_raw, args_val)]
+
+            # Substitute the arguments and apply the # and ## operators
+            parts: list[str] = []
+            for kind, val in macro.get_template():
+                if kind == "t":
+                    parts.append(val)
+                elif kind == "a":
+                    parts.append(args_expanded[val])
+                elif kind == "s":
+                    parts.append('"' + c_string_escape(args_raw[val]) + '"')
+                elif kind == "p":
+                    parts.append("".join(args_raw[x] if isinstance(x, int) else x for x in val))
+                elif args_raw[val[1]]:  # "c"
+                    parts.append(val[0] + args_expanded[val[1]])
+            replacement = "".join(parts)
 
         # Another round of global replacement
         self._recurse_in_use.add(name)
@@ -202,4 +882,4 @@ class MacroExpander:
         self._owner_stack.pop()
         self._recurse_in_use.remove(name)
 
-        return self.__expand_leave(replacement, match, base_offset)
+        return replacement
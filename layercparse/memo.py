@@ -0,0 +1,93 @@
+# Memo of per-function parse products.
+# Entries are keyed by a hash of the text they are computed from and the version of the tables
+# they depend on, so identical function bodies are analysed once, even across runs.
+
+import os, hashlib, pickle
+from collections import OrderedDict
+
+from .internal import *
+from . import cache
+
+def text_hash(txt: str) -> bytes:
+    return hashlib.sha1(txt.encode()).digest()
+
+def tables_version(*tables: Iterable[Any]) -> str:
+    """Version of lookup tables: changes when the contents change."""
+    h = hashlib.sha1()
+    for table in tables:
+        for item in sorted(table):
+            h.update(repr(item).encode())
+            h.update(b"\0")
+        h.update(b"\1")
+    return h.hexdigest()[:16]
+
+MemoKey: TypeAlias = tuple[str, bytes, str]  # (product, text hash, tables version)
+
+class FunctionMemo:
+    """LRU memo of per-function parse products"""
+    maxsize: int
+    hits: int
+    misses: int
+    _entries: OrderedDict[MemoKey, Any]
+    _new: dict[MemoKey, Any]  # entries added since the last take_new()
+
+    def __init__(self, maxsize: int = 65536):
+        self.maxsize = maxsize
+        self.hits = self.misses = 0
+        self._entries = OrderedDict()
+        self._new = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _put(self, key: MemoKey, value: Any) -> None:
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def get(self, product: str, txt: str, compute: Callable[[], Any], version: str = "") -> Any:
+        """Get the product computed from txt or compute and remember it."""
+        key = (product, text_hash(txt), version)
+        if key in self._entries:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+        self.misses += 1
+        value = compute()
+        self._put(key, value)
+        self._new[key] = value
+        return value
+
+    def take_new(self) -> dict[MemoKey, Any]:
+        """Return entries added since the last call, e.g. to send them from a worker process."""
+        ret, self._new = self._new, {}
+        return ret
+
+    def update(self, entries: dict[MemoKey, Any]) -> None:
+        for key, value in entries.items():
+            if key not in self._entries:
+                self._new[key] = value
+            self._put(key, value)
+
+    def load(self, name: str) -> bool:
+        """Load entries from the parse cache."""
+        if not (path := cache.getcachepath(name)):
+            return False
+        try:
+            with open(path, "rb") as f:
+                entries = pickle.load(f)
+        except (FileNotFoundError, pickle.UnpicklingError, EOFError):
+            return False
+        for key, value in entries.items():
+            self._put(key, value)
+        return True
+
+    def save(self, name: str) -> None:
+        """Save entries to the parse cache."""
+        if not (path := cache.getcachepath(name)):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            pickle.dump(dict(self._entries), f)
+        self._new = {}
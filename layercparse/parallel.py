@@ -0,0 +1,132 @@
+# Worker pools for scanning: the number of worker processes, scheduling of tasks by their
+# estimated cost and the utilisation of the workers.
+
+import os, time, math, signal, multiprocessing
+from dataclasses import dataclass, field
+
+from .internal import *
+
+def _cgroup_cpu_quota() -> float | None:
+    """The CPU quota of the cgroup in CPUs or None if there is no limit"""
+    try:  # cgroup v2
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()[:2]
+        return None if quota == "max" else int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    try:  # cgroup v1
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+            quota_us = int(f.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+            period_us = int(f.read())
+        return quota_us / period_us if quota_us > 0 and period_us > 0 else None
+    except (OSError, ValueError):
+        return None
+
+def available_cpus() -> int:
+    """CPUs this process may use: the affinity mask limited by the cgroup CPU quota"""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:  # not on Linux
+        cpus = os.cpu_count() or 1
+    if quota := _cgroup_cpu_quota():
+        cpus = min(cpus, math.ceil(quota))
+    return max(1, cpus)
+
+def resolve_jobs(jobs: int | None) -> int:
+    """Number of worker processes: None or 0 - all available CPUs, negative - all but that many"""
+    if not jobs:
+        return available_cpus()
+    return max(1, jobs if jobs > 0 else available_cpus() + jobs)
+
+@dataclass
+class WorkerStats:
+    """Utilisation of the worker processes of a pool"""
+    name: str
+    jobs: int = 0
+    wall: float = 0.0
+    busy: dict[int, float] = field(default_factory=dict)  # pid -> seconds spent in tasks
+    tasks: dict[int, int] = field(default_factory=dict)  # pid -> number of tasks
+    chunks: int = 0
+
+    def add(self, pid: int, busy: float, tasks: int) -> None:
+        self.busy[pid] = self.busy.get(pid, 0.0) + busy
+        self.tasks[pid] = self.tasks.get(pid, 0) + tasks
+        self.chunks += 1
+
+    def utilisation(self) -> float:
+        """Share of the workers' time spent in tasks"""
+        return sum(self.busy.values()) / (self.wall * self.jobs) if self.wall and self.jobs else 0.0
+
+    def report(self) -> str:
+        lines = [f"{self.name}: {self.jobs} workers, {sum(self.tasks.values())} tasks in "
+                 f"{self.chunks} chunks, {self.wall:.2f} s, utilisation {self.utilisation():.0%}"]
+        lines.extend(f"  worker {pid}: {self.tasks[pid]:6} tasks, busy {busy:8.2f} s "
+                     f"({busy / self.wall if self.wall else 0:.0%})"
+                     for pid, busy in sorted(self.busy.items(), key=lambda item: -item[1]))
+        return "\n".join(lines)
+
+def _chunks(costs: list[int], jobs: int) -> list[list[int]]:
+    """Task indexes in chunks, largest tasks first. A chunk costs about 1/8 of a worker's share,
+       so that small tasks travel together and the last chunks are small enough to even out
+       the workers."""
+    costs = [max(1, cost) for cost in costs]  # a task costs something even if it's empty
+    order = sorted(range(len(costs)), key=lambda i: -costs[i])
+    target = max(1, sum(costs) // (jobs * 8))
+    ret: list[list[int]] = []
+    chunk: list[int] = []
+    chunk_cost = 0
+    for i in order:
+        chunk.append(i)
+        chunk_cost += costs[i]
+        if chunk_cost >= target:
+            ret.append(chunk)
+            chunk, chunk_cost = [], 0
+    if chunk:
+        ret.append(chunk)
+    return ret
+
+def _run_chunk(func_chunk: tuple[Callable[..., Any], list[tuple[int, tuple]]]
+               ) -> tuple[int, float, list[tuple[int, Any]]]:
+    func, chunk = func_chunk
+    start = time.perf_counter()
+    ret = [(i, func(*args)) for i, args in chunk]
+    return (os.getpid(), time.perf_counter() - start, ret)
+
+def run_tasks(func: Callable[..., Any], tasks: list[tuple], costs: list[int] | None = None,
+              jobs: int | None = None, stats: WorkerStats | None = None,
+              ordered = True) -> Iterator[Any]:
+    """Run func(*task) for the tasks in worker processes and yield the results in the order of
+       the tasks. The tasks are started in the order of their estimated costs, largest first.
+       The worker processes are forked, so they inherit the state of the module globals.
+       Keeping the order costs time and memory: a small task early in the order is started
+       late, and the results finished before it wait for it. With ordered=False, the results
+       are yielded as they are finished."""
+    if not tasks:
+        return
+    init_multithreading()
+    jobs = min(resolve_jobs(jobs), len(tasks))
+    chunks = _chunks(costs if costs is not None else [1] * len(tasks), jobs)
+    if stats is not None:
+        stats.jobs = max(stats.jobs, jobs)
+    start = time.perf_counter()
+    pending: dict[int, Any] = {}
+    next_i = 0
+    with multiprocessing.Pool(processes=jobs,
+                              initializer=signal.signal,
+                              initargs=(signal.SIGINT, signal.SIG_IGN)) as pool:
+        for pid, busy, results in pool.imap_unordered(
+                    _run_chunk, ((func, [(i, tasks[i]) for i in chunk]) for chunk in chunks)):
+            if stats is not None:
+                stats.add(pid, busy, len(results))
+            if not ordered:
+                for _, res in results:
+                    yield res
+                continue
+            pending.update(results)
+            # Results are merged in the order of tasks, as they would be without workers
+            while next_i in pending:
+                yield pending.pop(next_i)
+                next_i += 1
+    if stats is not None:
+        stats.wall += time.perf_counter() - start
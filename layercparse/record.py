@@ -14,7 +14,7 @@ class RecordKind(enum.Enum):
     UNION = enum.auto()
     ENUM = enum.auto()
 
-@dataclass
+@dataclass(slots=True)
 class RecordParts:
     recordKind: RecordKind
     name: Token
@@ -21,6 +21,8 @@ _globals: Codebase
 _args: argparse.Namespace
 
 _color: bool = False
+_jobs: int | None = None  # number of worker processes, see resolve_jobs()
+_worker_stats: bool = False
 
 class Color(enum.Enum):
     NORM = ""
@@ -502,6 +504,18 @@ full: module, file, exact location's line, name, kind, code snippet
                        default=False,
                        help="Enable ANSI color output (default: no)")
 
+    group = argparser.add_argument_group(title="Profiling")
+    group.add_argument(      "--macro-stats", nargs="?", type=int, const=30, metavar="N",
+                       help="Profile macro expansion and report the N most expensive macros "
+                            "(default: 30)")
+    group.add_argument(      "--worker-stats", action="store_true",
+                       help="Report the utilisation of the worker processes")
+
+    group = argparser.add_argument_group(title="Parallelism")
+    group.add_argument("-j", "--jobs", type=int, metavar="N",
+                       help="Number of worker processes. Negative: all available CPUs but N "
+                            "(default: all CPUs available to the process)")
+
     group = argparser.add_argument_group(title="Cache control")
     group.add_argument(      "--cache", action=argparse.BooleanOptionalAction,
                        default=True,
@@ -630,28 +644,41 @@ def _hashstr(obj: Any, sz: int = 8) -> str:
     return hashlib.sha1(pickle.dumps((obj, _version_hash))).hexdigest()[:sz]
 
 @cache.cached(file=lambda files, *args, **kwargs: f"globals.{LAYERCPARSE_VERSION}." + _hashstr(files),
-              deps=lambda files, *args, **kwargs: files + _script_files)
-def load_globals(files: list[str], extraMacros: list[dict]) -> Codebase:
+              deps=lambda files, *args, **kwargs: files + _script_files,
+              suffix=lambda *args, profile_macros=False: ".profile.snap" if profile_macros else ".snap",
+              load=Snapshot.load, dump=Snapshot.save)  # type: ignore[arg-type]
+def load_globals(files: list[str], extraMacros: list[dict], profile_macros: bool = False) -> Codebase:
     ret = Codebase()
     for macro in extraMacros:
         ret.addMacro(**macro)
-    ret.scanFiles(files)
+    # A profiled scan uses the cache only for the macro pass, so the profile snapshot has stats
+    ret.scanFiles(files, profile_macros=profile_macros, jobs=_jobs, cache_files=True)
+    if _worker_stats:
+        print(*(stats.report() for stats in ret.worker_stats), sep="\n")
     return ret
 
 @cache.cached(file=lambda files, *args, **kwargs: f"access.{LAYERCPARSE_VERSION}." + _hashstr(files),
               deps=lambda files: files + _script_files)
 def load_access(files: list[str]) -> list[Access]:
     ret = []
-    for res in AccessCheck(_globals).xscan(
+    access = AccessCheck(_globals)
+    memo_name = f"funcmemo.{LAYERCPARSE_VERSION}." + _hashstr(None)
+    if cache.use_cache:
+        access.memo.load(memo_name)
+    for res in access.xscan(
                 # want_scan=want_scan if _args.from_ is not None or not _args.unmod else None,
                 on_macro_expand=on_macro_expand if _args.macros else None,
                 on_global_name=on_global_name if _args.calls else None,
                 # on_field_chain=on_field_chain,
-                on_field_access=on_field_access if _args.fields else None):
+                on_field_access=on_field_access if _args.fields else None,
+                jobs=_jobs, ordered=False):
         if _args.debug:
             print(*res, sep="\n")
-        for access in res:
-            ret.append(access)
+        ret.extend(res)
+    if _worker_stats and access.worker_stats is not None:
+        print(access.worker_stats.report())
+    if cache.use_cache:
+        access.memo.save(memo_name)
     return ret
 
 @cache.cached(file=lambda files, *args, **kwargs: f"stats.{LAYERCPARSE_VERSION}." + _hashstr(files),
@@ -678,7 +705,7 @@ def load_stats(files: list[str]) -> tuple[AccessSrc, AccessSrc]:
     return access_stats, access_stats_r
 
 def scan_sources_main(code_config_rel_path) -> int:
-    global _globals, _args, _color
+    global _globals, _args, _color, _jobs, _worker_stats
 
     commandline()
 
@@ -707,6 +734,11 @@ def scan_sources_main(code_config_rel_path) -> int:
             return 1
     _args.calls_only = _args.fields_only = _args.macros_only = None  # Clear for proper cache key
 
+    macro_stats = _args.macro_stats
+    _args.macro_stats = None  # Clear for proper cache key
+    _jobs, _worker_stats = _args.jobs, _args.worker_stats
+    _args.jobs = _args.worker_stats = None  # Clear for proper cache key
+
     code_config = load_code_config(_args.home, code_config_rel_path)
 
     modules = code_config["modules"]
@@ -729,7 +761,10 @@ def scan_sources_main(code_config_rel_path) -> int:
     cache.use_cache = _args.cache
     _args.cache = _args.clear_cache = None  # Clear for proper cache key
 
-    _globals = load_globals(files, code_config["extraMacros"])
+    _globals = load_globals(files, code_config["extraMacros"], profile_macros=macro_stats is not None)
+
+    if macro_stats is not None and _globals.macro_stats is not None:
+        print(_globals.macro_stats.report(macro_stats))
 
     if _args.metrics is not None:
         output_metrics()
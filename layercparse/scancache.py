@@ -0,0 +1,116 @@
+# Per-file scan results in the parse cache.
+# An entry is valid while the text of the file and the macros that its expansion can reach stay
+# the same, so after editing a file only that file and the files that use the changed macros
+# are scanned again.
+
+import os, hashlib, pickle
+
+from .internal import *
+from .workspace import *
+from .macroexpand import MacroTable, MacroGraph
+from . import cache, workspace
+
+# Bump when the format of the cached results changes
+version = 2
+
+def content_hash(txt: str) -> bytes:
+    return hashlib.sha1(txt.encode()).digest()
+
+def scan_settings() -> tuple[Any, ...]:
+    """Global settings that the scan results depend on"""
+    return (version, workspace.logLevel,
+            sorted((cat.name, cat.level, cat.enabled)
+                   for cat in vars(Log).values() if isinstance(cat, LogCategory)),
+            sorted((name, repr(module)) for name, module in workspace.modules.items()))
+
+class MacroFingerprints:
+    """Fingerprints of the macros that texts can expand with a macro table"""
+    table: MacroTable
+    _macros: dict[str, bytes]  # macro name -> fingerprint
+    _all_names: bytes | None   # fingerprint of the set of all macro names
+
+    def __init__(self, table: MacroTable):
+        self.table = table
+        self._macros = {}
+        self._all_names = None
+
+    def _macro(self, name: str) -> bytes:
+        if (ret := self._macros.get(name)) is None:
+            macro = self.table.macros[name].details
+            ret = self._macros[name] = hashlib.sha1(repr((
+                name,
+                [arg.value for arg in macro.args] if macro.args is not None else None,
+                macro.body.value if macro.body is not None else None,
+                macro.is_va_args,
+                name in self.table.names)).encode()).digest()
+        return ret
+
+    def of_text(self, txt: str) -> bytes:
+        """Fingerprint of the macros which names are in the text and the macros they reach"""
+        graph = self.table.graph
+        names = self.table.macros.keys() & set(reg_word.findall(txt))
+        reach = names.union(*(graph.closure(name) for name in names))
+        h = hashlib.sha1(repr((self.table.expand_const, self.table.policy)).encode())
+        if MacroGraph.PASTE in reach:
+            # Pasting can produce any name, so any macro can be reached
+            reach.discard(MacroGraph.PASTE)
+            if self._all_names is None:
+                self._all_names = hashlib.sha1("\0".join(sorted(self.table.macros)).encode()).digest()
+            h.update(self._all_names)
+        for name in sorted(reach):
+            h.update(self._macro(name))
+        return h.digest()
+
+class ScanCache:
+    """Per-file results of Codebase.scanFiles() in the parse cache. The results of the macro pass
+       are keyed by the file's content hash. The results of the definitions pass are keyed by the
+       content hash and the fingerprint of the macros the file can expand."""
+    fingerprints: MacroFingerprints | None
+    hits: int
+    misses: int
+    _settings: bytes
+    _keys: dict[tuple[str, str], bytes]  # (file name, suffix) -> key computed by get()
+
+    def __init__(self, table: MacroTable | None = None):
+        self.fingerprints = MacroFingerprints(table) if table is not None else None
+        self.hits = self.misses = 0
+        self._settings = hashlib.sha1(repr(scan_settings()).encode()).digest()
+        self._keys = {}
+
+    @staticmethod
+    def available() -> bool:
+        return cache.use_cache and bool(workspace.rootPath)
+
+    def _key(self, fname: str, suffix: str) -> bytes:
+        txt = file_content(fname)
+        h = hashlib.sha1(self._settings)
+        h.update(content_hash(txt))
+        if suffix == ".scan" and self.fingerprints is not None:
+            h.update(self.fingerprints.of_text(txt))
+        return h.digest()
+
+    def get(self, fname: str, suffix: str) -> Any:
+        """The cached result of the pass (".macros" or ".scan") for the file or None"""
+        try:
+            key = self._keys[(fname, suffix)] = self._key(fname, suffix)
+        except OSError:
+            return None
+        try:
+            with open(cache.getcachepath(fname, suffix), "rb") as f:
+                cached_key, result = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+            cached_key = None
+        if cached_key != key:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return result
+
+    def put(self, fname: str, suffix: str, result: Any) -> None:
+        """Remember the result computed for the file after get() missed"""
+        if (key := self._keys.pop((fname, suffix), None)) is None:
+            return
+        path = cache.getcachepath(fname, suffix)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            pickle.dump((key, result), f)
@@ -0,0 +1,277 @@
+# Binary snapshot of a scanned codebase. The file is memory-mapped and loading it unpickles only
+# the index: the files and the names, kinds, modules and locations of the definitions. The
+# details and comments of each definition, the expansion logs and the expanded texts are in
+# separate sections and are unpickled on first access.
+
+import os, io, gc, mmap, pickle, struct, zlib, functools
+
+from .internal import *
+from .workspace import *
+from .codebase import Codebase, Definition
+from . import filetext, LAYERCPARSE_VERSION
+
+# Bump when the layout of the snapshot changes
+version = 1
+
+_magic = b"LCPSNAP\0"
+_sections = ("files", "index", "details", "expansions", "texts")
+# magic, format version, LAYERCPARSE_VERSION, (offset, size) of each section
+_header = struct.Struct(f"<8sI32s{len(_sections) * 2}Q")
+
+Pos: TypeAlias = tuple[int, int]  # (offset, size) in a section
+
+class _Pending:
+    """Where the lazily loaded part of an object is"""
+    __slots__ = ("snapshot", "pos")
+    snapshot: 'Snapshot'
+    pos: Pos
+
+    def __init__(self, snapshot: 'Snapshot', pos: Pos):
+        self.snapshot, self.pos = snapshot, pos
+
+_definition_slots = {name: Definition.__dict__[name] for name in Definition.__slots__}
+
+def _lazy_slot(name: str) -> property:
+    slot = _definition_slots[name]
+    def get(self: 'LazyDefinition') -> Any:
+        self._load()
+        return slot.__get__(self)
+    def set(self: 'LazyDefinition', value: Any) -> None:
+        self._load()
+        slot.__set__(self, value)
+    return property(get, set)
+
+class LazyDefinition(Definition):
+    """Definition from a snapshot. Its details and comments are read on first access, then it
+       becomes a Definition."""
+    __slots__ = ()
+
+    details = _lazy_slot("details")  # type: ignore[assignment]
+    preComments = _lazy_slot("preComments")  # type: ignore[assignment]
+    postComments = _lazy_slot("postComments")  # type: ignore[assignment]
+
+    def _load(self) -> None:
+        pending = _definition_slots["details"].__get__(self)
+        details, pre, post = pending.snapshot.read("details", pending.pos)
+        self.__class__ = Definition  # type: ignore[assignment]
+        self.details, self.preComments, self.postComments = details, pre, post
+
+    def __repr__(self) -> str:
+        self._load()
+        return repr(self)
+
+    def __eq__(self, other: Any) -> bool:
+        self._load()
+        return self == other
+
+    def __reduce_ex__(self, protocol: Any) -> Any:
+        self._load()
+        return self.__reduce_ex__(protocol)
+
+_set_pending = _definition_slots["details"].__set__
+
+def _lazy_definition(snapshot: 'Snapshot', name: str, kind: str, scope: Scope, offset: int,
+                     module: str, is_private: bool | None, merged: bool, pos: Pos) -> LazyDefinition:
+    ret = LazyDefinition.__new__(LazyDefinition)
+    ret.name, ret.kind, ret.scope, ret.offset = name, kind, scope, offset
+    ret.module, ret.is_private, ret.merged = module, is_private, merged
+    _set_pending(ret, _Pending(snapshot, pos))
+    return ret
+
+class LazyExpansionLog(ExpansionLog):
+    """ExpansionLog from a snapshot. Its ranges are loaded with the file, the expansions are
+       read on first access, then it becomes an ExpansionLog."""
+    _pending: _Pending
+
+    def __getattr__(self, name: str) -> Any:
+        if name.startswith("__") or "_pending" not in self.__dict__:
+            raise AttributeError(name)
+        self._load()
+        return getattr(self, name)
+
+    def _load(self) -> None:
+        pending = self.__dict__.pop("_pending")
+        self.names, self.edge_start, self.edge_caller, self.edge_callee = \
+            pending.snapshot.read("expansions", pending.pos)
+        self._ids = {name: i for i, name in enumerate(self.names)}
+        self.__class__ = ExpansionLog  # type: ignore[assignment]
+
+    def __reduce_ex__(self, protocol: Any) -> Any:
+        self._load()
+        return self.__reduce_ex__(protocol)
+
+def _lazy_expansion_log(snapshot: 'Snapshot', ranges: SourceMap, pos: Pos) -> LazyExpansionLog:
+    ret = LazyExpansionLog.__new__(LazyExpansionLog)
+    ret.ranges, ret._pending = ranges, _Pending(snapshot, pos)
+    return ret
+
+# Functions that make the lazy objects, they get the snapshot from the reader
+_lazy_makers: dict[str, Callable[..., Any]] = {"_lazy_definition": _lazy_definition, "_lazy_expansion_log": _lazy_expansion_log}
+
+class _Pickler(pickle.Pickler):
+    """Pickles Files as their ids in the files section"""
+    def __init__(self, writer: '_Writer', section: str):
+        super().__init__(writer.buffers[section], protocol=pickle.HIGHEST_PROTOCOL)
+        self.writer = writer
+
+    def persistent_id(self, obj: Any) -> int | None:
+        return self.writer.file_id(obj) if isinstance(obj, File) else None
+
+class _IndexPickler(_Pickler):
+    """Pickles Definitions as LazyDefinitions, their details go to the details section"""
+    def reducer_override(self, obj: Any) -> Any:
+        return self.writer.reduce_definition(obj)
+
+class _FilesPickler(pickle.Pickler):
+    """Pickles ExpansionLogs as LazyExpansionLogs, the expansions go to the expansions section"""
+    def __init__(self, writer: '_Writer'):
+        super().__init__(writer.buffers["files"], protocol=pickle.HIGHEST_PROTOCOL)
+        self.writer = writer
+
+    def reducer_override(self, obj: Any) -> Any:
+        return self.writer.reduce_expansion_log(obj)
+
+class _Writer:
+    """Writes the sections of a snapshot"""
+    files: list[File]
+    buffers: dict[str, io.BytesIO]
+    _file_ids: dict[int, int]  # id(File) -> index in files
+
+    def __init__(self):
+        self.files, self._file_ids = [], {}
+        self.buffers = {name: io.BytesIO() for name in _sections}
+        self._details = _Pickler(self, "details")
+
+    def file_id(self, file: File) -> int:
+        if (ret := self._file_ids.get(id(file))) is None:
+            ret = self._file_ids[id(file)] = len(self.files)
+            self.files.append(file)
+        return ret
+
+    def _write(self, section: str, obj: Any, pickler: pickle.Pickler | None = None) -> Pos:
+        buf = self.buffers[section]
+        start = buf.tell()
+        if isinstance(obj, bytes):
+            buf.write(obj)
+        elif pickler is None:
+            buf.write(pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL))
+        else:
+            pickler.dump(obj)
+            pickler.clear_memo()
+        return (start, buf.tell() - start)
+
+    def reduce_definition(self, obj: Any) -> Any:
+        if isinstance(obj, LazyDefinition):
+            obj._load()
+        if type(obj) is not Definition:
+            return NotImplemented
+        pos = self._write("details", (obj.details, obj.preComments, obj.postComments),
+                          self._details)
+        return (_lazy_definition, (obj.name, obj.kind, obj.scope, obj.offset, obj.module,
+                                   obj.is_private, obj.merged, pos))
+
+    def reduce_expansion_log(self, obj: Any) -> Any:
+        if isinstance(obj, LazyExpansionLog):
+            obj._load()
+        if type(obj) is not ExpansionLog:
+            return NotImplemented
+        pos = self._write("expansions", (obj.names, obj.edge_start, obj.edge_caller, obj.edge_callee))
+        return (_lazy_expansion_log, (obj.ranges, pos))
+
+    def write(self, codebase: Codebase, path: str) -> None:
+        _IndexPickler(self, "index").dump(codebase)
+        texts: dict[tuple[str, int], Pos] = {}
+        for file in self.files:
+            if file.is_expanded and filetext.has_text(file):
+                texts[(file.name, file.textCrc)] = self._write(  # type: ignore[index] # textCrc is set
+                    "texts", zlib.compress(filetext.get_text(file).encode(), 1))
+        _FilesPickler(self).dump((self.files, texts))
+        offsets: list[int] = []
+        offset = _header.size
+        for name in _sections:
+            size = self.buffers[name].tell()
+            offsets += (offset, size)
+            offset += size
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(_header.pack(_magic, version, LAYERCPARSE_VERSION.encode(), *offsets))
+            for name in _sections:
+                f.write(self.buffers[name].getbuffer())
+        # Readers may have the old snapshot mapped, so it's replaced, not rewritten
+        os.replace(tmp, path)
+
+class _Reader(pickle.Unpickler):
+    def __init__(self, snapshot: 'Snapshot', data: Any):
+        super().__init__(io.BytesIO(data))
+        self.snapshot = snapshot
+
+    def persistent_load(self, pid: Any) -> Any:
+        return self.snapshot.files[pid]
+
+    def find_class(self, module: str, name: str) -> Any:
+        if module == __name__ and name in _lazy_makers:
+            return functools.partial(_lazy_makers[name], self.snapshot)
+        return super().find_class(module, name)
+
+class Snapshot:
+    """A memory-mapped snapshot file, see save() and load()"""
+    path: str
+    files: list[File]
+    codebase: Codebase
+    _mmap: mmap.mmap
+    _sections: dict[str, Pos]
+    _texts: dict[tuple[str, int], Pos]  # (file name, text crc) -> compressed expanded text
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._mmap) < _header.size:
+            raise ValueError(f"{path}: not a snapshot")
+        magic, format_version, lib_version, *offsets = _header.unpack_from(self._mmap)
+        if magic != _magic:
+            raise ValueError(f"{path}: not a snapshot")
+        lib_version = lib_version.rstrip(b"\0").decode()
+        if (format_version, lib_version) != (version, LAYERCPARSE_VERSION):
+            raise ValueError(f"{path}: snapshot version {format_version} of {lib_version}, "
+                             f"expected {version} of {LAYERCPARSE_VERSION}")
+        self._sections = {name: (offsets[i * 2], offsets[i * 2 + 1])
+                          for i, name in enumerate(_sections)}
+        # The objects of the index live as long as the codebase: collecting garbage while they
+        # are made only takes time, more than the unpickling itself on large codebases
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            self.files, self._texts = self.read("files", (0, self._sections["files"][1]))
+            self.codebase = self.read("index", (0, self._sections["index"][1]))
+        finally:
+            if gc_enabled:
+                gc.enable()
+        for file in self.files:
+            file.expander = self._expand_file_text
+
+    def read(self, section: str, pos: Pos) -> Any:
+        """Unpickle the object at the position in the section"""
+        start = self._sections[section][0] + pos[0]
+        return _Reader(self, memoryview(self._mmap)[start:start + pos[1]]).load()
+
+    def _expand_file_text(self, file: File) -> str:
+        if (pos := self._texts.get((file.name, file.textCrc))) is not None:  # type: ignore[arg-type]
+            start = self._sections["texts"][0] + pos[0]
+            return zlib.decompress(self._mmap[start:start + pos[1]]).decode()
+        return self.codebase._expand_file_text(file)
+
+    @staticmethod
+    def save(codebase: Codebase, path: str) -> None:
+        """Write the codebase to a snapshot file"""
+        _Writer().write(codebase, path)
+
+    @staticmethod
+    def load(path: str) -> Codebase | None:
+        """The codebase from a snapshot file or None if there is no valid snapshot of this
+           version"""
+        try:
+            return Snapshot(path).codebase
+        except (OSError, ValueError, EOFError, pickle.UnpicklingError) as e:
+            DEBUG(None, f"{path}: {e}")
+            return None
@@ -0,0 +1,425 @@
+# SQLite store of a scanned codebase and of the accesses found by AccessCheck.
+# Other tools query definitions and accesses by name, module, file, kind or privacy without
+# loading the whole codebase. Each definition is pickled in its own row, with its File as a
+# reference to the files table, so the line info and expansions of a file are stored once.
+
+import io, os, pickle, sqlite3, zlib
+from collections.abc import MutableMapping
+
+from .internal import *
+from .workspace import *
+from .ctoken import Token
+from .codebase import Codebase, Definition
+from .access import AccessEvent, AccessMacroExpand, AccessGlobalName, AccessFieldChain, AccessField
+from . import filetext
+
+# Bump when the schema or the format of the rows changes
+version = 1
+
+_tables = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY, name TEXT NOT NULL, module TEXT NOT NULL, data BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS texts (
+    name TEXT NOT NULL, crc INTEGER NOT NULL, data BLOB NOT NULL, PRIMARY KEY (name, crc));
+CREATE TABLE IF NOT EXISTS definitions (
+    id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,           -- type, field, name, static, macro or file_macro
+    key TEXT NOT NULL,            -- the record of a field, the file of a static name or macro
+    name TEXT NOT NULL,
+    defn_kind TEXT NOT NULL,      -- Definition.kind: function, record, variable, macro...
+    module TEXT NOT NULL,
+    is_private INTEGER,           -- NULL if not specified
+    restricted INTEGER NOT NULL,  -- also in types_restricted or names_restricted
+    file_id INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    line INTEGER NOT NULL,
+    col INTEGER NOT NULL,
+    data BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS typedefs (alias TEXT PRIMARY KEY, type TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS access (
+    id INTEGER PRIMARY KEY, kind TEXT NOT NULL, src TEXT NOT NULL, src_module TEXT NOT NULL,
+    file TEXT NOT NULL, offset INTEGER NOT NULL, line INTEGER NOT NULL, col INTEGER NOT NULL,
+    dst TEXT NOT NULL, owner TEXT NOT NULL);
+"""
+
+# Created after the rows are written, which is faster than updating them row by row
+_definition_indexes = """
+CREATE INDEX IF NOT EXISTS files_name ON files (name);
+CREATE INDEX IF NOT EXISTS definitions_key ON definitions (kind, key, name);
+CREATE INDEX IF NOT EXISTS definitions_name ON definitions (name);
+CREATE INDEX IF NOT EXISTS definitions_module ON definitions (module);
+CREATE INDEX IF NOT EXISTS definitions_file ON definitions (file_id);
+CREATE INDEX IF NOT EXISTS definitions_defn_kind ON definitions (defn_kind);
+CREATE INDEX IF NOT EXISTS definitions_private ON definitions (is_private);
+"""
+_access_indexes = """
+CREATE INDEX IF NOT EXISTS access_src ON access (src);
+CREATE INDEX IF NOT EXISTS access_src_module ON access (src_module);
+CREATE INDEX IF NOT EXISTS access_dst ON access (dst, owner);
+CREATE INDEX IF NOT EXISTS access_file ON access (file);
+CREATE INDEX IF NOT EXISTS access_kind ON access (kind);
+"""
+
+class AccessRow(NamedTuple):
+    """An access found in a function body, as stored in the access table"""
+    kind: str        # "macro", "call", "field" or "chain"
+    src: str         # the function
+    src_module: str
+    file: str
+    offset: int      # in the text of the file the function was scanned in
+    line: int
+    col: int
+    dst: str         # the macro, the global name, the field or the chain
+    owner: str       # the macro that expanded dst or "" for the function, the record of the field
+
+def access_rows(event: AccessEvent) -> list[AccessRow]:
+    """Rows for an event of AccessCheck. Use it as the on_... callbacks of AccessCheck.xscan(),
+       then the worker processes send back plain rows rather than events with definitions."""
+    src, file = event.src, event.src.scope.file
+
+    def row(kind: str, offset: int, dst: str, owner: str) -> AccessRow:
+        offset += src.scope.offset
+        return AccessRow(kind, src.name, src.module, file.name, offset,
+                         *file.offsetToLinePos(offset), dst, owner)
+
+    if isinstance(event, AccessMacroExpand):
+        return [row("macro", event.exps.at.range_new[0], callee, caller)
+                for caller, callees in sorted(event.exps.expansions.items())
+                for callee in sorted(callees)]
+    body = cast(Token, cast(Any, src.details).body).range[0]
+    if isinstance(event, AccessGlobalName):
+        return [row("call", body + event.range[0], event.dst, "")]
+    if isinstance(event, AccessField):
+        return [row("field", body + event.range[0], event.field, event.typename)]
+    if isinstance(event, AccessFieldChain):
+        return [row("chain", body + event.chain.range[0], str(event.chain), "")]
+    return []
+
+class _Pickler(pickle.Pickler):
+    """Pickles Files as their ids in the files table"""
+    files: dict[int, tuple[int, File]]  # id(File) -> (file id, File)
+    _buf: io.BytesIO
+
+    def __init__(self):
+        self._buf = io.BytesIO()
+        super().__init__(self._buf, pickle.HIGHEST_PROTOCOL)
+        self.files = {}
+
+    def file_id(self, file: File) -> int:
+        if (ret := self.files.get(id(file))) is None:
+            ret = self.files[id(file)] = (len(self.files) + 1, file)
+        return ret[0]
+
+    def persistent_id(self, obj: Any) -> int | None:
+        return self.file_id(obj) if isinstance(obj, File) else None
+
+    def dumps(self, obj: Any) -> bytes:
+        self._buf.seek(0)
+        self._buf.truncate()
+        self.clear_memo()
+        self.dump(obj)
+        return self._buf.getvalue()
+
+class _Unpickler(pickle.Unpickler):
+    def __init__(self, data: bytes, load_file: Callable[[int], File]):
+        super().__init__(io.BytesIO(data))
+        self._load_file = load_file
+
+    def persistent_load(self, pid: Any) -> File:
+        return self._load_file(pid)
+
+def _definition_items(codebase: Codebase) -> Iterator[tuple[str, str, str, Definition]]:
+    """(kind, key, name, definition) of everything the store keeps"""
+    for name, defn in codebase.types.items():
+        if defn.name == name:  # not an alias added by fill_typedefs()
+            yield ("type", "", name, defn)
+    for rec_name, fields in codebase.fields.items():
+        for name, defn in fields.items():
+            yield ("field", rec_name, name, defn)
+    for name, defn in codebase.names.items():
+        yield ("name", "", name, defn)
+    for fname, names in codebase.static_names.items():
+        for name, defn in names.items():
+            yield ("static", fname, name, defn)
+    for name, defn in codebase.macros.items():
+        yield ("macro", "", name, defn)
+    for fname, macros in codebase.file_macros.items():
+        for name, defn in macros.items():
+            yield ("file_macro", fname, name, defn)
+
+class CodebaseStore:
+    """A Codebase and access rows in an SQLite database.
+       save_codebase() and save_access() write, load() reads everything back,
+       codebase() makes a view that reads definitions as they are accessed, find() and access()
+       query by the indexed columns."""
+    path: str
+    _conn: sqlite3.Connection
+    _pid: int
+    _files: dict[int, File]  # file id -> File read from the store
+
+    def __init__(self, path: str):
+        self.path = path
+        self._connect()
+        self.conn.executescript(_tables)
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if row is None:
+            with self.conn:
+                self.conn.execute("INSERT INTO meta VALUES ('version', ?)", (str(version),))
+        elif row[0] != str(version):
+            raise ValueError(f"{path}: store version {row[0]}, expected {version}")
+        self._files = {}
+
+    def _connect(self) -> None:
+        self._conn, self._pid = sqlite3.connect(self.path), os.getpid()
+        self._conn.execute("PRAGMA journal_mode = WAL")  # readers don't wait for the writer
+        self._conn.execute("PRAGMA synchronous = NORMAL")
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        # A connection must not be used across fork(), forked workers open their own
+        if self._pid != os.getpid():
+            self._connect()
+        return self._conn
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def __enter__(self) -> 'CodebaseStore':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    ### Writing ###
+
+    def save_codebase(self, codebase: Codebase) -> None:
+        """Replace the contents of the store with the codebase, in one transaction.
+           The access rows are removed as well."""
+        pickler = _Pickler()
+        restricted = {"type": codebase.types_restricted, "name": codebase.names_restricted}
+        rows = []
+        for kind, key, name, defn in _definition_items(codebase):
+            offset = defn.scope.offset + defn.offset
+            rows.append((kind, key, name, defn.kind, defn.module,
+                         None if defn.is_private is None else int(defn.is_private),
+                         int(restricted.get(kind, {}).get(name) is defn),
+                         pickler.file_id(defn.scope.file), offset,
+                         *defn.scope.file.offsetToLinePos(offset), pickler.dumps(defn)))
+        texts = {(file.name, file.textCrc): file for _, file in pickler.files.values()
+                 if file.is_expanded and file.textCrc is not None}
+        with self.conn:
+            for table in ["files", "texts", "definitions", "typedefs", "access"]:
+                self.conn.execute(f"DELETE FROM {table}")
+            self.conn.executemany("INSERT INTO definitions VALUES (NULL, ?,?,?,?,?,?,?,?,?,?,?,?)",
+                                  rows)
+            self.conn.executemany("INSERT INTO files VALUES (?, ?, ?, ?)",
+                                  ((file_id, file.name, file.module, pickle.dumps(file))
+                                   for file_id, file in pickler.files.values()))
+            self.conn.executemany("INSERT INTO texts VALUES (?, ?, ?)",
+                                  ((name, crc, zlib.compress(filetext.get_text(file).encode()))
+                                   for (name, crc), file in texts.items()))
+            self.conn.executemany("INSERT INTO typedefs VALUES (?, ?)", codebase.typedefs.items())
+            self.conn.executescript(_definition_indexes)
+        self._files = {}
+
+    def save_access(self, results: Iterable[Iterable[AccessRow]], batch: int = 10000) -> int:
+        """Append the rows of access_rows() as they come from AccessCheck.xscan(), in transactions
+           of the batch size. Returns the number of rows."""
+        count = 0
+        rows: list[AccessRow] = []
+        for res in results:
+            rows.extend(res)
+            if len(rows) >= batch:
+                count += self._insert_access(rows)
+                rows = []
+        count += self._insert_access(rows)
+        with self.conn:
+            self.conn.executescript(_access_indexes)
+        return count
+
+    def _insert_access(self, rows: list[AccessRow]) -> int:
+        with self.conn:
+            self.conn.executemany("INSERT INTO access VALUES (NULL, ?,?,?,?,?,?,?,?,?)", rows)
+        return len(rows)
+
+    ### Reading ###
+
+    def _file(self, file_id: int) -> File:
+        if (ret := self._files.get(file_id)) is None:
+            data = self.conn.execute("SELECT data FROM files WHERE id = ?", (file_id,)).fetchone()[0]
+            ret = self._files[file_id] = pickle.loads(data)
+            ret.expander = self._text
+        return ret
+
+    def _text(self, file: File) -> str:
+        """The macro-expanded text of a file, see File.expander"""
+        row = self.conn.execute("SELECT data FROM texts WHERE name = ? AND crc = ?",
+                                (file.name, file.textCrc)).fetchone()
+        if row is None:
+            raise ValueError(f"{self.path}: no text of {file.name}")
+        return zlib.decompress(row[0]).decode()
+
+    def _load(self, data: bytes) -> Definition:
+        return _Unpickler(data, self._file).load()
+
+    def _select(self, columns: str, table: str, where: dict[str, Any],
+                order: str = "id") -> Iterator[tuple]:
+        conds, args = [], []
+        for column, value in where.items():
+            if value is None:
+                continue
+            if column == "is_private":
+                conds.append("is_private = 1" if value else "is_private IS NOT 1")
+            elif column == "file_id":
+                conds.append("file_id IN (SELECT id FROM files WHERE name = ?)")
+                args.append(value)
+            else:
+                conds.append(f"{column} = ?")
+                args.append(value)
+        sql = f"SELECT {columns} FROM {table}"
+        if conds:
+            sql += " WHERE " + " AND ".join(conds)
+        return self.conn.execute(f"{sql} ORDER BY {order}", args)
+
+    def find(self, name: str | None = None, module: str | None = None, file: str | None = None,
+             kind: str | None = None, defn_kind: str | None = None,
+             is_private: bool | None = None) -> Iterator[tuple[str, str, Definition]]:
+        """(kind, key, definition) of the definitions that match all given conditions.
+           kind is the collection (see Definitions), defn_kind is Definition.kind."""
+        for kind_, key, data in self._select("kind, key, data", "definitions", {
+                    "name": name, "module": module, "file_id": file, "kind": kind,
+                    "defn_kind": defn_kind, "is_private": is_private}):
+            yield kind_, key, self._load(data)
+
+    def access(self, kind: str | None = None, src: str | None = None,
+               src_module: str | None = None, file: str | None = None,
+               dst: str | None = None, owner: str | None = None) -> Iterator[AccessRow]:
+        """Access rows that match all given conditions"""
+        for row in self._select(", ".join(AccessRow._fields), "access", {
+                    "kind": kind, "src": src, "src_module": src_module, "file": file,
+                    "dst": dst, "owner": owner}):
+            yield AccessRow(*row)
+
+    def _names(self, kind: str, key: str, restricted: bool) -> dict[str, None]:
+        return dict.fromkeys(name for name, in self._select("name", "definitions", {
+            "kind": kind, "key": key, "restricted": 1 if restricted else None}))
+
+    def _definition(self, kind: str, key: str, name: str) -> Definition:
+        return self._load(next(self._select("data", "definitions",
+                                            {"kind": kind, "key": key, "name": name}))[0])
+
+    def _keys(self, kind: str) -> list[str]:
+        return [key for key, in self.conn.execute(
+            "SELECT key FROM definitions WHERE kind = ? GROUP BY key ORDER BY min(id)", (kind,))]
+
+    def load(self) -> Codebase:
+        """Read the whole codebase. Its provenance is not stored, so updateFiles() can't be used."""
+        ret = Codebase(typedefs=self.typedefs())
+        restricted = {"type": ret.types_restricted, "name": ret.names_restricted}
+        dicts: dict[str, dict[str, Definition]] = {
+            "type": ret.types, "name": ret.names, "macro": ret.macros}
+        nested: dict[str, dict[str, dict[str, Definition]]] = {
+            "field": ret.fields, "static": ret.static_names, "file_macro": ret.file_macros}
+        for kind, key, name, is_restricted, data in self.conn.execute(
+                "SELECT kind, key, name, restricted, data FROM definitions ORDER BY id"):
+            defn = self._load(data)
+            if kind in nested:
+                nested[kind].setdefault(key, {})[name] = defn
+            else:
+                dicts[kind][name] = defn
+            if is_restricted:
+                restricted[kind][name] = defn
+        ret.field_records = self.field_records()
+        return ret
+
+    def codebase(self) -> Codebase:
+        """A view that reads each definition when it's first accessed. Changes to it, e.g. by
+           finalize(), stay in memory."""
+        def view(defns: StoredDefinitions) -> dict[str, Definition]:
+            # Codebase uses its dicts of definitions only through the MutableMapping methods
+            return cast(dict[str, Definition], defns)
+        types, names = StoredDefinitions(self, "type"), StoredDefinitions(self, "name")
+        return Codebase(
+            types=view(types), types_restricted=view(types.restricted()),
+            fields={key: view(StoredDefinitions(self, "field", key)) for key in self._keys("field")},
+            field_records=self.field_records(),
+            names=view(names), names_restricted=view(names.restricted()),
+            static_names={key: view(StoredDefinitions(self, "static", key))
+                          for key in self._keys("static")},
+            typedefs=self.typedefs(),
+            macros=view(StoredDefinitions(self, "macro")),
+            file_macros={key: view(StoredDefinitions(self, "file_macro", key))
+                         for key in self._keys("file_macro")})
+
+    def typedefs(self) -> dict[str, str]:
+        return dict(self.conn.execute("SELECT alias, type FROM typedefs ORDER BY rowid"))
+
+    def field_records(self) -> dict[str, set[str]]:
+        ret: dict[str, set[str]] = {}
+        for name, key in self.conn.execute("SELECT name, key FROM definitions WHERE kind = 'field'"):
+            ret.setdefault(name, set()).add(key)
+        return ret
+
+class StoredDefinitions(MutableMapping[str, Definition]):
+    """Definitions of one kind and key in a CodebaseStore, read when they are first accessed.
+       Changes stay in memory."""
+    _store: CodebaseStore
+    _kind: str
+    _key: str
+    _restricted: bool
+    _names: dict[str, None] | None      # names in the store, in the order of the codebase
+    _loaded: dict[str, Definition]      # shared by the view of the restricted ones
+    _changed: dict[str, Definition | None]  # None if deleted
+
+    def __init__(self, store: CodebaseStore, kind: str, key: str = "", restricted: bool = False,
+                 loaded: dict[str, Definition] | None = None):
+        self._store, self._kind, self._key, self._restricted = store, kind, key, restricted
+        self._names = None
+        self._loaded = {} if loaded is None else loaded
+        self._changed = {}
+
+    def restricted(self) -> 'StoredDefinitions':
+        """The view of the definitions that are also in the restricted dict"""
+        return StoredDefinitions(self._store, self._kind, self._key, True, self._loaded)
+
+    def _stored(self) -> dict[str, None]:
+        if self._names is None:
+            self._names = self._store._names(self._kind, self._key, self._restricted)
+        return self._names
+
+    def __contains__(self, name: Any) -> bool:
+        if name in self._changed:
+            return self._changed[name] is not None
+        return name in self._stored()
+
+    def __getitem__(self, name: str) -> Definition:
+        if name in self._changed:
+            if (ret := self._changed[name]) is None:
+                raise KeyError(name)
+            return ret
+        if name not in self._stored():
+            raise KeyError(name)
+        if (ret := self._loaded.get(name)) is None:
+            ret = self._loaded[name] = self._store._definition(self._kind, self._key, name)
+        return ret
+
+    def __setitem__(self, name: str, defn: Definition) -> None:
+        self._changed[name] = defn
+
+    def __delitem__(self, name: str) -> None:
+        if name not in self:
+            raise KeyError(name)
+        self._changed[name] = None
+
+    def __iter__(self) -> Iterator[str]:
+        stored = self._stored()
+        for name in stored:
+            if self._changed.get(name, True) is not None:
+                yield name
+        for name, defn in self._changed.items():
+            if defn is not None and name not in stored:
+                yield name
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
@@ -15,7 +15,7 @@ def get_base_type_str(clean_txt: str, **kwargs) -> str:
     return get_base_type(TokenList(TokenList.xxFilterCode(TokenList.xFromText(
                 clean_txt, base_offset=0, **kwargs))))
 
-@dataclass
+@dataclass(slots=True)
 class Variable:
     name: Token
     typename: TokenList
@@ -1,11 +1,12 @@
 import enum
 import regex
 from dataclasses import dataclass, field
-from typing import Callable, IO
+from typing import Callable, IO, Sequence
 import itertools
 from glob import glob
 from os import path
-from bisect import bisect_left
+from bisect import bisect_left, bisect_right
+from array import array
 from io import StringIO
 
 from .internal import *
@@ -175,6 +176,183 @@ def fname_to_module(fname: str) -> str:
     return ""
 
 
+class SourceMap:
+    """Offset map between the original and the macro-expanded text of a file.
+       Every top-level expansion is a pair of ranges: the macro use in the original text and
+       its replacement in the expanded text. They are kept in packed integer arrays."""
+    orig_start: array
+    orig_end: array
+    new_start: array
+    new_end: array
+
+    def __init__(self, insertList: 'InsertList' = ()):  # type: ignore[assignment] # empty tuple
+        self.orig_start, self.orig_end = array("q"), array("q")
+        self.new_start, self.new_end = array("q"), array("q")
+        for ins in insertList:
+            self.orig_start.append(ins.range_orig[0])
+            self.orig_end.append(ins.range_orig[1])
+            self.new_start.append(ins.range_new[0])
+            self.new_end.append(ins.range_new[1])
+
+    def __len__(self) -> int:
+        return len(self.new_start)
+
+    def __eq__(self, other: Any) -> bool:
+        return isinstance(other, SourceMap) and self.tobytes() == other.tobytes()
+
+    def append(self, range_orig: 'Range', range_new: 'Range') -> None:
+        self.orig_start.append(range_orig[0])
+        self.orig_end.append(range_orig[1])
+        self.new_start.append(range_new[0])
+        self.new_end.append(range_new[1])
+
+    def insert_point(self, k: int) -> 'InsertPoint':
+        range_orig = (self.orig_start[k], self.orig_end[k])
+        range_new = (self.new_start[k], self.new_end[k])
+        return InsertPoint(range_orig, range_new,
+                           (range_new[1] - range_new[0]) - (range_orig[1] - range_orig[0]))
+
+    @staticmethod
+    def _map(offset: int, k: int, src_start: array, src_end: array, dst_start: array,
+             dst_end: array) -> int:
+        # k is the last expansion that starts at or before the offset
+        if k < 0:
+            return offset
+        if offset < src_end[k]:  # inside the expansion, map to its start
+            return dst_start[k]
+        return offset - src_end[k] + dst_end[k]
+
+    def to_orig(self, offset: int) -> int:
+        """Offset in the original text. Offsets inside an expansion map to the macro use."""
+        return self._map(offset, bisect_right(self.new_start, offset) - 1,
+                         self.new_start, self.new_end, self.orig_start, self.orig_end)
+
+    def to_expanded(self, offset: int) -> int:
+        """Offset in the expanded text. Offsets inside a macro use map to its replacement."""
+        return self._map(offset, bisect_right(self.orig_start, offset) - 1,
+                         self.orig_start, self.orig_end, self.new_start, self.new_end)
+
+    def _map_many(self, offsets: Sequence[int], src_start: array, src_end: array,
+                  dst_start: array, dst_end: array) -> array:
+        # One pass over the expansions in the order of the offsets
+        ret = array("q", offsets)
+        k, n = -1, len(src_start)
+        for i in sorted(range(len(offsets)), key=offsets.__getitem__):
+            offset = offsets[i]
+            while k + 1 < n and src_start[k + 1] <= offset:
+                k += 1
+            ret[i] = self._map(offset, k, src_start, src_end, dst_start, dst_end)
+        return ret
+
+    def to_orig_many(self, offsets: Sequence[int]) -> array:
+        """to_orig() of many offsets at once, in any order"""
+        return self._map_many(offsets, self.new_start, self.new_end, self.orig_start, self.orig_end)
+
+    def to_expanded_many(self, offsets: Sequence[int]) -> array:
+        """to_expanded() of many offsets at once, in any order"""
+        return self._map_many(offsets, self.orig_start, self.orig_end, self.new_start, self.new_end)
+
+    def to_orig_range(self, rng: 'Range') -> 'Range | None':
+        """Range in the original text or None if it starts or ends inside an expansion"""
+        k = bisect_right(self.new_start, rng[0]) - 1
+        if k >= 0 and rng[0] < self.new_end[k] and rng[0] != self.new_start[k]:
+            return None
+        j = bisect_left(self.new_start, rng[1]) - 1
+        if j >= 0 and rng[1] < self.new_end[j]:
+            return None
+        return (self.to_orig(rng[0]), self.to_orig(rng[1]) if j < 0 or rng[1] != self.new_end[j]
+                                      else self.orig_end[j])
+
+    def to_orig_span(self, rng: 'Range') -> 'Range':
+        """Range in the original text that the range comes from. Ends inside an expansion
+           extend to the whole macro use."""
+        j = bisect_left(self.new_start, rng[1]) - 1
+        return (self.to_orig(rng[0]),
+                self.orig_end[j] if j >= 0 and rng[1] <= self.new_end[j] else self.to_orig(rng[1]))
+
+    def expansions_in(self, rng: 'Range') -> range:
+        """Indexes of the expansions that start in the range of the expanded text"""
+        return range(bisect_left(self.new_start, rng[0]), bisect_left(self.new_start, rng[1]))
+
+    def tobytes(self) -> bytes:
+        return b"".join(a.tobytes() for a in
+                        (self.orig_start, self.orig_end, self.new_start, self.new_end))
+
+    @staticmethod
+    def frombytes(data: bytes) -> 'SourceMap':
+        ret = SourceMap()
+        n = len(data) // 4
+        for i, a in enumerate((ret.orig_start, ret.orig_end, ret.new_start, ret.new_end)):
+            a.frombytes(data[i * n:(i + 1) * n])
+        return ret
+
+    def __getstate__(self) -> bytes:
+        return self.tobytes()
+
+    def __setstate__(self, state: bytes) -> None:
+        self.__dict__.update(SourceMap.frombytes(state).__dict__)
+
+class ExpansionLog:
+    """Top-level macro expansions of a text with the macros each of them went through.
+       Macro names are interned to ids, id 0 is the expansion context "". The (caller, callee)
+       edges of expansion k are edge_caller/edge_callee[edge_start[k]:edge_start[k+1]].
+       Items are Expansions objects made on access."""
+    ranges: SourceMap
+    names: list[str]  # id -> name
+    edge_start: array
+    edge_caller: array
+    edge_callee: array
+    _ids: dict[str, int]
+
+    def __init__(self):
+        self.ranges = SourceMap()
+        self.names, self._ids = [""], {"": 0}
+        self.edge_start, self.edge_caller, self.edge_callee = array("I", [0]), array("I"), array("I")
+
+    def _id(self, name: str) -> int:
+        if (ret := self._ids.get(name)) is None:
+            ret = self._ids[name] = len(self.names)
+            self.names.append(name)
+        return ret
+
+    def append(self, range_orig: 'Range', range_new: 'Range',
+               expansions: dict[str, set[str]]) -> None:
+        self.ranges.append(range_orig, range_new)
+        for caller, callees in expansions.items():
+            caller_id = self._id(caller)
+            for callee in callees:
+                self.edge_caller.append(caller_id)
+                self.edge_callee.append(self._id(callee))
+        self.edge_start.append(len(self.edge_caller))
+
+    def __len__(self) -> int:
+        return len(self.ranges)
+
+    def edges(self, k: int) -> Iterator[tuple[str, str]]:
+        """(caller, callee) of expansion k"""
+        for i in range(self.edge_start[k], self.edge_start[k + 1]):
+            yield self.names[self.edge_caller[i]], self.names[self.edge_callee[i]]
+
+    def __getitem__(self, k: int) -> 'Expansions':
+        if not 0 <= k < len(self):
+            raise IndexError(k)
+        expansions: dict[str, set[str]] = {}
+        for caller, callee in self.edges(k):
+            expansions.setdefault(caller, set()).add(callee)
+        return Expansions(self.ranges.insert_point(k), expansions)
+
+    def __iter__(self) -> Iterator['Expansions']:
+        return (self[k] for k in range(len(self)))
+
+    def __getstate__(self) -> dict[str, Any]:
+        state = self.__dict__.copy()
+        del state["_ids"]
+        return state
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._ids = {name: i for i, name in enumerate(self.names)}
+
 @dataclass
 class File:
     name: str
@@ -182,12 +360,16 @@ class File:
     is_private: bool | None = field(default=None, repr=False)
     # txt: str = ""
     lineOffsets: list[int] | None = field(default=None, repr=False)
-    expandList: list[Expansions] = field(default_factory=list, repr=False)
+    expandList: ExpansionLog | None = field(default=None, repr=False)
     fileKind: FileKind = field(default="", repr=False)
     relpath: str = field(default="", repr=False)
-    # Mapping from expanded offset to original offset
-    _offsetMapIdx: list[int] = field(default_factory=list, repr=False)
-    _offsetMapOffset: list[int] = field(default_factory=list, repr=False)
+    # Checksum of the text that the tokens refer to and whether it's macro-expanded
+    textCrc: int | None = field(default=None, repr=False)
+    is_expanded: bool = field(default=False, repr=False)
+    # Mapping between expanded and original offsets
+    sourceMap: SourceMap | None = field(default=None, repr=False)
+    # Produces the macro-expanded text when it's not cached, set by the codebase that has the file
+    expander: Callable[['File'], str] | None = field(default=None, repr=False, compare=False)
 
     def __post_init__(self):
         if not self.relpath:
@@ -200,6 +382,11 @@ class File:
         if not self.fileKind:
             self.fileKind = get_file_kind(self.name)
 
+    def __getstate__(self) -> dict[str, Any]:
+        state = self.__dict__.copy()
+        state.pop("expander", None)  # it's set again by the codebase that loads the file
+        return state
+
     # Create a mapping from offset to line number
     def fillLineInfo(self, txt: str) -> list[int]:
         if self.lineOffsets is None:
@@ -209,17 +396,11 @@ class File:
         return self.lineOffsets
 
     def updateLineInfoWithInsertList(self, insertList: InsertList) -> None:
-        self._offsetMapIdx = [0]
-        self._offsetMapOffset = [0]
-        if not insertList:
-            return
+        self.sourceMap = SourceMap(insertList)
 
-        cur_delta = 0
-        for ins in insertList:
-            offset, delta = ins.range_new[0], ins.delta
-            cur_delta += delta
-            self._offsetMapIdx.append(offset)
-            self._offsetMapOffset.append(cur_delta)
+    def setExpansions(self, log: ExpansionLog) -> None:
+        """Use the expansions of the expanded text, they also map the offsets"""
+        self.expandList, self.sourceMap = log, log.ranges
 
     def offsetToLinePos(self, offset: int) -> tuple[int, int]:
         offset = self.getOrigOffset(offset)
@@ -242,21 +423,36 @@ class File:
         return txt
 
     def expansions(self, range: Range) -> Iterable[Expansions]:
-        if not self.expandList:
+        if not self.expandList or not self.sourceMap:
             return
-        idx = bisect_left(self.expandList, range[0], key=lambda x: x.at.range_new[0])
-        while idx < len(self.expandList) and self.expandList[idx].at.range_new[0] < range[1]:
+        for idx in self.sourceMap.expansions_in(range):
             yield self.expandList[idx]
-            idx += 1
 
     # Get original file offset before macro expansion
     def getOrigOffset(self, offset: int) -> int:
-        if not self._offsetMapIdx:
-            return offset
-        idx = bisect_left(self._offsetMapIdx, offset)
-        return offset - self._offsetMapOffset[idx - 1]
+        return self.sourceMap.to_orig(offset) if self.sourceMap else offset
 
-@dataclass
+    # Get the offset in the expanded text from the original file offset
+    def getExpandedOffset(self, offset: int) -> int:
+        return self.sourceMap.to_expanded(offset) if self.sourceMap else offset
+
+    # Get the original range of a range of the expanded text, None if it's within a macro
+    def getOrigRange(self, rng: Range) -> Range | None:
+        return self.sourceMap.to_orig_range(rng) if self.sourceMap else rng
+
+    def offsetsToLinePos(self, offsets: Sequence[int]) -> list[tuple[int, int]]:
+        """offsetToLinePos() of many offsets at once"""
+        if self.sourceMap:
+            offsets = self.sourceMap.to_orig_many(offsets)
+        if not self.lineOffsets:
+            return [(0, offset) for offset in offsets]
+        ret = []
+        for offset in offsets:
+            line = bisect_left(self.lineOffsets, offset)
+            ret.append((line + 1, offset - self.lineOffsets[line-1] if line > 0 else offset))
+        return ret
+
+@dataclass(slots=True)
 class Scope:
     file: File
     offset: int  # offset in file
@@ -269,6 +465,10 @@ class Scope:
     def locationStr(self, offset: int) -> str:
         return self.file.locationStr(self.offset + offset)
 
+    def __reduce__(self) -> tuple[type, tuple[File, int]]:
+        # Pickled as the arguments: the File is a reference to the one pickled with the first scope
+        return (Scope, (self.file, self.offset))
+
     @staticmethod
     def create(file: File | None, offset: int) -> 'Scope':
         if file is not None:
@@ -368,6 +568,7 @@ class Log: # Log Categories
     access_member        = LogCategory("access_member",        LogLevel.ERROR,   True)
     defn_conflict        = LogCategory("defn_conflict",        LogLevel.WARNING, True)
     defn_conflict_macro  = LogCategory("defn_conflict_macro",  LogLevel.WARNING, True)
+    macro_leak           = LogCategory("macro_leak",           LogLevel.WARNING, True)
     parse_typedef        = LogCategory("parse_typedef",        LogLevel.WARNING, True)
     parse_localvar       = LogCategory("parse_localvar",       LogLevel.WARNING, True)
     parse_expression     = LogCategory("parse_expression",     LogLevel.WARNING, True)
@@ -70,17 +70,28 @@ def renameFields(renames: dict[str, dict[str, str]]) -> None:
         if t not in renames or arg.field not in renames[t]:
             return
         body = cast(Token, arg.src.details.body)  # type: ignore[union-attr] # arg.src.details.body
-        rng = rangeShift(arg.range, body.range[0])
+        # Patches apply to the original text
+        rng_expanded = rangeShift(arg.range, body.range[0])
+        rng = arg.src.scope.file.getOrigRange(rng_expanded)
+        if rng is None:
+            LOG(LogLevel.QUIET, lambda:arg.src.scope.locationStr(rng_expanded[0]), f"Field access in a macro expansion in {arg.src.name}: <{arg.field}>")
+            return None
         fname = arg.src.scope.file.name
         patcher = _get_patcher_for_file(fname)
         txt = patcher.txt
         if body.value[arg.range[0]:arg.range[1]] != arg.field or arg.field != txt[rng[0]:rng[1]]:
-            LOG(LogLevel.QUIET, lambda:arg.src.scope.locationStr(rng[0]), f"Field access mismatch in {arg.src.name}: <{arg.field}> == <{body.value[arg.range[0]:arg.range[1]]}> == <{txt[rng[0]:rng[1]]}>")
+            LOG(LogLevel.QUIET, lambda:arg.src.scope.locationStr(rng_expanded[0]), f"Field access mismatch in {arg.src.name}: <{arg.field}> == <{body.value[arg.range[0]:arg.range[1]]}> == <{txt[rng[0]:rng[1]]}>")
             return None
-        print(f"{arg.src.scope.locationStr(rng[0])} Field access in {arg.src.name}: {access_chain}: {t}:{arg.field} -> {renames[t][arg.field]}")
+        print(f"{arg.src.scope.locationStr(rng_expanded[0])} Field access in {arg.src.name}: {access_chain}: {t}:{arg.field} -> {renames[t][arg.field]}")
         patcher.replace(rng, renames[t][arg.field])
         return None
 
+    for t, fields in renames.items():
+        for f in fields:
+            if _globals.untypedef(t) not in (recs := _globals.get_field_records(f)):
+                print(f"Field '{f}' not found in '{t}'" +
+                      (f", it's in: {', '.join(sorted(recs))}" if recs else ""))
+
     access = AccessCheck(_globals)
     fields_re = regex.compile(r"\b(?:\L<names>)\b", re_flags, names=[v for vv in renames.values() for v in vv.keys()])
     for defn in itertools.chain(_globals.names.values(),
@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-import sys, os
+import sys, os, pickle, random, tempfile
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
 os.chdir(os.path.dirname(__file__))
 
@@ -22,6 +22,9 @@ def _sort_set_txt(txt):
 def pf(obj: Any) -> str:
     return pformat(obj, width=120, compact=False)
 
+def pf_noid(obj: Any) -> str:
+    return regex.sub(r" with id=\d++", " with id=*", pf(obj), re_flags)
+
 class TestCaseLocal(unittest.TestCase):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -137,6 +140,14 @@ class TestRegex(TestCaseLocal):
             list(reversed(['int', ' ', 'main', '(int argc, char *argv[])',
                            ' ', '{\\n  int a = 1;\\n  return a;\\n}'])))
 
+    def test_regex_body(self):
+        # The fast BODY of block tokens must split text the same way as the plain token recursion
+        reg_plain = regex.compile(r"(?&TOKEN)" + re_token_r, re_flags)
+        rnd = random.Random(1)
+        for _ in range(2000):
+            txt = "".join(rnd.choice("a_1 \n;()[]{}/*\"'\\#") for _ in range(rnd.randint(0, 40)))
+            self.assertListEqual(reg_token.findall(txt), reg_plain.findall(txt), txt)
+
     def test_clean(self):
         self.assertEqual(clean_text_sz("qwe asd /* zxc\n */ wer"), "qwe asd       \n    wer")
         self.assertEqual(clean_text("qwe asd /* zxc\n */ wer"), "qwe asd   wer")
@@ -308,6 +319,274 @@ class TestMacro(TestCaseLocal):
 
         workspace.logStream = None
 
+    def test_macro_collect_multi(self):
+        setModules([Module("mod1"), Module("mod2")])
+        files = ["data/macro-access.c", "data/macro.c", "data/statements.c", "data/various.c"]
+        results = []
+        setLogLevel(LogLevel.WARNING)
+        for multithread in [False, True]:
+            workspace.logStream = StringIO()
+            _globals = Codebase()
+            _globals.scanFiles(files, twopass=True, multithread=multithread)
+            # Only the macro pass is compared
+            results.append(("".join(line for line in workspace.logStream.getvalue().splitlines(True)
+                                    if "{defn_conflict_macro}" in line),
+                            pf(_globals.macros),
+                            [defn.locationStr() for defn in _globals.macros.values()]))
+        setLogLevel(LogLevel.DEFAULT)
+        self.assertIn("conflicting update for macro details", results[0][0])
+        self.assertEqual(results[0], results[1])
+        workspace.logStream = None
+
+    def test_macro_local(self):
+        setModules([Module("mod1"), Module("mod2")])
+        for multithread in [False, True]:
+            workspace.logStream = StringIO()
+            _globals = Codebase()
+            _globals.scanFiles(["data/macro-access.c"], multithread=multithread, local_macros=True)
+            self.assertEqual(list(_globals.macros), ["__attribute__"])
+            self.assertIn("QWE", _globals.macros_for_file("data/macro-access.c"))
+            AccessCheck(_globals).checkAccess(multithread=False)
+            self.checkStrAgainstFile(workspace.logStream.getvalue(), "data/macro-access.c-access")
+
+        files = ["data/macro-access.c", "data/macro.c", "data/statements.c", "data/various.c"]
+        setLogLevel(LogLevel.WARNING)
+        for multithread in [False, True]:
+            workspace.logStream = StringIO()
+            _globals = Codebase()
+            _globals.scanFiles(files, multithread=multithread, local_macros=True)
+            self.assertEqual([line for line in workspace.logStream.getvalue().splitlines()
+                              if "{macro_leak}" in line], [
+                "data/macro.c:8:1: warning: Macro 'qwe' is defined only in data/statements.c {macro_leak}",
+                "data/statements.c:181:1: warning: Macro 'QWE' is defined only in data/macro-access.c, "
+                    "data/various.c {macro_leak}"])
+        setLogLevel(LogLevel.DEFAULT)
+        workspace.logStream = None
+
+        # File macros are visible to the global macros while the file is expanded
+        _globals = Codebase()
+        _globals.addMacro("A", body="B + 1")
+        table = _globals.macro_table()
+        self.assertEqual(MacroExpander().expand("A", table), "B + 1")
+        with ScopePush(file=File("file.c")):
+            file_macros = _globals._get_file_macros("#define B b_local\n")
+        file_table = table.overlay(file_macros)
+        self.assertEqual(MacroExpander().expand("A", file_table), "b_local + 1")
+        self.assertEqual(MacroExpander().expand("A", table), "B + 1")
+        self.assertEqual((table.obj_like, set(table.macros)), ({"A"}, {"A", "__attribute__"}))
+        # The overlay doesn't change the table, and shares the expansions that don't use its macros
+        _globals.addMacro("C", body="c_global")
+        table = _globals.macro_table()
+        MacroExpander().expand("C", table)
+        cache_size = len(table.cache)
+        file_table = table.overlay(file_macros)
+        self.assertEqual(MacroExpander().expand("A C", file_table), "b_local + 1 c_global")
+        self.assertEqual(len(table.cache), cache_size)
+        self.assertEqual(MacroExpander().expand("A C", table), "B + 1 c_global")
+
+    def test_macro_policy(self):
+        setModules([Module("mod1"), Module("mod2")])
+        workspace.logStream = StringIO()
+        _globals = Codebase()
+        _globals.scanFiles(["data/macro-access.c"], twopass=True, multithread=False,
+                           expand_policy="private")
+        self.assertEqual(_globals.macro_table().opaque, {"QWE"})
+        AccessCheck(_globals).checkAccess(multithread=False)
+        self.checkStrAgainstFile(workspace.logStream.getvalue(), "data/macro-access.c-access")
+
+        # The policy of the codebase is kept. Macros of a module that are not private to it are
+        # not expanded.
+        _globals2 = Codebase(expand_policy="private")
+        _globals2.addMacro("PUB", body="pub_value")
+        _globals2.macros["PUB"].module = "mod2"
+        _globals2.scanFiles(["data/macro-access.c"], twopass=True, multithread=False)
+        self.assertEqual(_globals2.expand_policy, "private")
+        self.assertEqual(_globals2.macro_table().opaque, {"QWE", "PUB"})
+        workspace.logStream = None
+
+        table = MacroTable(_globals.macros, policy=lambda defn: defn.name != "QWE3")
+        expander = MacroExpander()
+        self.assertEqual(expander.expand("QWE3(QWE(1))", table), "QWE3(1+5)")
+        self.assertEqual(expander.expand_list[0].expansions, {"": {"QWE3", "QWE"}})
+
+    def test_macro_table(self):
+        _globals = Codebase()
+        _globals.addMacro("A", body="B")
+        _globals.addMacro("C", body="1")
+        table = _globals.macro_table()
+        self.assertEqual((table.obj_like, table.fn_like), ({"A"}, set()))
+        self.assertEqual(MacroExpander().expand("A C", table), "B C")
+
+        # Only new expandable macros trigger a rebuild
+        names_reg = table.names_reg
+        _globals.addMacro("D", body="2")
+        self.assertIs(_globals.macro_table().names_reg, names_reg)
+        _globals.addMacro("F", ("x",), body="x + 1")
+        self.assertIs(_globals.macro_table(), table)
+        self.assertIsNot(table.names_reg, names_reg)
+        self.assertEqual(MacroExpander().expand("A F(C)", table), "B C + 1")
+
+        # Redefined macros of the same kind don't rebuild the matcher, but their cached
+        # expansions are dropped
+        names_reg = table.names_reg
+        _globals.addMacro("A", body="E")
+        _globals.addMacro("F", ("x",), body="x + 2")
+        self.assertIs(_globals.macro_table().names_reg, names_reg)
+        self.assertEqual(MacroExpander().expand("A F(C)", table), "E C + 2")
+
+    def test_source_map(self):
+        _globals = Codebase()
+        _globals.addMacro("A", body="aaaa")
+        txt = "x A y z A"
+        expander = MacroExpander()
+        expanded = expander.expand(txt, _globals.macro_table())
+        self.assertEqual(expanded, "x aaaa y z aaaa")
+        smap = SourceMap(expander.insert_list)
+        # Offsets inside an expansion map to the macro use
+        self.assertEqual([smap.to_orig(i) for i in range(len(expanded) + 1)],
+                         [0, 1, 2, 2, 2, 2, 3, 4, 5, 6, 7, 8, 8, 8, 8, 9])
+        self.assertEqual([smap.to_expanded(i) for i in range(len(txt) + 1)],
+                         [0, 1, 2, 6, 7, 8, 9, 10, 11, 15])
+        self.assertEqual(list(smap.to_orig_many([15, 3, 0, 7])), [9, 2, 0, 4])
+        self.assertEqual(list(smap.to_expanded_many([9, 3])), [15, 6])
+        self.assertEqual((smap.to_orig_range((0, 7)), smap.to_orig_range((2, 6)),
+                          smap.to_orig_range((3, 5)), smap.to_orig_range((5, 8))),
+                         ((0, 4), (2, 3), None, None))
+        self.assertEqual(list(smap.expansions_in((0, 11))), [0])
+        self.assertEqual(pickle.loads(pickle.dumps(smap)), smap)
+        self.assertEqual(SourceMap.frombytes(smap.tobytes()), smap)
+
+    def test_expansion_log(self):
+        _globals = Codebase()
+        with ScopePush(file=File("data/macro.c")):
+            _globals.updateMacroFromText(scope_file().read())
+            expander = MacroExpander()
+            expander.expand(scope_file().read(), _globals.macro_table())
+        log = expander.expansion_log
+        self.assertEqual(len(log.names), len(set(log.names)))
+        self.assertEqual(log[0], Expansions(InsertPoint((174, 183), (174, 179), -4), {"": {"DDD"}}))
+        self.assertEqual(list(pickle.loads(pickle.dumps(log))), list(log))
+        file = File("data/macro.c")
+        file.setExpansions(log)
+        self.assertEqual(list(file.expansions((170, 200))), list(log)[:2])
+
+    def test_macro_stats(self):
+        self.assertIsNone(Codebase().macro_stats)
+        setModules([Module("mod1"), Module("mod2")])
+        files = ["data/macro-access.c", "data/macro.c", "data/statements.c", "data/various.c"]
+        counts = []
+        for multithread in [False, True]:
+            _globals = Codebase()
+            _globals.scanFiles(files, multithread=multithread, profile_macros=True)
+            stats = cast(MacroStats, _globals.macro_stats)
+            counts.append({name: stat.count for name, stat in stats.items()})
+            self.assertIn("qwe", stats)
+            self.assertGreater(stats["qwe"].out_bytes, 0)
+            self.assertIn("count", stats.report(5).splitlines()[0])
+        self.assertEqual(counts[0], counts[1])
+        # The profile is saved with the codebase, as in the profile snapshot of scan_sources_tool
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "codebase.profile.snap")
+            Snapshot.save(_globals, path)
+            loaded = cast(Codebase, Snapshot.load(path))
+            self.assertEqual({name: stat.count for name, stat in cast(MacroStats, loaded.macro_stats).items()},
+                             counts[0])
+
+    def test_macro_statements(self):
+        txt = ("int x;\n/* F(a)\n}\n*/\nint f(void)\n{\n    return (0);\n}\n"
+               "F(1, {\n}\n);\nstruct s {\n    int a;\n};\nint g(void)\n{\n    return (N);\n}\n")
+        self.assertEqual([txt[start:end] for start, end in top_statements(txt)], [
+            "int x;\n", "/* F(a)\n}\n*/\nint f(void)\n{\n    return (0);\n}\n", "F(1, {\n}\n);\n",
+            "struct s {\n    int a;\n};\n", "int g(void)\n{\n    return (N);\n}\n"])
+        _globals = Codebase()
+        _globals.updateMacroFromText("#define F(a, b) (a + b)\n#define N 10\n")
+        expander = MacroExpander()
+        expanded = expander.expand(txt, MacroTable(_globals.macros, expand_const=True))
+        self.assertEqual(expanded, txt.replace("F(1, {\n}\n)", "(1 + {\n})").replace("(N)", "(10)"))
+        self.assertEqual([(txt[slice(*ins.range_orig)], expanded[slice(*ins.range_new)])
+                          for ins in expander.insert_list], [("F(1, {\n}\n)", "(1 + {\n})"), ("N", "10")])
+
+        # Parentheses in comments and literals don't count
+        txt = "F(')', {\n} /* ( */\n);\nint x = F('(', \"(\");\n// )\nint y;\n/* ** (\n*/\nint z;\n"
+        self.assertEqual([txt[start:end] for start, end in top_statements(txt)], [
+            "F(')', {\n} /* ( */\n);\n", "int x = F('(', \"(\");\n", "// )\nint y;\n",
+            "/* ** (\n*/\nint z;\n"])
+        self.assertEqual(expander.expand(txt, MacroTable(_globals.macros, expand_const=True)),
+                         "(')' + {\n} /* ( */);\nint x = ('(' + \"(\");\n// )\nint y;\n/* ** (\n*/\nint z;\n")
+
+    def test_macro_tokens(self):
+        for fname in ["data/macro.c", "data/macro-expand-offsets.c", "data/statements.c"]:
+            for expand_const in (False, True):
+                _globals = Codebase()
+                with ScopePush(file=File(fname)):
+                    txt = scope_file().read()
+                    _globals.updateMacroFromText(txt)
+                    expander1, expander2 = MacroExpander(), MacroExpander()
+                    expanded = expander1.expand(txt, MacroTable(_globals.macros, expand_const=expand_const))
+                    expanded2, tokens = expander2.expand_tokens(
+                        txt, MacroTable(_globals.macros, expand_const=expand_const))
+                self.assertEqual(expanded2, expanded)
+                self.assertEqual([(ins.range_orig, ins.range_new) for ins in expander2.insert_list],
+                                 [(ins.range_orig, ins.range_new) for ins in expander1.insert_list])
+                self.assertEqual(expander2.expand_list, expander1.expand_list)
+                self.assertEqual([(token.range, token.value) for token in tokens],
+                                 [(token.range, token.value) for token in TokenList.fromText(expanded, 0)])
+                for token in tokens:
+                    if token.range in (ins.range_new for ins in expander2.insert_list):
+                        self.assertNotEqual(txt[slice(*token.orig_range)], token.value)
+
+        _globals = Codebase()
+        _globals.updateMacroFromText("#define F(a, b) (a + b)\n#define N 10\n")
+        txt = "int f(void)\n{\n    return F(N, 2);\n}\n"
+        expanded, tokens = MacroExpander().expand_tokens(txt, MacroTable(_globals.macros, expand_const=True))
+        self.assertEqual(expanded, "int f(void)\n{\n    return (10 + 2);\n}\n")
+        self.assertEqual([txt[slice(*token.orig_range)] for token in tokens],
+                         ["int", " ", "f", "(void)", "\n", "{\n    return F(N, 2);\n}", "\n"])
+
+    def test_macro_template(self):
+        _globals = Codebase()
+        _globals.updateMacroFromText(
+            '#define P(x, ...) f("x=%d", x, ## __VA_ARGS__) #x a ## x ## b\n'
+            '#define Q(a) a\n')
+        self.assertListEqual(_globals.macros["P"].details.get_template(),
+            [("t", 'f("x=%d", '), ("a", 0), ("c", (", ", 1)), ("t", ") "), ("s", 0), ("t", " "),
+             ("p", ("a", 0, "b"))])
+        self.assertEqual(MacroExpander().expand("P(1) P(Q(2), 3, 4)", _globals.macro_table()),
+                         'f("x=%d", 1) "1" a1b f("x=%d", 2, 3, 4) "Q(2)" aQ(2)b')
+
+    def test_macro_graph(self):
+        _globals = Codebase()
+        with ScopePush(file=File("data/macro.c")):
+            _globals.updateMacroFromText(scope_file().read())
+        graph = _globals.macro_table().graph
+        self.assertIn(["RECURSE"], graph.cycles())
+        self.assertIn(["RECURSE_A", "RECURSE_B"], graph.cycles())
+        self.assertEqual(_globals.get_macro_users("TABLESIZE"), {"BUFSIZE"})
+        self.assertIn("XCAT", _globals.get_macro_users("CAT"))
+
+        table = MacroTable(_globals.macros, expand_const=True)
+        self.assertEqual(table.preexpanded["BUFSIZE"], ("1024", (("BUFSIZE", "TABLESIZE"),)))
+        expander = MacroExpander()
+        self.assertEqual(expander.expand("BUFSIZE", table), "1024")
+        self.assertEqual(expander.expand_list[0].expansions, {"": {"BUFSIZE"}, "BUFSIZE": {"TABLESIZE"}})
+
+    def test_macro_expansion_cache(self):
+        _globals = Codebase()
+        with ScopePush(file=File("data/macro.c")):
+            src = scope_file().read()
+            _globals.updateMacroFromText(src)
+            table = MacroTable(_globals.macros, expand_const=True)
+            results, misses = [], []
+            for _ in range(2):
+                expander = MacroExpander()
+                results.append((expander.expand(src, table),
+                                pf(expander.insert_list), pf(expander.expand_list)))
+                misses.append(sum(stat[1] for stat in table.cache.stats.values()))
+        self.checkStrAgainstFile(results[0][0], "data/macro.c.macro-full")
+        self.assertEqual(results[0], results[1])
+        self.assertGreater(misses[0], 0)
+        self.assertEqual(misses[0], misses[1])
+
 class TestCodebase(TestCaseLocal):
     def test_codebase(self):
         _globals = Codebase()
@@ -317,6 +596,488 @@ class TestCodebase(TestCaseLocal):
         self.checkStrAgainstFile(pformat(_globals, width=120, compact=False),
                                  "data/statements.c.globals")
 
+    def test_scan_multi(self):
+        setModules([Module("mod1"), Module("mod2")])
+        files = ["data/macro-access.c", "data/record.c", "data/statements.c", "data/various.c",
+                 "data/block.h"]
+        results = []
+        for multithread in [False, True]:
+            workspace.logStream = StringIO()
+            _globals = Codebase()
+            _globals.scanFiles(files, twopass=True, multithread=multithread)
+            results.append((pf_noid(_globals.types), pf_noid(_globals.fields), pf_noid(_globals.names),
+                            pf_noid(_globals.static_names), _globals.typedefs,
+                            sorted(_globals.types_restricted), sorted(_globals.names_restricted),
+                            _globals.field_records))
+        self.assertEqual(results[0], results[1])
+        workspace.logStream = None
+
+    def test_scan_cache(self):
+        setModules([Module("mod1"), Module("mod2")])
+        workspace.logStream = StringIO()
+        root_path, use_cache = workspace.rootPath, cache.use_cache
+        with tempfile.TemporaryDirectory() as tmpdir:
+            workspace.rootPath, cache.use_cache = tmpdir, True
+            files = []
+            for fname in ["data/record.c", "data/statements.c"]:
+                files.append(os.path.join(tmpdir, os.path.basename(fname)))
+                with open(files[-1], "w") as f:
+                    f.write(file_content(fname))
+            for fname, txt in [("ten.h", "#define TEN(x) ((x) * 10)\n"),
+                               ("ten.c", "int ten(void)\n{\n    return TEN(1);\n}\n")]:
+                files.append(os.path.join(tmpdir, fname))
+                with open(files[-1], "w") as f:
+                    f.write(txt)
+
+            def scan(multithread: bool) -> tuple[Codebase, ScanCache]:
+                _globals = Codebase()
+                _globals.scanFiles(files, multithread=multithread, cache_files=True)
+                return _globals, cast(ScanCache, _globals.scan_cache)
+
+            _globals, scan_cache = scan(False)
+            self.assertEqual((scan_cache.hits, scan_cache.misses), (0, 8))
+            expected = Codebase()
+            expected.scanFiles(files, multithread=False)
+            self.assertEqual(pf_noid(_globals.names), pf_noid(expected.names))
+            self.assertEqual(pf_noid(_globals.types), pf_noid(expected.types))
+
+            _globals, scan_cache = scan(True)
+            self.assertEqual((scan_cache.hits, scan_cache.misses), (8, 0))
+            self.assertEqual(pf_noid(_globals.names), pf_noid(expected.names))
+            self.assertEqual(pf_noid(_globals.fields), pf_noid(expected.fields))
+            self.assertEqual(_globals.typedefs, expected.typedefs)
+            self.assertEqual(filetext.get_text(_globals.names["ten"].scope.file),
+                             "int ten(void)\n{\n    return ((1) * 10);\n}\n")
+
+            # A changed macro invalidates its file in both passes and the files that use it
+            with open(files[2], "w") as f:
+                f.write("#define TEN(x) ((x) * 11)\n")
+            _globals, scan_cache = scan(False)
+            self.assertEqual((scan_cache.hits, scan_cache.misses), (5, 3))
+            self.assertEqual(cast(BodyRef, _globals.names["ten"].details.body).value,
+                             "\n    return ((1) * 11);\n")
+
+            # Profiling on a warm cache expands the files again to count the expansions
+            _globals = Codebase()
+            _globals.scanFiles(files, multithread=False, profile_macros=True, cache_files=True)
+            self.assertEqual(cast(ScanCache, _globals.scan_cache).hits, 4)
+            self.assertEqual(cast(MacroStats, _globals.macro_stats)["TEN"].count, 1)
+        workspace.rootPath, cache.use_cache = root_path, use_cache
+        workspace.logStream = None
+
+    def test_update_files(self):
+        setModules([Module("mod1"), Module("mod2")])
+        workspace.logStream = StringIO()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            files = []
+            for fname in ["data/record.c", "data/statements.c"]:
+                files.append(os.path.join(tmpdir, os.path.basename(fname)))
+                with open(files[-1], "w") as f:
+                    f.write(file_content(fname))
+            for fname, txt in [("ten.h", "#define TEN(x) ((x) * 10)\n"),
+                               ("ten.c", "int ten(void)\n{\n    return TEN(1);\n}\n"),
+                               ("dup.c", "static int dup;\nint ten2(void)\n{\n    return 2;\n}\n")]:
+                files.append(os.path.join(tmpdir, fname))
+                with open(files[-1], "w") as f:
+                    f.write(txt)
+
+            def check(_globals: Codebase, files: list[str]) -> None:
+                expected = Codebase()
+                expected.scanFiles(files, multithread=False)
+                self.assertEqual(pf_noid(_globals.names), pf_noid(expected.names))
+                self.assertEqual(pf_noid(_globals.types), pf_noid(expected.types))
+                self.assertEqual(pf_noid(_globals.fields), pf_noid(expected.fields))
+                self.assertEqual(pf_noid(_globals.macros), pf_noid(expected.macros))
+                self.assertEqual(_globals.typedefs, expected.typedefs)
+                self.assertEqual(pf_noid(_globals.static_names), pf_noid(expected.static_names))
+                self.assertEqual(_globals.names_restricted.keys(), expected.names_restricted.keys())
+                self.assertEqual(_globals.types_restricted.keys(), expected.types_restricted.keys())
+
+            _globals = Codebase()
+            _globals.scanFiles(files, multithread=False)
+
+            # A changed macro rescans the files that use it
+            with open(files[2], "w") as f:
+                f.write("#define TEN(x) ((x) * 11)\n")
+            self.assertEqual(_globals.updateFiles(changed=[files[2]]), [files[2], files[3]])
+            check(_globals, files)
+            self.assertEqual(cast(BodyRef, _globals.names["ten"].details.body).value,
+                             "\n    return ((1) * 11);\n")
+
+            # The definition of a name from another file replaces the retracted one
+            with open(files[4], "w") as f:
+                f.write("static int dup;\nint ten(void)\n{\n    return 2;\n}\n")
+            self.assertEqual(_globals.updateFiles(changed=[files[4]]), [files[4]])
+            check(_globals, files)
+            _globals.updateFiles(removed=[files[3]])
+            check(_globals, [*files[:3], files[4]])
+            self.assertNotIn(files[3], _globals.files)
+            self.assertIs(_globals.names["ten"].scope.file, _globals.files[files[4]])
+            self.assertEqual(cast(BodyRef, _globals.names["ten"].details.body).value,
+                             "\n    return 2;\n")
+            _globals.updateFiles(removed=[files[4]])
+            check(_globals, files[:3])
+            self.assertNotIn("ten", _globals.names)
+
+            # Definitions of the same names merge in the order of files, as in a full scan
+            files = [os.path.join(tmpdir, "a.h"), os.path.join(tmpdir, "b.c")]
+            for fname, txt in zip(files, ["typedef struct x T;\nstruct S9 {\n    int a;\n};\n",
+                                          "typedef struct y T;\nstruct S9 {\n    int b;\n};\n"]):
+                with open(fname, "w") as f:
+                    f.write(txt)
+            _globals = Codebase()
+            _globals.scanFiles(files, multithread=False)
+            self.assertEqual((_globals.typedefs, list(_globals.fields["S9"])), ({"T": "y"}, ["a", "b"]))
+            self.assertEqual(_globals.updateFiles(changed=[files[0]]), [files[0]])
+            self.assertEqual((_globals.typedefs, list(_globals.fields["S9"])), ({"T": "y"}, ["a", "b"]))
+            check(_globals, files)
+            # A removed file that was never scanned is ignored
+            _globals.updateFiles(removed=[os.path.join(tmpdir, "c.c")])
+            check(_globals, files)
+        workspace.logStream = None
+
+    def test_field_records(self):
+        _globals = Codebase()
+        _globals.scanFiles(["data/record.c"], twopass=False, multithread=False)
+        self.assertSetEqual(_globals.get_field_records("x"), {"S1", "ACCESS1"})
+        self.assertSetEqual(_globals.get_field_records("y"), {"S1", "ACCESS1"})
+        self.assertSetEqual(_globals.get_field_records("no_such_field"), set())
+        self.assertEqual(_globals.get_field_record("f1"), "FNPTRS")
+        self.assertEqual(_globals.get_field_record("x"), "")
+        for rec, fields in _globals.fields.items():
+            for name in fields:
+                self.assertIn(rec, _globals.get_field_records(name))
+
+    def test_type_tables(self):
+        workspace.logStream = StringIO()
+        setLogLevel(LogLevel.WARNING)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, "types.h")
+            txt = ("struct S1 {\n    int x;\n    struct S1 *next;\n    T3 t;\n};\n"
+                   "typedef struct S1 T1;\ntypedef T1 T2;\ntypedef T2 T3;\n"
+                   "typedef C2 C1;\ntypedef C1 C2;\ntypedef C1 C0;\n")
+            with open(fname, "w") as f:
+                f.write(txt)
+            _globals = Codebase()
+            _globals.scanFiles([fname], multithread=False)
+            computed = {(rec, name): _globals.get_field_type(rec, name)
+                        for rec, fields in _globals.fields.items() for name in fields}
+            self.assertDictEqual(computed, {("S1", "x"): "int", ("S1", "next"): "S1", ("S1", "t"): "S1"})
+            _globals.finalize()
+            self.assertDictEqual(cast(dict, _globals.resolved_typedefs),
+                                 {"T1": "S1", "T2": "S1", "T3": "S1", "C1": "C1", "C2": "C2", "C0": "C1"})
+            self.assertIn("typedef cycle: C1 -> C2 -> C1", workspace.logStream.getvalue())
+            self.assertDictEqual(cast(dict, _globals.field_types), computed)
+            self.assertIs(_globals.types["T3"], _globals.types["S1"])
+
+            # The tables are built again after an update
+            with open(fname, "w") as f:
+                f.write(txt.replace("typedef T2 T3;\n", ""))
+            _globals.updateFiles(changed=[fname])
+            self.assertNotIn("T3", _globals.types)
+            self.assertNotIn("T3", cast(dict, _globals.resolved_typedefs))
+            self.assertEqual(_globals.get_field_type("S1", "t"), "T3")
+            self.assertEqual(cast(dict, _globals.field_types)[("S1", "t")], "T3")
+        setLogLevel(LogLevel.DEFAULT)
+        workspace.logStream = None
+
+    def test_body_ref(self):
+        _globals = Codebase()
+        _globals.scanFiles(["data/macro-access.c"], twopass=True, multithread=False)
+        bodies = {name: defn.details.body.value for name, defn in _globals.names.items()}
+        self.assertTrue(bodies)
+        for defn in _globals.names.values():
+            self.assertIsInstance(defn.details.body, BodyRef)
+        import pickle
+        from layercparse import filetext
+        data = pickle.dumps(_globals)
+        self.assertTrue(all(body not in data.decode("latin-1") for body in bodies.values() if len(body) > 20))
+        filetext.clear()
+        _globals2 = pickle.loads(data)
+        self.assertDictEqual({name: defn.details.body.value for name, defn in _globals2.names.items()},
+                             bodies)
+        with self.assertRaises(AttributeError):
+            next(iter(_globals2.names.values())).details.body.value = ""
+
+    def test_body_ref_expanders(self):
+        from layercparse import filetext
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, "ten.c")
+            with open(fname, "w") as f:
+                f.write("int ten(void)\n{\n    return TEN(1);\n}\n")
+            codebases = []
+            for value in ("10", "11"):
+                _globals = Codebase()
+                _globals.addMacro("TEN", ("x",), body=f"((x) * {value})")
+                _globals.scanFiles([fname], multithread=False)
+                codebases.append(_globals)
+            # Each codebase expands the text again with its own macros
+            filetext.clear()
+            self.assertEqual([_globals.names["ten"].details.body.value for _globals in codebases],
+                             ["\n    return ((1) * 10);\n", "\n    return ((1) * 11);\n"])
+
+    def test_slots(self):
+        _globals = Codebase()
+        _globals.scanFiles(["data/record.c", "data/macro-access.c"], multithread=False)
+        defns = [*_globals.names.values(), *_globals.types.values(), *_globals.macros.values(),
+                 *(defn for fields in _globals.fields.values() for defn in fields.values())]
+        objs = [*defns, *(defn.details for defn in defns), *(defn.scope for defn in defns),
+                *(defn.details.name for defn in defns),
+                *(body for defn in defns if (body := getattr(defn.details, "body", None)))]
+        self.assertSetEqual({type(obj).__name__ for obj in objs},
+                            {"Definition", "FunctionParts", "RecordParts", "Variable", "MacroParts",
+                             "Scope", "Token", "BodyRef"})
+        for obj in objs:
+            self.assertFalse(hasattr(obj, "__dict__"), type(obj).__name__)
+        _globals2 = pickle.loads(pickle.dumps(_globals))
+        self.assertEqual(pf_noid(_globals2.names), pf_noid(_globals.names))
+        self.assertEqual(pf_noid(_globals2.types), pf_noid(_globals.types))
+        self.assertEqual(pf_noid(_globals2.macros), pf_noid(_globals.macros))
+
+    def test_files(self):
+        fnames = ["data/record.c", "data/macro-access.c", "data/statements.c"]
+        for multithread in [False, True]:
+            _globals = Codebase()
+            _globals.scanFiles(fnames, multithread=multithread)
+            self.assertListEqual(list(_globals.files), fnames)
+            for _globals in [_globals, pickle.loads(pickle.dumps(_globals))]:
+                defns = [*_globals.names.values(), *_globals.types.values(),
+                         *(defn for fields in _globals.fields.values() for defn in fields.values())]
+                self.assertTrue(defns)
+                for defn in defns:
+                    self.assertIs(defn.scope.file, _globals.files[defn.scope.file.name])
+                    self.assertIs(defn.details.scope.file, defn.scope.file)
+                    if isinstance(body := getattr(defn.details, "body", None), BodyRef):
+                        self.assertIs(body.file, defn.scope.file)
+
+    def test_function_memo(self):
+        workspace.logStream = StringIO()
+        setModules([Module("module1"), Module("module2")])
+        _globals = Codebase()
+        _globals.updateFromFile("data/record.c", expand_preproc=False)
+        check = AccessCheck(_globals)
+        check.checkAccess(multithread=False)
+        check1 = workspace.logStream.getvalue()
+        hits, misses = check.memo.hits, check.memo.misses
+        self.assertGreater(misses, 0)
+
+        workspace.logStream = StringIO()
+        check.checkAccess(multithread=False)
+        self.assertMultiLineEqualDiff(workspace.logStream.getvalue(), check1)
+        self.assertEqual(check.memo.misses, misses)
+        self.assertGreater(check.memo.hits, hits)
+
+        memo = FunctionMemo(maxsize=2)
+        for txt in ["a", "b", "a", "c", "b"]:
+            memo.get("p", txt, lambda: txt.upper())
+        self.assertEqual((memo.hits, memo.misses, len(memo)), (1, 4, 2))
+
+        # Functions with the same arguments and body don't share the argument offsets
+        txt = "int f(int a)\n{\n    return a;\n}\nint g(int a) /* gap */\n{\n    return a;\n}\n"
+        check = AccessCheck(Codebase())
+        offsets = []
+        for st in StatementList.fromText(txt, 0):
+            func = cast(FunctionParts, FunctionParts.fromStatement(st))
+            offsets.append([sym.offset for sym in check._get_symbols(func)])
+            self.assertEqual(offsets[-1], [sym.offset for sym in func.getSymbolTable()])
+        self.assertNotEqual(offsets[0], offsets[1])
+        workspace.logStream = None
+
+    def test_symbol_table(self):
+        txt = """int f(S1 *a) {
+    S2 x, *y;
+    x.a;
+    {
+        S1 x;
+        x.b;
+        for (S2 *a = y; a; a = NULL)
+            a->c;
+    }
+    x.d;
+    a->e;
+}"""
+        func = FunctionParts.fromStatement(StatementList.fromText(txt, 0)[0])
+        body = func.body.value
+        symbols = func.getSymbolTable({"S1", "S2"})
+        self.assertListEqual([(sym.name, sym.basetype) for sym in symbols],
+                             [("a", "S1"), ("x", "S2"), ("y", "S2"), ("x", "S1"), ("a", "S2")])
+        def _type(name: str, use: str) -> str:
+            sym = symbols.lookup(name, body.index(use))
+            return sym.basetype if sym else ""
+        self.assertListEqual([_type("x", "x.a"), _type("x", "x.b"), _type("a", "a->c"),
+                              _type("x", "x.d"), _type("a", "a->e"), _type("z", "x.d")],
+                             ["S2", "S1", "S2", "S2", "S1", ""])
+
+
+def _keep_event(event: Any) -> Any:
+    return event
+
+class TestParallel(TestCaseLocal):
+    def test_jobs(self):
+        self.assertGreaterEqual(available_cpus(), 1)
+        self.assertEqual(resolve_jobs(3), 3)
+        self.assertEqual(resolve_jobs(None), available_cpus())
+        self.assertEqual(resolve_jobs(-1000), 1)
+
+    def test_chunks(self):
+        from layercparse.parallel import _chunks
+        chunks = _chunks([5, 100, 1, 1, 40, 1, 1, 1], 2)
+        self.assertEqual(chunks[:2], [[1], [4]])
+        self.assertEqual(sorted(i for chunk in chunks for i in chunk), list(range(8)))
+        # Tasks with no cost are spread over chunks too
+        self.assertEqual(len(_chunks([0] * 64, 2)), 16)
+
+    def test_run_tasks(self):
+        from layercparse.parallel import run_tasks
+        tasks = [(i, 2) for i in range(20)]
+        costs = [i % 7 for i in range(20)]
+        self.assertEqual(list(run_tasks(pow, tasks, costs, jobs=2)), [i ** 2 for i in range(20)])
+        self.assertEqual(sorted(run_tasks(pow, tasks, costs, jobs=2, ordered=False)),
+                         [i ** 2 for i in range(20)])
+
+    def test_access_multi(self):
+        setModules([Module("mod1"), Module("mod2")])
+        workspace.logStream = StringIO()
+        _globals = Codebase()
+        _globals.scanFiles(["data/record.c", "data/macro-access.c"], twopass=True, multithread=False)
+        results = []
+        for multithread in [False, True]:
+            access = AccessCheck(_globals)
+            results.append([(type(event).__name__, event.src.name, event.range,
+                             getattr(event, "field", getattr(event, "name", None)))
+                            for event in access.xscan(multithread, jobs=2, on_field_access=_keep_event,
+                                                      on_global_name=_keep_event)])
+        self.assertTrue(results[0])
+        self.assertEqual(results[0], results[1])
+        unordered = [(type(event).__name__, event.src.name, event.range,
+                      getattr(event, "field", getattr(event, "name", None)))
+                     for event in AccessCheck(_globals).xscan(
+                         jobs=2, ordered=False, on_field_access=_keep_event, on_global_name=_keep_event)]
+        self.assertEqual(sorted(unordered, key=repr), sorted(results[0], key=repr))
+        stats = cast(WorkerStats, access.worker_stats)
+        self.assertEqual(stats.jobs, 2)
+        self.assertEqual(sum(stats.tasks.values()),
+                         len(_globals.names) + len(_globals.static_names))
+        self.assertIn("access: 2 workers", stats.report())
+        workspace.logStream = None
+
+class TestStore(TestCaseLocal):
+    def test_store(self):
+        setModules([Module("mod1"), Module("mod2")])
+        workspace.logStream = StringIO()
+        _globals = Codebase()
+        _globals.scanFiles(["data/record.c", "data/macro-access.c", "data/statements.c"],
+                           multithread=False)
+        with tempfile.TemporaryDirectory() as tmpdir, \
+                CodebaseStore(os.path.join(tmpdir, "codebase.db")) as store:
+            store.save_codebase(_globals)
+            attrs = ["names", "names_restricted", "types", "types_restricted", "macros", "typedefs"]
+            loaded = store.load()
+            for attr in [*attrs, "fields", "static_names"]:
+                self.assertEqual(pf_noid(getattr(loaded, attr)), pf_noid(getattr(_globals, attr)), attr)
+            self.assertDictEqual(loaded.field_records, _globals.field_records)
+
+            view = store.codebase()
+            for attr in attrs:
+                self.assertEqual(pf_noid(dict(getattr(view, attr))), pf_noid(getattr(_globals, attr)), attr)
+            self.assertEqual(pf_noid({rec: dict(fields) for rec, fields in view.fields.items()}),
+                             pf_noid(_globals.fields))
+            self.assertIs(view.names["func"], view.names["func"])
+            self.assertNotIn("no_such_name", view.names)
+            self.assertListEqual(
+                sorted(defn.name for _, _, defn in store.find(module="mod1", is_private=True)),
+                sorted(defn.name for defn in [*_globals.names.values(), *_globals.types.values(),
+                                              *_globals.macros.values(),
+                                              *(defn for fields in _globals.fields.values()
+                                                for defn in fields.values())]
+                       if defn.module == "mod1" and defn.is_private))
+
+            # The view is enough for the access check
+            AccessCheck(_globals).checkAccess(multithread=False)
+            expected = workspace.logStream.getvalue()
+            workspace.logStream = StringIO()
+            AccessCheck(view).checkAccess(multithread=False)
+            self.assertMultiLineEqualDiff(workspace.logStream.getvalue(), expected)
+
+            callbacks = dict(on_macro_expand=access_rows, on_global_name=access_rows,
+                             on_field_access=access_rows, on_field_chain=access_rows)
+            rows = []
+            for multithread in [False, True]:
+                store.save_codebase(_globals)
+                count = store.save_access(AccessCheck(view).xscan(multithread, jobs=2, **callbacks),
+                                          batch=10)
+                rows.append(sorted(store.access()))  # workers check static functions first
+                self.assertEqual(count, len(rows[-1]))
+            self.assertTrue(rows[0])
+            self.assertListEqual(rows[0], rows[1])
+            self.assertIn(AccessRow("call", "func", "module1", "data/record.c", 576, 39, 5,
+                                    "__wti_module2_func1", ""), store.access(dst="__wti_module2_func1"))
+            self.assertSetEqual({row.owner for row in store.access(kind="macro", dst="M1_QWE2")},
+                                {"", "QWE2"})
+        workspace.logStream = None
+
+class TestSnapshot(TestCaseLocal):
+    def test_snapshot(self):
+        setModules([Module("mod1"), Module("mod2")])
+        workspace.logStream = StringIO()
+        _globals = Codebase()
+        _globals.scanFiles(["data/record.c", "data/macro-access.c", "data/statements.c"],
+                           multithread=False)
+        AccessCheck(_globals).checkAccess(multithread=False)
+        expected = workspace.logStream.getvalue()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "codebase.snap")
+            Snapshot.save(_globals, path)
+            loaded = Snapshot.load(path)
+            assert loaded is not None
+            defn = loaded.names["func"]
+            self.assertIsInstance(defn, LazyDefinition)
+            self.assertEqual(defn.locationStr(), _globals.names["func"].locationStr())
+            self.assertIsInstance(defn, LazyDefinition)  # the location doesn't read the details
+            body = cast(FunctionParts, defn.details).body
+            self.assertIs(type(defn), Definition)
+            # The expanded text comes from the snapshot
+            filetext.clear()
+            self.assertEqual(body, cast(FunctionParts, _globals.names["func"].details).body)
+            # Loading another snapshot or scanning another codebase keeps the expander of each file
+            other = Snapshot.load(path)
+            assert other is not None
+            Codebase().scanFiles(["data/statements.c"], multithread=False)
+            filetext.clear()
+            self.assertNotEqual(loaded.files["data/record.c"].expander,
+                                other.files["data/record.c"].expander)
+            self.assertEqual(filetext.get_text(loaded.files["data/record.c"]),
+                             filetext.get_text(_globals.files["data/record.c"]))
+
+            for attr in ["names", "names_restricted", "types", "types_restricted", "macros",
+                         "typedefs", "fields", "static_names", "file_macros"]:
+                self.assertEqual(pf_noid(getattr(loaded, attr)), pf_noid(getattr(_globals, attr)), attr)
+            self.assertDictEqual(loaded.field_records, _globals.field_records)
+            self.assertEqual(pf_noid(loaded.provenance), pf_noid(_globals.provenance))
+            self.assertIs(loaded.names["func"].scope.file, loaded.files["data/record.c"])
+            for name, file in _globals.files.items():
+                self.assertEqual(pf(list(loaded.files[name].expandList or [])),
+                                 pf(list(file.expandList or [])), name)
+
+            workspace.logStream = StringIO()
+            AccessCheck(Snapshot.load(path)).checkAccess(multithread=False)  # type: ignore[arg-type]
+            self.assertMultiLineEqualDiff(workspace.logStream.getvalue(), expected)
+
+            # Loaded definitions and expansions are saved and pickled as the scanned ones
+            Snapshot.save(Snapshot.load(path), path)  # type: ignore[arg-type]
+            loaded = pickle.loads(pickle.dumps(Snapshot.load(path)))
+            self.assertEqual(pf_noid(loaded.names), pf_noid(_globals.names))
+            self.assertEqual(pf(list(loaded.files["data/macro-access.c"].expandList)),
+                             pf(list(_globals.files["data/macro-access.c"].expandList)))
+
+            # Snapshots of another version are not loaded
+            with open(path, "r+b") as f:
+                f.seek(8)
+                f.write(b"\xff")
+            self.assertIsNone(Snapshot.load(path))
+            self.assertIsNone(Snapshot.load(os.path.join(tmpdir, "no_such_file")))
+        workspace.logStream = None
+
 
 # Enable to run as a standalone script
 if __name__ == "__main__":